@@ -1,5 +1,4 @@
-from threading import Thread, Event
-from queue import Queue
+from threading import Thread, Condition
 import requests
 import time
 from flask import Flask, request, jsonify
@@ -13,7 +12,33 @@ app = Flask(__name__)
 log = []
 
 secondaries = ["http://secondary1:5001", "http://secondary2:5002"]
-ack_events = Queue()  # This queue will hold events for each replication attempt
+
+
+class Acks:
+    """
+    The secondaries that have acknowledged one message.
+
+    It is used like the old `acks` list (append / len), but append() also wakes up the request
+    waiting in wait_for_acks(), so the request doesn't have to poll and requests don't share any queue.
+    A secondary is only counted once.
+    """
+
+    def __init__(self):
+        self._secondaries = []
+        self._condition = Condition()
+
+    def append(self, secondary):
+        with self._condition:
+            if secondary not in self._secondaries:
+                self._secondaries.append(secondary)
+            self._condition.notify_all()
+
+    def __len__(self):
+        return len(self._secondaries)
+
+    def wait_for(self, required_acks, timeout):
+        with self._condition:
+            return self._condition.wait_for(lambda: len(self._secondaries) >= required_acks, timeout)
 
 
 def replicate_to_secondary(secondary, seq_message, acks, required_acks):
@@ -71,35 +96,17 @@ def wait_for_acks(acks, required_acks, timeout=30):
     Waits for a specified number of acknowledgments from secondary nodes.
 
     Args:
-        acks (list): A list that keeps track of which secondary nodes have successfully acknowledged the replication.
+        acks (Acks): Keeps track of which secondary nodes have successfully acknowledged the replication.
         required_acks (int): The number of acknowledgments required for the write operation to be considered successful.
         timeout (int): The maximum time to wait for the required acknowledgments.
 
     Returns:
         bool: True if the required number of acks is received within the timeout, False otherwise.
 
-
-    Why it's not ok for log-3 version? =>
-    The wait_for_acks function is used to wait synchronously for the required number of ACKs. 
-    This means the function will block (i.e., wait without doing anything else) 
-    until the required number of ACKs is received or until a timeout occurs.
+    The request is woken up by the replication thread that adds the last required ACK,
+    so there is no polling loop and no extra waiter thread per request.
     """
-    wait_event = Event()
-
-    # Check if the required ACKs are already present
-    if len(acks) >= required_acks:
-        return True
-
-    # Start a background thread to wait for ACKs
-    def ack_waiter():
-        while len(acks) < required_acks:
-            time.sleep(0.1)
-        wait_event.set()  # Signal that the required ACKs have been received
-
-    Thread(target=ack_waiter).start()
-    # Wait for the required ACKs to be received or for the timeout
-    is_acked = wait_event.wait(timeout)
-    return is_acked
+    return acks.wait_for(required_acks, timeout)
 
 
 # Global log to keep all messages
@@ -131,28 +138,16 @@ def post_message():
 
         #ack_events_list = []
 
-        acks = []  # Initialize the list to keep track of ACKs from secondaries
-        ack_events_list = [] # Initialize the list to keep track of events for each replication attempt
+        acks = Acks()  # Keeps track of ACKs from secondaries and wakes us up when they arrive
+        # w counts the master too, it has the message already: w=1 needs no secondary, w=3 needs two
+        required_acks = write_concern - 1
 
         for secondary in secondaries:
-            ack_event = Event()
-            ack_events.put(ack_event)
-            ack_events_list.append(ack_event)
-
-            # Pass the required_acks argument to the replicate_to_secondary function
-            #replication_thread = Thread(target=replicate_to_secondary, args=(secondary, seq_message, ack_event, write_concern))
-            #replication_thread = Thread(target=replicate_to_secondary, args=(secondary, seq_message, ack_event))
-            #replication_thread = Thread(target=replicate_to_secondary, args=(secondary, seq_message, ack_event, write_concern))
-            replication_thread = Thread(target=replicate_to_secondary, args=(secondary, seq_message, acks, write_concern))
-            #replication_thread = Thread(target=replicate_to_secondary, args=(secondary, seq_message, acks, write_concern))
-
+            replication_thread = Thread(target=replicate_to_secondary, args=(secondary, seq_message, acks, required_acks))
             replication_thread.start()
 
-        acks_received = 0
-        while acks_received < write_concern:
-            ack_event = ack_events.get()
-            ack_event.wait()
-            acks_received += 1
+        if required_acks > 0 and not wait_for_acks(acks, required_acks):
+            return jsonify({'status': 'fail', 'message': 'Write concern not satisfied'}), 500
 
         return jsonify({'status': 'success', 'message': 'Message replicated with required write concern'}), 200
 
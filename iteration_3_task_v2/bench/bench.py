@@ -0,0 +1,439 @@
+"""
+Load-generation benchmark of the replicated log, no Docker needed.
+
+Starts the master (master/master.py) as a subprocess with a fresh data directory and points it
+at N stand-in secondaries served from this process. The stand-ins speak the same replication
+protocol as the real secondaries (JSON and the binary framing of wire.py, cumulative ACKs) but
+keep nothing but their position, so the numbers are the master's. Then `--concurrency` clients
+send POST /messages with a mix of write concerns for `--duration` seconds, and throughput and
+latency percentiles are written to a JSON result file.
+
+Delay and failures of the secondaries can be injected at a given second of the run:
+
+    --event AT:ACTION:TARGET[:VALUE]
+
+    AT       seconds from the start of the load
+    ACTION   delay   - answer replication requests after VALUE seconds
+             fail    - answer replication requests with 500
+             down    - stop listening (connections are refused)
+             recover - listen again, no failures, no delay
+    TARGET   number of the secondary (1..N) or 'all'
+
+Example:
+    python bench/bench.py --secondaries 2 --concurrency 16 --duration 30 --w-mix 1:0.5,2:0.3,3:0.2 \\
+        --event 10:delay:2:0.2 --event 20:down:1 --event 25:recover:all --output result.json
+
+With --baseline, the run is compared to an earlier result file and the exit status is 1 if the
+throughput dropped or the p99 latency grew by more than --max-regression.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MASTER_SCRIPT = os.path.join(ROOT, 'master', 'master.py')
+sys.path.insert(0, ROOT)
+
+from common.wire import MEDIA_TYPE, decode_batch  # noqa: E402
+
+PERCENTILES = (50, 95, 99)
+MASTER_START_TIMEOUT = 30  # Seconds to wait for the master to answer
+
+
+class StandInSecondary:
+    """
+    A secondary that applies replicated records by sequence number only, served on 127.0.0.1.
+
+    Records ahead of a gap are buffered until the gap is filled, every answer carries the
+    highest contiguous sequence number applied, like the real secondaries do.
+    """
+
+    def __init__(self, name, delay=0.0):
+        self.name = name
+        self.delay = delay
+        self.failing = False
+        self.last_applied = -1
+        self.received = 0
+        self._buffer = {}
+        self._lock = threading.Lock()
+        self._server = None
+        self.port = self._listen(0)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def _listen(self, port):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, the master pools its connections
+
+            def handle(self):
+                try:
+                    super().handle()
+                except ConnectionError:
+                    pass  # The master went away (end of the run, or it was restarted)
+
+            def do_GET(self):
+                if self._is_down():
+                    return
+                if self.path == '/health':
+                    self._reply(200, {'status': 'OK'})
+                elif self.path == '/status':
+                    self._reply(200, {'last_applied': standin.last_applied, 'buffered': len(standin._buffer)})
+                else:
+                    self._reply(404, {'status': 'error', 'message': 'Not found'})
+
+            def do_POST(self):
+                if self._is_down():
+                    return
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path not in ('/replicate', '/replicate_batch'):
+                    self._reply(404, {'status': 'error', 'message': 'Not found'})
+                    return
+                if standin.failing:
+                    self._reply(500, {'status': 'error', 'message': 'Injected failure'})
+                    return
+                try:
+                    if self.headers.get_content_type() == MEDIA_TYPE:
+                        records = decode_batch(body, self.headers.get('Content-Encoding'))
+                    else:
+                        payload = json.loads(body)
+                        records = payload['records'] if self.path == '/replicate_batch' else [payload]
+                except (ValueError, KeyError) as e:
+                    self._reply(400, {'status': 'error', 'message': str(e)})
+                    return
+                results = standin.apply(records)
+                if standin.delay:
+                    time.sleep(standin.delay)
+                self._reply(200, {'status': 'ACK', 'last_applied': standin.last_applied, **results})
+
+            def _is_down(self):
+                # Keep-alive connections outlive a stopped listener, they are dropped without an answer
+                if self.server is not standin._server:
+                    self.close_connection = True
+                    return True
+                return False
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name=f"standin-{self.name}", daemon=True).start()
+        return self._server.server_address[1]
+
+    def apply(self, records):
+        results = {'applied': 0, 'duplicate': 0, 'buffered': 0, 'rejected': 0}
+        with self._lock:
+            self.received += len(records)
+            for record in records:
+                seq = record['sequence_number']
+                if seq <= self.last_applied or seq in self._buffer:
+                    results['duplicate'] += 1
+                elif seq > self.last_applied + 1:
+                    self._buffer[seq] = True
+                    results['buffered'] += 1
+                else:
+                    self.last_applied = seq
+                    results['applied'] += 1
+                    while self.last_applied + 1 in self._buffer:
+                        del self._buffer[self.last_applied + 1]
+                        self.last_applied += 1
+        return results
+
+    def down(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def recover(self):
+        self.failing = False
+        self.delay = 0.0
+        if self._server is None:
+            self._listen(self.port)
+
+    def status(self):
+        return {'url': self.url, 'last_applied': self.last_applied, 'received': self.received,
+                'delay': self.delay, 'failing': self.failing, 'listening': self._server is not None}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_master(port, standins, data_dir, extra_env):
+    env = dict(os.environ)
+    env.update({
+        'MASTER_PORT': str(port),
+        'SECONDARIES': ','.join(standin.url for standin in standins),
+        'WAL_DIR': os.path.join(data_dir, 'wal'),
+        'SNAPSHOT_DIR': os.path.join(data_dir, 'snapshots'),
+    })
+    env.update(extra_env)
+    log_path = os.path.join(data_dir, 'master.log')
+    with open(log_path, 'wb') as log:
+        process = subprocess.Popen([sys.executable, MASTER_SCRIPT], cwd=data_dir, env=env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + MASTER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The master exited with status {process.returncode}, see {log_path}")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/", timeout=1).status_code == 200:
+                return process, log_path
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"The master did not answer within {MASTER_START_TIMEOUT}s, see {log_path}")
+
+
+def parse_w_mix(text):
+    # "1:0.5,2:0.3,3:0.2" -> ([1, 2, 3], [0.5, 0.3, 0.2])
+    values, weights = [], []
+    for part in text.split(','):
+        w, weight = part.split(':')
+        values.append(int(w))
+        weights.append(float(weight))
+    if not values or sum(weights) <= 0:
+        raise ValueError(f"Invalid write concern mix: {text}")
+    return values, weights
+
+
+def parse_event(text):
+    parts = text.split(':')
+    if len(parts) not in (3, 4) or parts[1] not in ('delay', 'fail', 'down', 'recover'):
+        raise argparse.ArgumentTypeError(f"Expected AT:ACTION:TARGET[:VALUE], got {text}")
+    if parts[1] == 'delay' and len(parts) != 4:
+        raise argparse.ArgumentTypeError(f"delay needs a VALUE in seconds: {text}")
+    return {'at': float(parts[0]), 'action': parts[1], 'target': parts[2],
+            'value': float(parts[3]) if len(parts) == 4 else None}
+
+
+def run_events(events, standins, started, stop):
+    # Applies the injected events at their time, returns the log of what was done when
+    done = []
+
+    def run():
+        for event in sorted(events, key=lambda e: e['at']):
+            if stop.wait(max(0.0, started + event['at'] - time.monotonic())):
+                return
+            targets = standins if event['target'] == 'all' else [standins[int(event['target']) - 1]]
+            for standin in targets:
+                if event['action'] == 'delay':
+                    standin.delay = event['value']
+                elif event['action'] == 'fail':
+                    standin.failing = True
+                elif event['action'] == 'down':
+                    standin.down()
+                else:
+                    standin.recover()
+            done.append({**event, 'applied_at': round(time.monotonic() - started, 3)})
+            print(f"[{time.monotonic() - started:6.1f}s] {event['action']} {event['target']}"
+                  + (f" {event['value']}" if event['value'] is not None else ""), flush=True)
+
+    thread = threading.Thread(target=run, name='events', daemon=True)
+    thread.start()
+    return thread, done
+
+
+def client(url, args, seed, started, stop, samples):
+    # One closed-loop client: sends the next message as soon as the previous one is answered
+    rng = random.Random(seed)
+    values, weights = parse_w_mix(args.w_mix)
+    session = requests.Session()
+    filler = 'x' * args.payload_bytes
+    sent = 0
+    while not stop.is_set():
+        w = rng.choices(values, weights)[0]
+        prefix = f"{seed}-{sent}-"  # Unique, so payload deduplication never kicks in
+        message = (prefix + filler)[:max(args.payload_bytes, len(prefix))]
+        sent += 1
+        begin = time.monotonic()
+        try:
+            response = session.post(url, json={'message': message, 'w': w, 'timeout': args.write_timeout},
+                                    timeout=args.write_timeout + 10)
+            status = response.status_code
+        except requests.RequestException:
+            status = 0
+        end = time.monotonic()
+        samples.append((begin - started, w, end - begin, status))
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return None
+    rank = max(1, -(-p * len(sorted_values) // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(samples, duration):
+    latencies = sorted(latency for _, _, latency, status in samples if status == 200)
+    ok = len(latencies)
+    summary = {
+        'requests': len(samples),
+        'ok': ok,
+        'errors': len(samples) - ok,
+        'error_rate': round((len(samples) - ok) / len(samples), 4) if samples else 0,
+        'throughput_rps': round(ok / duration, 2) if duration > 0 else 0,
+        'latency_ms': {
+            **{f"p{p}": None if not latencies else round(percentile(latencies, p) * 1000, 3) for p in PERCENTILES},
+            'mean': None if not latencies else round(sum(latencies) / ok * 1000, 3),
+            'max': None if not latencies else round(latencies[-1] * 1000, 3),
+        },
+    }
+    return summary
+
+
+def timeline(samples, warmup, duration):
+    # Per-second throughput and p99, to see what the injected events did
+    seconds = {}
+    for at, _, latency, status in samples:
+        second = int(at)
+        if warmup <= second < warmup + duration:
+            seconds.setdefault(second, []).append((latency, status))
+    rows = []
+    for second in range(int(warmup), int(warmup + duration)):
+        # A second without samples stays in, a stall is what the timeline is for
+        started = seconds.get(second, [])
+        latencies = sorted(latency for latency, status in started if status == 200)
+        rows.append({
+            't': second,
+            'ok': len(latencies),
+            'errors': len(started) - len(latencies),
+            'p99_ms': None if not latencies else round(percentile(latencies, 99) * 1000, 3),
+        })
+    return rows
+
+
+def compare(result, baseline, max_regression):
+    # Returns the list of regressions against the baseline result
+    regressions = []
+    old, new = baseline['summary'], result['summary']
+    if old['throughput_rps'] and new['throughput_rps'] < old['throughput_rps'] * (1 - max_regression):
+        regressions.append(f"throughput {new['throughput_rps']} rps < {old['throughput_rps']} rps")
+    old_p99, new_p99 = old['latency_ms']['p99'], new['latency_ms']['p99']
+    if old_p99 and new_p99 and new_p99 > old_p99 * (1 + max_regression):
+        regressions.append(f"p99 {new_p99} ms > {old_p99} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the master with local stand-in secondaries.")
+    parser.add_argument('--secondaries', type=int, default=2, help="Number of stand-in secondaries")
+    parser.add_argument('--concurrency', type=int, default=8, help="Number of concurrent clients")
+    parser.add_argument('--duration', type=float, default=20, help="Seconds of measured load")
+    parser.add_argument('--warmup', type=float, default=2, help="Seconds of load before the measurement starts")
+    parser.add_argument('--payload-bytes', type=int, default=64, help="Size of every message")
+    parser.add_argument('--w-mix', default='1:0.34,2:0.33,3:0.33', help="Write concerns and their weights")
+    parser.add_argument('--write-timeout', type=float, default=10, help="Write concern deadline sent with every message")
+    parser.add_argument('--secondary-delay', type=float, default=0, help="Delay of the stand-ins from the start, in seconds")
+    parser.add_argument('--event', type=parse_event, action='append', default=[], help="AT:ACTION:TARGET[:VALUE]")
+    parser.add_argument('--master-env', action='append', default=[], help="KEY=VALUE passed to the master")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='bench-result.json', help="Result file")
+    parser.add_argument('--baseline', help="Earlier result file to compare with")
+    parser.add_argument('--max-regression', type=float, default=0.1, help="Tolerated relative regression")
+    parser.add_argument('--keep-data', action='store_true', help="Keep the master's data directory and log")
+    args = parser.parse_args()
+    parse_w_mix(args.w_mix)
+    extra_env = dict(item.split('=', 1) for item in args.master_env)
+
+    standins = [StandInSecondary(f"secondary{i + 1}", delay=args.secondary_delay) for i in range(args.secondaries)]
+    data_dir = tempfile.mkdtemp(prefix='replicated-log-bench-')
+    port = free_port()
+    master, master_log = start_master(port, standins, data_dir, extra_env)
+    master_url = f"http://127.0.0.1:{port}"
+    print(f"Master on {master_url}, {len(standins)} stand-in secondaries, log in {master_log}", flush=True)
+
+    try:
+        stop = threading.Event()
+        samples = []  # (seconds since start, w, latency, status), list.append is thread-safe
+        started = time.monotonic()
+        _, events_done = run_events(args.event, standins, started + args.warmup, stop)
+        clients = [
+            threading.Thread(target=client, args=(f"{master_url}/messages", args, args.seed * 1000 + i, started, stop, samples),
+                             daemon=True)
+            for i in range(args.concurrency)
+        ]
+        for thread in clients:
+            thread.start()
+        time.sleep(args.warmup + args.duration)
+        stop.set()
+        for thread in clients:
+            thread.join()
+
+        # Requests started during the warmup are not measured
+        measured = [(at - args.warmup, w, latency, status) for at, w, latency, status in samples if at >= args.warmup]
+        mix = sorted({w for _, w, _, _ in measured})
+        try:
+            replication = requests.get(f"{master_url}/replication", timeout=5).json()
+        except (requests.RequestException, ValueError):
+            replication = None
+
+        result = {
+            'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'config': {key: value for key, value in vars(args).items() if key not in ('baseline', 'output', 'keep_data')},
+            'summary': summarize(measured, args.duration),
+            'by_w': {str(w): summarize([s for s in measured if s[1] == w], args.duration) for w in mix},
+            'timeline': timeline(measured, 0, args.duration),
+            'events': events_done,
+            'secondaries': [standin.status() for standin in standins],
+            'replication': replication,
+        }
+    finally:
+        master.terminate()
+        master.wait(10)
+        for standin in standins:
+            standin.down()
+        if not args.keep_data:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    summary = result['summary']
+    print(f"{summary['ok']} ok, {summary['errors']} errors in {args.duration:g}s: {summary['throughput_rps']} rps, "
+          + ", ".join(f"{name} {value} ms" for name, value in summary['latency_ms'].items()))
+    for w, by_w in result['by_w'].items():
+        print(f"  w={w}: {by_w['throughput_rps']} rps, p50 {by_w['latency_ms']['p50']} ms, p99 {by_w['latency_ms']['p99']} ms")
+    print(f"Result written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.max_regression)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+"""Modules used by both the master and the secondaries."""
@@ -0,0 +1,55 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+
+class DedupIndex:
+    """
+    Content-hash index of the messages in a log, for constant-time duplicate payload checks.
+
+    Each message is stored as a 16-byte BLAKE2b digest mapped to the sequence number that holds it,
+    so a lookup costs the same no matter how long the log is. The index can be bounded: the oldest
+    digests are evicted once there are more than `max_entries` of them or they are older than `ttl`.
+    An evicted payload is no longer recognised as a duplicate.
+
+    Args:
+        max_entries (int): Maximum number of digests kept, 0 for no limit.
+        ttl (float): Seconds a digest is kept, 0 to keep it forever.
+    """
+
+    def __init__(self, max_entries=0, ttl=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._digests = OrderedDict()  # digest -> (sequence_number, added_at), oldest first
+
+    def __len__(self):
+        return len(self._digests)
+
+    @staticmethod
+    def digest(message):
+        return hashlib.blake2b(message.encode('utf-8'), digest_size=16).digest()
+
+    def lookup(self, message):
+        """Return the sequence number of an earlier message with the same payload, or None."""
+        self._evict()
+        entry = self._digests.get(self.digest(message))
+        return None if entry is None else entry[0]
+
+    def add(self, sequence_number, message):
+        """Remember the payload of `sequence_number`."""
+        digest = self.digest(message)
+        if digest not in self._digests:
+            self._digests[digest] = (sequence_number, time.monotonic())
+        self._evict()
+
+    def _evict(self):
+        if self.max_entries:
+            while len(self._digests) > self.max_entries:
+                self._digests.popitem(last=False)
+        if self.ttl:
+            expired_before = time.monotonic() - self.ttl
+            while self._digests and next(iter(self._digests.values()))[1] < expired_before:
+                self._digests.popitem(last=False)
+
+    def stats(self):
+        return {'entries': len(self._digests), 'max_entries': self.max_entries, 'ttl': self.ttl}
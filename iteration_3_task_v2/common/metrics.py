@@ -0,0 +1,218 @@
+"""
+Counters, gauges and histograms exported in the Prometheus text format on /metrics.
+
+Recording is meant for hot paths: every metric keeps its values in a few stripes, each with its
+own lock, and a thread always writes to the stripe picked by its thread id. So concurrent request
+threads rarely wait on each other, a record costs an uncontended lock and an addition, and the
+stripes are only added up when /metrics is scraped. Gauges are usually computed at scrape time
+from a callback, so keeping them up to date costs nothing at all.
+"""
+import bisect
+import math
+import threading
+import time
+
+STRIPES = 8
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _stripe():
+    # Thread ids are aligned addresses, mix the bits before picking a stripe
+    ident = threading.get_ident()
+    return ((ident >> 4) ^ (ident >> 12) ^ (ident >> 20)) % STRIPES
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """The metrics of one process, rendered together by render()."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """The child metric of one combination of label values (created on first use)."""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class _CounterChild:
+    def __init__(self):
+        self._values = [0.0] * STRIPES
+        self._locks = [threading.Lock() for _ in range(STRIPES)]
+
+    def inc(self, amount=1):
+        stripe = _stripe()
+        with self._locks[stripe]:
+            self._values[stripe] += amount
+
+    def get(self):
+        return sum(self._values)
+
+
+class Counter(_Metric):
+    """A value that only goes up (requests, retries, applied records)."""
+
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.get())}"
+                for values, child in list(self._children.items())]
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        # Per stripe: one count per bucket (+Inf last), then the sum of the observations
+        self._stripes = [[0] * (len(buckets) + 1) + [0.0] for _ in range(STRIPES)]
+        self._locks = [threading.Lock() for _ in range(STRIPES)]
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        stripe = _stripe()
+        counts = self._stripes[stripe]
+        with self._locks[stripe]:
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self):
+        """Context manager that observes the seconds spent in its block."""
+        return _Timer(self)
+
+    def snapshot(self):
+        # (cumulative bucket counts, total count, sum)
+        totals = [sum(column) for column in zip(*self._stripes)]
+        cumulative = []
+        running = 0
+        for count in totals[:-1]:
+            running += count
+            cumulative.append(running)
+        return cumulative, running, totals[-1]
+
+
+class _Timer:
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._child.observe(time.perf_counter() - self._start)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values (latencies) in fixed buckets, with their count and sum."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def samples(self):
+        lines = []
+        for values, child in list(self._children.items()):
+            cumulative, count, total = child.snapshot()
+            for bound, bucket_count in zip(self.buckets + (math.inf,), cumulative):
+                labels = _format_labels(self.labelnames, values, [('le', _format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, read from `callback` at scrape time.
+
+    The callback returns the value, or {(label values...): value} if the gauge has labels.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, callback, labelnames=(), registry=REGISTRY):
+        self.callback = callback
+        super().__init__(name, help, labelnames, registry)
+
+    def samples(self):
+        values = self.callback()
+        if not self.labelnames:
+            values = {(): values}
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+                for labels, value in values.items() if value is not None]
@@ -0,0 +1,78 @@
+"""
+Range reads of a log over HTTP: query parameters, ETags and chunked JSON responses.
+"""
+import json
+
+from flask import Response, request
+
+STREAM_CHUNK_RECORDS = 1000  # Messages serialised per chunk of a streamed response
+
+
+def range_args():
+    """
+    Parse the `since`, `until` and `limit` query parameters of a read.
+
+    `since` is the first sequence number returned, `until` the first one that is not,
+    `limit` the maximum number of messages. Missing parameters are None.
+
+    Returns:
+        tuple: (since, until, limit)
+
+    Raises:
+        ValueError: If a parameter is not a non-negative integer.
+    """
+    values = []
+    for name in ('since', 'until', 'limit'):
+        value = request.args.get(name)
+        if value is not None:
+            value = int(value)
+            if value < 0:
+                raise ValueError(f"'{name}' must not be negative")
+        values.append(value)
+    return tuple(values)
+
+
+def not_modified(etag):
+    """True if the client already has the version of the log identified by `etag` (If-None-Match)."""
+    return request.if_none_match.contains(etag)
+
+
+def read_headers(etag, high_watermark, next_since=None):
+    headers = {'ETag': f'"{etag}"', 'X-High-Watermark': str(high_watermark)}
+    if next_since is not None:
+        headers['X-Next-Since'] = str(next_since)
+    return headers
+
+
+def stream_messages(messages, next_since, high_watermark, etag):
+    """
+    Stream {"messages": [...], "next_since": ..., "high_watermark": ...} as chunked JSON.
+
+    Messages are serialised `STREAM_CHUNK_RECORDS` at a time, so a large read never builds
+    the whole body in memory. `next_since` is where the next incremental read should start.
+
+    Args:
+        messages (iterable): The message strings, in sequence order.
+        next_since (int): The `since` of the next read.
+        high_watermark (int): Highest sequence number readable on this node.
+        etag (str): Version of the log the read was made against.
+    """
+    def generate():
+        yield '{"messages": ['
+        chunk = []
+        first = True
+        for message in messages:
+            chunk.append(json.dumps(message))
+            if len(chunk) >= STREAM_CHUNK_RECORDS:
+                yield ('' if first else ',') + ','.join(chunk)
+                first = False
+                chunk = []
+        if chunk:
+            yield ('' if first else ',') + ','.join(chunk)
+        yield f'], "next_since": {next_since}, "high_watermark": {high_watermark}}}'
+
+    return Response(generate(), mimetype='application/json', headers=read_headers(etag, high_watermark, next_since))
+
+
+def not_modified_response(etag, high_watermark):
+    return Response(status=304, headers=read_headers(etag, high_watermark))
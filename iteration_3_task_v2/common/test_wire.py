@@ -0,0 +1,126 @@
+import zlib
+
+import pytest
+
+from common.wire import (COMPRESSED_ENCODING, MEDIA_TYPE, BatchPoster, decode_batch, decode_records, encode_batch,
+                         encode_records, is_valid_message)
+
+
+def records(*sequence_numbers):
+    return [{'sequence_number': n, 'message': f"message {n} é"} for n in sequence_numbers]
+
+
+@pytest.mark.parametrize('batch', [
+    records(0, 1, 2),
+    records(5, 9, 300, 10 ** 12),  # Gaps and sequence numbers that take several varint bytes
+    [{'sequence_number': 7, 'message': 'x' * 1000}],
+    [],
+])
+def test_records_round_trip(batch):
+    assert decode_records(encode_records(batch)) == batch
+
+
+def test_contiguous_batch_takes_two_bytes_of_framing_per_record():
+    batch = records(*range(100, 110))
+    payload = sum(len(r['message'].encode('utf-8')) for r in batch)
+    assert len(encode_records(batch)) == 1 + 1 + payload + 2 * len(batch)
+
+
+def test_records_out_of_order_are_refused():
+    with pytest.raises(ValueError):
+        encode_records(records(2, 1))
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'\x80',              # A varint with its continuation bit set and nothing after it
+    b'\x01\x80\x80',
+])
+def test_truncated_varint(data):
+    with pytest.raises(ValueError):
+        decode_records(data)
+
+
+def test_truncated_and_padded_batches_are_refused():
+    data = encode_records(records(0, 1))
+    with pytest.raises(ValueError):
+        decode_records(data[:-1])
+    with pytest.raises(ValueError):
+        decode_records(data + b'\x00')
+
+
+def test_large_batches_are_compressed():
+    batch = records(*range(500))
+    body, headers = encode_batch(batch, compress_min_bytes=4096)
+    assert headers == {'Content-Type': MEDIA_TYPE, 'Content-Encoding': COMPRESSED_ENCODING}
+    assert decode_batch(body, headers['Content-Encoding']) == batch
+
+    body, headers = encode_batch(records(0), compress_min_bytes=4096)
+    assert 'Content-Encoding' not in headers
+    assert decode_batch(body) == records(0)
+
+
+def test_bad_content_encoding_is_refused():
+    body, _ = encode_batch(records(0), compress_min_bytes=0)
+    with pytest.raises(ValueError):
+        decode_batch(body, 'gzip')
+    with pytest.raises(ValueError):
+        decode_batch(b'not deflate', COMPRESSED_ENCODING)
+    assert decode_batch(zlib.compress(body), COMPRESSED_ENCODING) == records(0)
+
+
+def test_is_valid_message():
+    assert is_valid_message('a')
+    assert not is_valid_message('')
+    assert not is_valid_message(None)
+    assert not is_valid_message(3)
+    assert not is_valid_message(['a'])
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakePool:
+    """Stands in for the SessionPool: answers 415 to binary batches from the URLs in `json_only`."""
+
+    def __init__(self, json_only=()):
+        self.json_only = set(json_only)
+        self.posts = []
+
+    def post(self, secondary, path, data=None, json=None, headers=None, **kwargs):
+        binary = json is None
+        self.posts.append((secondary, 'binary' if binary else 'json', headers))
+        return FakeResponse(415 if binary and secondary in self.json_only else 200)
+
+
+def test_binary_batches_by_default():
+    pool = FakePool()
+    poster = BatchPoster(pool)
+    assert poster.post_batch('http://s1', records(0), headers={'X-Partition': '1'}).status_code == 200
+    secondary, sent_as, headers = pool.posts[0]
+    assert sent_as == 'binary'
+    assert headers['Content-Type'] == MEDIA_TYPE and headers['X-Partition'] == '1'
+    assert poster.format_for('http://s1') == 'binary'
+
+
+def test_415_falls_back_to_json_for_that_secondary():
+    pool = FakePool(json_only={'http://old'})
+    poster = BatchPoster(pool)
+
+    assert poster.post_batch('http://old', records(0)).status_code == 200
+    assert [sent_as for _, sent_as, _ in pool.posts] == ['binary', 'json']  # The same batch, sent again at once
+
+    poster.post_batch('http://old', records(1))
+    poster.post_batch('http://new', records(1))
+    assert [(secondary, sent_as) for secondary, sent_as, _ in pool.posts[2:]] == [('http://old', 'json'), ('http://new', 'binary')]
+    assert poster.format_for('http://old') == 'json'
+
+
+def test_json_only_poster():
+    pool = FakePool()
+    poster = BatchPoster(pool, binary=False)
+    poster.post_batch('http://s1', records(0))
+    assert pool.posts[0][1] == 'json'
+    assert poster.format_for('http://s1') == 'json'
@@ -0,0 +1,171 @@
+"""
+Lightweight tracing of the write path: sampled spans kept in an in-memory ring buffer.
+
+A trace is identified by a trace ID. The master samples a fraction of the writes (or every write
+that comes with an X-Trace-Id header) and records a span for every step of it. The sequence number
+of a sampled write is linked to its trace, so the replication batch that carries it records a
+span on the trace too and passes the trace IDs on in the X-Trace-Id header (comma-separated, a
+batch can carry several sampled writes); the secondaries record their own spans under the same IDs.
+Spans are appended to a bounded deque, which needs no lock, and unsampled writes cost one check.
+
+Spans are read back grouped by trace, or as Chrome trace JSON (chrome://tracing, Perfetto).
+Timestamps are wall-clock, so the dumps of the master and the secondaries can be merged.
+"""
+import os
+import random
+import threading
+import time
+import uuid
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+TRACE_HEADER = 'X-Trace-Id'
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ('tracer', 'trace_id', 'name', 'attrs', 'start')
+
+    def __init__(self, tracer, trace_id, name, attrs):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.trace_id, self.name, self.start, time.time(), **self.attrs)
+        return False
+
+    def set(self, **attrs):
+        """Add attributes to the span (known only once the step is done)."""
+        self.attrs.update(attrs)
+
+
+class Tracer:
+    """
+    Samples traces and keeps their spans.
+
+    Args:
+        node (str): Name of this node in the spans.
+        sample_rate (float): Fraction of the traces started here that are recorded.
+        max_spans (int): Size of the ring buffer, older spans are dropped.
+        max_links (int): Sequence numbers of sampled writes remembered for the replication spans.
+    """
+
+    def __init__(self, node, sample_rate=0.01, max_spans=10000, max_links=10000):
+        self.node = node
+        self.sample_rate = sample_rate
+        self.max_links = max_links
+        self._spans = deque(maxlen=max_spans)  # (trace_id, name, start, end, thread, attrs)
+        self._link_seqs = []   # Ascending, appended in log order
+        self._link_traces = []
+        self._link_lock = threading.Lock()
+
+    def sample(self, trace_id=None):
+        """
+        The trace ID of a new request: `trace_id` if the caller passed one (always recorded),
+        a new ID for a sampled request, or None if the request is not traced.
+        """
+        if trace_id:
+            return trace_id[:64]
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return uuid.uuid4().hex
+        return None
+
+    def span(self, trace_id, name, **attrs):
+        """Context manager that records the time spent in its block, a no-op if trace_id is None."""
+        if trace_id is None:
+            return NO_SPAN
+        return _Span(self, trace_id, name, attrs)
+
+    def record(self, trace_id, name, start, end, **attrs):
+        """Record a span timed by the caller (time.time() values)."""
+        if trace_id is not None:
+            self._spans.append((trace_id, name, start, end, threading.current_thread().name, attrs))
+
+    def link(self, seq, trace_id):
+        """Remember that the record `seq` belongs to the trace. Call in ascending seq order."""
+        if trace_id is None:
+            return
+        with self._link_lock:
+            self._link_seqs.append(seq)
+            self._link_traces.append(trace_id)
+            if len(self._link_seqs) > self.max_links:
+                del self._link_seqs[:self.max_links // 2]
+                del self._link_traces[:self.max_links // 2]
+
+    def linked(self, first_seq, last_seq):
+        """Trace IDs of the sampled records between first_seq and last_seq (inclusive)."""
+        with self._link_lock:
+            if not self._link_seqs or self._link_seqs[-1] < first_seq:
+                return []
+            start = bisect_left(self._link_seqs, first_seq)
+            stop = bisect_right(self._link_seqs, last_seq)
+            return self._link_traces[start:stop]
+
+    def _select(self, trace_id=None, limit=20):
+        # Spans of the newest `limit` traces (or of one trace), {trace_id: [span, ...]} oldest trace first
+        traces = {}
+        for span in reversed(list(self._spans)):
+            if trace_id is not None and span[0] != trace_id:
+                continue
+            if span[0] not in traces:
+                if len(traces) >= limit:
+                    continue
+                traces[span[0]] = []
+            traces[span[0]].append(span)
+        return {key: sorted(spans, key=lambda s: s[2]) for key, spans in reversed(list(traces.items()))}
+
+    def traces(self, trace_id=None, limit=20):
+        """The recorded traces with their spans, newest last."""
+        result = []
+        for key, spans in self._select(trace_id, limit).items():
+            started = spans[0][2]
+            result.append({
+                'trace_id': key,
+                'node': self.node,
+                'start': started,
+                'duration_ms': round((max(s[3] for s in spans) - started) * 1000, 3),
+                'spans': [{
+                    'name': name,
+                    'offset_ms': round((start - started) * 1000, 3),
+                    'duration_ms': round((end - start) * 1000, 3),
+                    'thread': thread,
+                    **attrs,
+                } for _, name, start, end, thread, attrs in spans],
+            })
+        return result
+
+    def chrome_trace(self, trace_id=None, limit=20):
+        """The recorded spans in the Chrome trace event format."""
+        pid = os.getpid()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': self.node}}]
+        threads = {}
+        for spans in self._select(trace_id, limit).values():
+            for key, name, start, end, thread, attrs in spans:
+                tid = threads.setdefault(thread, len(threads) + 1)
+                events.append({
+                    'name': name, 'cat': self.node, 'ph': 'X', 'pid': pid, 'tid': tid,
+                    'ts': round(start * 1e6), 'dur': round((end - start) * 1e6),
+                    'args': {'trace_id': key, **attrs},
+                })
+        events += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread}}
+                   for thread, tid in threads.items()]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
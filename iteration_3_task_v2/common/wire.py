@@ -0,0 +1,187 @@
+"""
+Binary framing of replication batches, with JSON as the fallback.
+
+A batch is: varint record count, varint sequence number of the first record, then for every
+record a varint gap to the previous sequence number (0 in a contiguous batch, so one byte),
+the varint length of the payload and the raw UTF-8 payload. Records must be in ascending order.
+A batch larger than `compress_min_bytes` is compressed with zlib and sent with
+`Content-Encoding: deflate`. The receiver tells the formats apart by the Content-Type and
+answers 415 to one it doesn't read, after which the sender uses JSON for that node.
+"""
+import logging
+import zlib
+
+MEDIA_TYPE = 'application/x-replicated-log-batch'
+COMPRESSED_ENCODING = 'deflate'
+FORWARD_HEADER = 'X-Replication-Forward'  # On live batches: a secondary passes them on to its children in the tree
+PARTITION_HEADER = 'X-Partition'  # Partition of the records of a batch, partition 0 without it
+
+
+def is_valid_message(message):
+    """
+    A message the log takes: a non-empty string that can be encoded as UTF-8 (JSON lets a lone surrogate
+    like "\\ud800" through). The master checks writes with it and the secondaries records.
+    """
+    if not message or not isinstance(message, str):
+        return False
+    if message.isascii():
+        return True
+    try:
+        message.encode('utf-8')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+def _varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+def _read_varint(data, position):
+    # Returns (value, position after it)
+    value = 0
+    shift = 0
+    while True:
+        if position >= len(data):
+            raise ValueError("Truncated varint")
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def encode_records(records):
+    """
+    Frame [{'sequence_number': ..., 'message': ...}, ...] as bytes.
+
+    Raises:
+        ValueError: If the records are not in ascending sequence-number order.
+    """
+    out = _varint(len(records))
+    previous = records[0]['sequence_number'] - 1 if records else 0
+    out += _varint(previous + 1)
+    for record in records:
+        sequence_number = record['sequence_number']
+        if sequence_number <= previous:
+            raise ValueError(f"Records out of order: {sequence_number} after {previous}")
+        payload = record['message'].encode('utf-8')
+        out += _varint(sequence_number - previous - 1)
+        out += _varint(len(payload))
+        out += payload
+        previous = sequence_number
+    return bytes(out)
+
+
+def decode_records(data):
+    """
+    Parse a framed batch back into [{'sequence_number': ..., 'message': ...}, ...].
+
+    Raises:
+        ValueError: If the batch is truncated, has trailing bytes or a payload is not UTF-8.
+    """
+    count, position = _read_varint(data, 0)
+    first, position = _read_varint(data, position)
+    previous = first - 1
+    size = len(data)
+    records = []
+    try:
+        for _ in range(count):
+            # Gaps and most lengths fit in one byte, the common case skips the varint loop
+            byte = data[position]
+            if byte < 0x80:
+                gap, position = byte, position + 1
+            else:
+                gap, position = _read_varint(data, position)
+            byte = data[position]
+            if byte < 0x80:
+                length, position = byte, position + 1
+            else:
+                length, position = _read_varint(data, position)
+            end = position + length
+            if end > size:
+                raise ValueError("Truncated record")
+            previous += gap + 1
+            records.append({'sequence_number': previous, 'message': data[position:end].decode('utf-8')})
+            position = end
+    except IndexError:
+        raise ValueError("Truncated record")
+    if position != size:
+        raise ValueError("Trailing bytes after the last record")
+    return records
+
+
+def encode_batch(records, compress_min_bytes=4096, compress_level=1):
+    """
+    Encode a batch for an HTTP request body.
+
+    Returns:
+        tuple: (body, headers)
+    """
+    body = encode_records(records)
+    headers = {'Content-Type': MEDIA_TYPE}
+    if compress_min_bytes and len(body) >= compress_min_bytes:
+        body = zlib.compress(body, compress_level)
+        headers['Content-Encoding'] = COMPRESSED_ENCODING
+    return body, headers
+
+
+def decode_batch(body, content_encoding=None):
+    """
+    Decode an HTTP request body made by encode_batch().
+
+    Raises:
+        ValueError: If the body is not a valid batch (zlib.error included).
+    """
+    if content_encoding == COMPRESSED_ENCODING:
+        try:
+            body = zlib.decompress(body)
+        except zlib.error as e:
+            raise ValueError(f"Invalid compressed batch: {e}")
+    elif content_encoding:
+        raise ValueError(f"Unsupported Content-Encoding: {content_encoding}")
+    return decode_records(body)
+
+
+class BatchPoster:
+    """
+    Posts replication batches to `/replicate_batch` of the secondaries, in the binary format if they accept it.
+
+    A secondary that answers 415 (it only reads JSON) gets the same batch again as JSON right away,
+    and JSON from then on.
+
+    Args:
+        http (SessionPool): Pooled keep-alive sessions.
+        binary (bool): Use the binary format. If False, every batch is sent as JSON.
+        compress_min_bytes (int): Size of a framed batch from which it is compressed, 0 to never compress.
+        compress_level (int): zlib level, 1 is the fastest.
+    """
+
+    def __init__(self, http, binary=True, compress_min_bytes=4096, compress_level=1):
+        self.http = http
+        self.binary = binary
+        self.compress_min_bytes = compress_min_bytes
+        self.compress_level = compress_level
+        self._json_only = set()
+
+    def post_batch(self, secondary, records, headers=None, **kwargs):
+        if self.binary and secondary not in self._json_only:
+            body, batch_headers = encode_batch(records, self.compress_min_bytes, self.compress_level)
+            if headers:
+                batch_headers.update(headers)
+            response = self.http.post(secondary, '/replicate_batch', data=body, headers=batch_headers, **kwargs)
+            if response.status_code != 415:
+                return response
+            logging.warning(f"{secondary} does not accept {MEDIA_TYPE}, sending JSON from now on")
+            self._json_only.add(secondary)
+        return self.http.post(secondary, '/replicate_batch', json={'records': records}, headers=headers, **kwargs)
+
+    def format_for(self, secondary):
+        """The format batches are sent in to `secondary`: 'binary' or 'json'."""
+        return 'binary' if self.binary and secondary not in self._json_only else 'json'
@@ -0,0 +1,8 @@
+"""
+Run the tests from this folder with `python -m pytest`. The tests sit next to the modules they test
+and import them the way master.py and secondary.py do: by module name, and `common` from here.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,281 @@
+import logging
+import threading
+import time
+
+import requests
+
+from replication import REPLICATION_RETRIES
+from retry import CircuitBreaker
+from common.wire import BatchPoster
+
+
+class CatchUpStream:
+    """
+    Streams the part of the master's log a secondary has missed, in chunks, in a background thread.
+
+    The stream starts at the first sequence number the secondary is missing and reads chunks of
+    `chunk_records` records straight from the log index, sending each one to `/replicate_batch`.
+    It keeps going until it reaches the head of the log. Every ACK moves the stream to the
+    secondary's `last_applied + 1`, so the stream also follows the secondary if it turns out to be
+    further behind. If the secondary stops answering, the stream is marked 'interrupted' and keeps
+    its position, and the next /sync request resumes it.
+
+    If the secondary is missing records that were already compacted out of the log (the stream
+    starts below the first sequence number of the log), the secondary is first told to load the
+    master's latest snapshot (`/bootstrap`), and the stream continues after the snapshot.
+
+    Failures go through the secondary's circuit breaker (shared with its replication worker):
+    a failed chunk is retried once the breaker lets requests through again, and if the breaker
+    opens the stream stops at once as 'interrupted'. The replication worker takes over, and when
+    its trial request closes the breaker, a large backlog brings the stream back.
+
+    Args:
+        secondary (str): The URL of the secondary node.
+        log_store (SegmentedLog): The master's log.
+        http (SessionPool): Pooled keep-alive sessions.
+        on_ack (callable): Called as on_ack(secondary, last_applied) after every ACK.
+        start (int): First sequence number to send.
+        chunk_records (int): Records per request.
+        max_records_per_second (int): Rate cap of the stream, 0 for no cap.
+        max_attempts (int): Attempts per chunk before the stream is interrupted.
+        on_finish (callable): Called as on_finish(stream) when the stream is done or interrupted.
+        bootstrap_timeout (float): Seconds the secondary has to download and load a snapshot.
+        wire (BatchPoster): Encodes and posts the chunks, JSON if not given.
+        breaker (CircuitBreaker): Circuit breaker of the secondary. Without one, failed chunks are
+                                  retried after an exponential delay.
+    """
+
+    def __init__(self, secondary, log_store, http, on_ack, start, chunk_records=1000,
+                 max_records_per_second=0, max_attempts=5, on_finish=None, bootstrap_timeout=300, wire=None,
+                 breaker=None):
+        self.secondary = secondary
+        self.log_store = log_store
+        self.http = http
+        self.on_ack = on_ack
+        self.chunk_records = chunk_records
+        self.max_records_per_second = max_records_per_second
+        self.max_attempts = max_attempts
+        self.on_finish = on_finish
+        self.bootstrap_timeout = bootstrap_timeout
+        self.wire = wire or BatchPoster(http, binary=False)
+        self.breaker = breaker
+
+        self.start_seq = start
+        self.cursor = start
+        self.last_applied = start - 1
+        self.sent = 0
+        self.snapshot_loaded = None  # Last sequence number of the snapshot the secondary was bootstrapped from
+        self.state = 'running'
+        self.error = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._cancelled = False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"sync-{self.secondary}", daemon=True)
+        self._thread.start()
+
+    def resume(self, start):
+        """Restart an interrupted stream from `start` (the secondary's last_applied + 1)."""
+        with self._lock:
+            self.cursor = start
+            self.state = 'running'
+            self.error = None
+            self.finished_at = None
+        self.start()
+
+    def cancel(self):
+        """Stop after the chunk on the wire, the secondary left the cluster."""
+        self._cancelled = True
+
+    @property
+    def running(self):
+        return self.state == 'running'
+
+    def progress(self):
+        head = self.log_store.durable_seq
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            'secondary': self.secondary,
+            'state': self.state,
+            'start': self.start_seq,
+            'last_applied': self.last_applied,
+            'head': head,
+            'remaining': 0 if self.state == 'done' else max(0, head - self.last_applied),
+            'sent': self.sent,
+            'snapshot_loaded': self.snapshot_loaded,
+            'elapsed': round(elapsed, 3),
+            'records_per_second': round(self.sent / elapsed, 1) if elapsed else 0,
+            'max_records_per_second': self.max_records_per_second,
+            'error': self.error,
+        }
+
+    def _pace(self):
+        # Rate cap: don't send the next chunk before `sent / max_records_per_second` seconds have passed
+        if self.max_records_per_second:
+            delay = self.started_at + self.sent / self.max_records_per_second - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _run(self):
+        while True:
+            if self._cancelled:
+                self._finish('cancelled')
+                return
+            if self.cursor < self.log_store.first_seq:
+                if not self._bootstrap():
+                    self._finish('interrupted')
+                    return
+                continue
+
+            records = self.log_store.read_range(self.cursor, self.log_store.durable_seq + 1, limit=self.chunk_records)
+            if not records:
+                self._finish('done')
+                return
+
+            self._pace()
+            ack = self._post('/replicate_batch', lambda: self.wire.post_batch(self.secondary, records))
+            if ack is None:
+                self._finish('interrupted')
+                return
+
+            with self._lock:
+                self.sent += len(records)
+                self.last_applied = ack['last_applied']
+                self.cursor = self.last_applied + 1
+            self.on_ack(self.secondary, self.last_applied)
+
+    def _bootstrap(self):
+        # The secondary loads the snapshot itself, from the master, and answers with where it is now
+        logging.info(f"{self.secondary} is missing compacted records from {self.cursor}, bootstrapping it from the snapshot")
+        ack = self._post('/bootstrap', lambda: self.http.post(
+            self.secondary, '/bootstrap', timeout=(self.http.timeout[0], self.bootstrap_timeout)))
+        if ack is None:
+            return False
+        if ack.get('last_applied') is None or ack['last_applied'] + 1 < self.log_store.first_seq:
+            self.error = f"Snapshot does not reach the log (last applied: {ack.get('last_applied')})"
+            logging.error(f"Bootstrap of {self.secondary} failed: {self.error}")
+            return False
+        with self._lock:
+            self.snapshot_loaded = ack['last_applied']
+            self.last_applied = ack['last_applied']
+            self.cursor = self.last_applied + 1
+        self.on_ack(self.secondary, self.last_applied)
+        return True
+
+    def _post(self, path, send):
+        # Calls send() until it returns a 200 answer, returns its JSON body or None after max_attempts
+        for attempt in range(1, self.max_attempts + 1):
+            if self.breaker is not None:
+                # A parked retry waits for the retry wheel, an open breaker ends the stream
+                if self.breaker.state != CircuitBreaker.OPEN:
+                    self.breaker.wait_ready(self.breaker.retry_delay * self.breaker.backoff_factor ** self.max_attempts)
+                if not self.breaker.allow_request():
+                    self.error = f"Circuit breaker is {self.breaker.state}" + (f" ({self.error})" if self.error else "")
+                    break
+            try:
+                response = send()
+                if response.status_code == 200:
+                    if self.breaker is not None:
+                        self.breaker.record_success()
+                    return response.json()
+                self.error = f"Status code: {response.status_code}"
+            except (requests.RequestException, ValueError) as e:
+                self.error = str(e)
+            logging.error(f"Sync request {path} to {self.secondary} failed (attempt {attempt}): {self.error}")
+            REPLICATION_RETRIES.labels(self.secondary, 'catch_up').inc()
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            else:
+                time.sleep(min(2 ** attempt, 30))
+        return None
+
+    def _finish(self, state):
+        with self._lock:
+            self.state = state
+            self.finished_at = time.time()
+        logging.info(f"Sync of {self.secondary} {state}: {self.sent} records sent, last applied {self.last_applied}")
+        if self.on_finish:
+            self.on_finish(self)
+
+
+class CatchUpManager:
+    """
+    Keeps one catch-up stream per secondary: starts it, resumes it if it was interrupted,
+    and reports its progress.
+
+    Args:
+        log_store (SegmentedLog): The master's log.
+        http (SessionPool): Pooled keep-alive sessions.
+        on_ack (callable): Called as on_ack(secondary, last_applied) after every ACK.
+        chunk_records (int): Records per request.
+        max_records_per_second (int): Rate cap of each stream, 0 for no cap.
+        on_start (callable): Called as on_start(secondary) when a stream starts or resumes.
+        on_finish (callable): Called as on_finish(stream) when a stream is done or interrupted.
+        bootstrap_timeout (float): Seconds a secondary has to download and load a snapshot.
+        wire (BatchPoster): Encodes and posts the chunks, JSON if not given.
+        breakers (dict): Circuit breaker of every secondary, by URL.
+    """
+
+    def __init__(self, log_store, http, on_ack, chunk_records=1000, max_records_per_second=0,
+                 on_start=None, on_finish=None, bootstrap_timeout=300, wire=None, breakers=None):
+        self.log_store = log_store
+        self.http = http
+        self.on_ack = on_ack
+        self.chunk_records = chunk_records
+        self.max_records_per_second = max_records_per_second
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.bootstrap_timeout = bootstrap_timeout
+        self.wire = wire
+        self.breakers = breakers if breakers is not None else {}
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def sync(self, secondary, last_applied):
+        """
+        Make sure the secondary is being caught up from `last_applied + 1`.
+
+        Returns:
+            CatchUpStream: The new, resumed or already running stream.
+        """
+        # Not clamped to the start of the log: a stream below it bootstraps the secondary from the snapshot
+        start = last_applied + 1
+        with self._lock:
+            stream = self._streams.get(secondary)
+            if stream is not None and stream.running:
+                return stream
+            if self.on_start:
+                self.on_start(secondary)
+            if stream is not None and stream.state == 'interrupted':
+                stream.resume(start)
+                return stream
+            stream = CatchUpStream(
+                secondary, self.log_store, self.http, self.on_ack, start,
+                chunk_records=self.chunk_records,
+                max_records_per_second=self.max_records_per_second,
+                on_finish=self.on_finish,
+                bootstrap_timeout=self.bootstrap_timeout,
+                wire=self.wire,
+                breaker=self.breakers.get(secondary),
+            )
+            self._streams[secondary] = stream
+            stream.start()
+            return stream
+
+    def remove(self, secondary):
+        """Cancel and forget the stream of a secondary that left the cluster."""
+        with self._lock:
+            stream = self._streams.pop(secondary, None)
+        if stream is not None:
+            stream.cancel()
+
+    def progress(self, secondary=None):
+        with self._lock:
+            streams = dict(self._streams)
+        if secondary is not None:
+            stream = streams.get(secondary)
+            return stream.progress() if stream else None
+        return {url: stream.progress() for url, stream in streams.items()}
@@ -0,0 +1,18 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def master(tmp_path_factory):
+    # The master app with no secondaries, on a log of its own
+    data = tmp_path_factory.mktemp('master')
+    for name, value in (('WAL_DIR', data / 'wal'), ('SNAPSHOT_DIR', data / 'snapshots'),
+                        ('MEMBERS_FILE', data / 'members.json'), ('WAL_FSYNC', '0'), ('SECONDARIES', '')):
+        os.environ[name] = str(value)
+    # The secondary has a partitions module too, the master must find its own first
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.modules.pop('partitions', None)
+    return importlib.import_module('master')
@@ -0,0 +1,207 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+import requests
+
+PHI_MAX = 1000.0  # phi is capped so it stays a finite number in JSON
+
+
+class PhiAccrualDetector:
+    """
+    Phi accrual failure detector for one node (Hayashibara et al.).
+
+    Instead of a fixed healthy/unhealthy verdict, the detector learns the distribution of the
+    intervals between heartbeats (a window of the last `max_samples`) and turns the time since the
+    last heartbeat into a suspicion level: phi = -log10(P(the next heartbeat is still to come)).
+    phi = 1 means about a 10% chance of a false suspicion, phi = 8 about 1e-8. The normal
+    distribution is approximated with a logistic function, like Akka and Cassandra do.
+
+    Args:
+        threshold (float): phi from which the node is considered unavailable.
+        max_samples (int): Number of heartbeat intervals kept.
+        min_std_deviation (float): Lower bound of the standard deviation, in seconds, so very
+                                   regular heartbeats don't make phi jump on the first delay.
+        acceptable_pause (float): Seconds of extra delay that are not suspicious (a GC pause, a busy node).
+        first_interval (float): Expected heartbeat interval, used until real intervals are known.
+        now (float): time.monotonic() of the start of the detection, now by default.
+
+    Until the first heartbeat, the time is counted from the start of the detection, so a node that
+    never answers becomes suspect like one that stopped answering.
+    """
+
+    def __init__(self, threshold=8.0, max_samples=200, min_std_deviation=0.2, acceptable_pause=1.0, first_interval=1.0,
+                 now=None):
+        self.threshold = threshold
+        self.min_std_deviation = min_std_deviation
+        self.acceptable_pause = acceptable_pause
+        self._intervals = deque(maxlen=max_samples)
+        self._sum = 0.0
+        self._squares = 0.0
+        self._started = time.monotonic() if now is None else now
+        self._last = None
+        # Seed the history with the expected interval, +/- a quarter of it
+        for interval in (first_interval - first_interval / 4, first_interval + first_interval / 4):
+            self._add_interval(interval)
+
+    def _add_interval(self, interval):
+        if len(self._intervals) == self._intervals.maxlen:
+            dropped = self._intervals.popleft()
+            self._sum -= dropped
+            self._squares -= dropped * dropped
+        self._intervals.append(interval)
+        self._sum += interval
+        self._squares += interval * interval
+
+    def heartbeat(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self._last is not None:
+            self._add_interval(now - self._last)
+        self._last = now
+
+    @property
+    def mean(self):
+        return self._sum / len(self._intervals)
+
+    @property
+    def std_deviation(self):
+        variance = self._squares / len(self._intervals) - self.mean ** 2
+        return max(math.sqrt(max(variance, 0.0)), self.min_std_deviation)
+
+    def phi(self, now=None):
+        """Suspicion level of the node now."""
+        now = time.monotonic() if now is None else now
+        elapsed = now - (self._started if self._last is None else self._last)
+        mean = self.mean + self.acceptable_pause
+        y = (elapsed - mean) / self.std_deviation
+        e = math.exp(min(-y * (1.5976 + 0.070566 * y * y), 700.0))
+        if elapsed > mean:
+            p_later = e / (1.0 + e)
+        else:
+            p_later = 1.0 - 1.0 / (1.0 + e)
+        if p_later <= 0.0:
+            return PHI_MAX
+        return min(-math.log10(p_later), PHI_MAX)
+
+    def is_available(self, now=None):
+        return self.phi(now) < self.threshold
+
+    def seconds_since_heartbeat(self, now=None):
+        if self._last is None:
+            return None
+        return (time.monotonic() if now is None else now) - self._last
+
+
+class HealthMonitor:
+    """
+    Probes the secondaries' `/health` concurrently and keeps a phi accrual detector per secondary.
+
+    Every secondary has its own prober thread that sends a probe every `interval` seconds with a
+    strict timeout, so a hung secondary only delays its own status. A successful probe is a
+    heartbeat. The probes need a SessionPool of their own: behind the replication requests of a busy
+    secondary, they would wait for a connection and the secondary would look down. After every probe the availability is re-evaluated and on_change(secondary, available)
+    is called when it flips.
+
+    Args:
+        http (SessionPool): Keep-alive sessions used for the probes only.
+        interval (float): Seconds between two probes of a secondary.
+        timeout (float): Connect and read timeout of a probe, in seconds.
+        threshold (float): phi from which a secondary is considered unavailable.
+        acceptable_pause (float): Seconds of extra delay that are not suspicious.
+        on_change (callable): Called as on_change(secondary, available) when the availability changes.
+    """
+
+    def __init__(self, http, interval=1.0, timeout=0.5, threshold=8.0, acceptable_pause=1.0, on_change=None):
+        self.http = http
+        self.interval = interval
+        self.timeout = timeout
+        self.threshold = threshold
+        self.acceptable_pause = acceptable_pause
+        self.on_change = on_change
+        self._detectors = {}
+        self._available = {}
+        self._probes = {}  # secondary -> {'ok', 'rtt', 'error', 'at'} of the last probe
+        self._stopped = {}
+        self._lock = threading.Lock()
+
+    def add(self, secondary):
+        """Start probing `secondary`."""
+        with self._lock:
+            if secondary in self._detectors:
+                return
+            self._detectors[secondary] = PhiAccrualDetector(
+                threshold=self.threshold, acceptable_pause=self.acceptable_pause, first_interval=self.interval)
+            self._available[secondary] = True
+            self._probes[secondary] = None
+            self._stopped[secondary] = stopped = threading.Event()
+        threading.Thread(target=self._probe_loop, args=(secondary, stopped), name=f"probe-{secondary}", daemon=True).start()
+
+    def remove(self, secondary):
+        """Stop probing `secondary` and forget its history."""
+        with self._lock:
+            stopped = self._stopped.pop(secondary, None)
+            self._detectors.pop(secondary, None)
+            self._available.pop(secondary, None)
+            self._probes.pop(secondary, None)
+        if stopped is not None:
+            stopped.set()
+
+    def is_available(self, secondary):
+        detector = self._detectors.get(secondary)
+        return detector is None or detector.is_available()
+
+    def phi(self, secondary):
+        detector = self._detectors.get(secondary)
+        return 0.0 if detector is None else detector.phi()
+
+    def _probe_loop(self, secondary, stopped):
+        while not stopped.is_set():
+            started = time.monotonic()
+            probe = {'ok': False, 'rtt': None, 'error': None, 'at': time.time()}
+            try:
+                response = self.http.get(secondary, '/health', timeout=(self.timeout, self.timeout))
+                probe['rtt'] = round(time.monotonic() - started, 4)
+                if response.status_code == 200:
+                    probe['ok'] = True
+                else:
+                    probe['error'] = f"Status code: {response.status_code}"
+            except requests.RequestException as e:
+                probe['error'] = type(e).__name__
+
+            with self._lock:
+                detector = self._detectors.get(secondary)
+                if detector is None:
+                    return
+                if probe['ok']:
+                    detector.heartbeat()
+                self._probes[secondary] = probe
+                available = detector.is_available()
+                changed = available != self._available[secondary]
+                self._available[secondary] = available
+            if changed:
+                logging.warning(f"{secondary} is {'available again' if available else 'suspected to be down'} "
+                                f"(phi {detector.phi():.1f})")
+                if self.on_change:
+                    self.on_change(secondary, available)
+
+            stopped.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def status(self):
+        with self._lock:
+            detectors = dict(self._detectors)
+            probes = dict(self._probes)
+        status = {}
+        for secondary, detector in detectors.items():
+            since = detector.seconds_since_heartbeat()
+            status[secondary] = {
+                'phi': round(detector.phi(), 3),
+                'available': detector.is_available(),
+                'threshold': self.threshold,
+                'seconds_since_heartbeat': None if since is None else round(since, 3),
+                'mean_interval': round(detector.mean, 4),
+                'std_deviation': round(detector.std_deviation, 4),
+                'last_probe': probes.get(secondary),
+            }
+        return status
@@ -0,0 +1,92 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SessionPool:
+    """
+    Keep-alive HTTP sessions for the master-to-secondary traffic, one per secondary.
+
+    Every secondary gets its own `requests.Session` with a connection pool of `pool_size`
+    connections, so replication batches, health checks and sync requests reuse open TCP
+    connections instead of opening a new one per request. Requests that don't pass a timeout
+    get the pool's (connect, read) timeouts.
+
+    Args:
+        pool_size (int): Maximum number of connections kept open to one secondary.
+        connect_timeout (float): Seconds to wait for a TCP connection.
+        read_timeout (float): Seconds to wait for the secondary to answer.
+    """
+
+    def __init__(self, pool_size=4, connect_timeout=1.0, read_timeout=5.0):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self._sessions = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def session(self, secondary):
+        return self._open(secondary)[0]
+
+    def _open(self, secondary, count=False):
+        # The session of a secondary and its counters, created on first use. count: count a request
+        with self._lock:
+            session = self._sessions.get(secondary)
+            if session is None:
+                session = requests.Session()
+                # pool_block: with all connections busy, wait for one instead of opening a throwaway connection
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True, max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[secondary] = session
+                self._counters[secondary] = {'requests': 0, 'errors': 0}
+            counters = self._counters[secondary]
+            if count:
+                counters['requests'] += 1
+            return session, counters
+
+    def request(self, method, secondary, path, **kwargs):
+        """Send `method` to `secondary + path` over the pooled session of the secondary."""
+        # The counters are held by reference, if close() drops them meanwhile they are just not reported
+        session, counters = self._open(secondary, count=True)
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            return session.request(method, f"{secondary}{path}", **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                counters['errors'] += 1
+            raise
+
+    def close(self, secondary):
+        """Close the connections to a secondary that left the cluster."""
+        with self._lock:
+            session = self._sessions.pop(secondary, None)
+            self._counters.pop(secondary, None)
+        if session is not None:
+            session.close()
+
+    def get(self, secondary, path, **kwargs):
+        return self.request('GET', secondary, path, **kwargs)
+
+    def post(self, secondary, path, **kwargs):
+        return self.request('POST', secondary, path, **kwargs)
+
+    def stats(self):
+        """Requests, errors and connection usage of every pool, for operators."""
+        with self._lock:
+            sessions = dict(self._sessions)
+            counters = {secondary: dict(self._counters[secondary]) for secondary in sessions}
+        stats = {}
+        for secondary, session in sessions.items():
+            manager = session.get_adapter(secondary).poolmanager
+            pools = [manager.pools[key] for key in manager.pools.keys()]
+            stats[secondary] = {
+                **counters[secondary],
+                'pool_size': self.pool_size,
+                'connections_opened': sum(pool.num_connections for pool in pools),
+                'idle_connections': sum(1 for pool in pools for conn in list(pool.pool.queue) if conn is not None),
+                'connect_timeout': self.timeout[0],
+                'read_timeout': self.timeout[1],
+            }
+        return stats
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class IdempotencyKeys:
+    """
+    Outcomes of the writes sent with an Idempotency-Key, so a retried write is answered from here
+    instead of being logged a second time under a new sequence number.
+
+    Every key is stored with a fingerprint of its request, so a key sent again with a different
+    request is recognised. The cache is bounded like the payload DedupIndex: the least recently used
+    keys are evicted once there are more than `max_entries`, and keys older than `ttl` expire.
+    A retry that comes after its key was evicted is logged again.
+
+    Args:
+        max_entries (int): Maximum number of keys kept, 0 for no limit.
+        ttl (float): Seconds a key is kept, 0 to keep it until it is evicted.
+    """
+
+    PENDING = 'pending'
+    DONE = 'done'
+
+    def __init__(self, max_entries=100000, ttl=86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.replayed = 0
+        self._entries = OrderedDict()  # key -> entry, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def begin(self, key, fingerprint):
+        """
+        Claim `key` for a write.
+
+        A finished write can be claimed again if it was marked `resumable` (it was logged but its
+        write concern was not met), so a retry waits for it instead of logging it again.
+
+        Returns:
+            tuple: (entry, claimed). If claimed, the caller runs the write and must call finish() or
+                   discard(). Otherwise entry is the write that holds the key: pending, finished, or
+                   sent with another request (a different fingerprint).
+        """
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if entry['fingerprint'] != fingerprint or entry['state'] == self.PENDING or not entry.get('resumable'):
+                    if entry['state'] == self.DONE and entry['fingerprint'] == fingerprint:
+                        self.replayed += 1
+                    return entry, False
+                entry['state'] = self.PENDING
+                return entry, True
+            entry = {'fingerprint': fingerprint, 'state': self.PENDING, 'created': time.monotonic()}
+            self._entries[key] = entry
+            self._evict()
+            return entry, True
+
+    def finish(self, key, entry, **outcome):
+        """Store the outcome of a claimed write, for the retries."""
+        with self._lock:
+            entry.update(outcome, state=self.DONE)
+            self._entries[key] = entry
+
+    def discard(self, key):
+        """Release a claimed write that logged nothing, a retry runs it again."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _expired(self, entry):
+        return self.ttl and entry['created'] < time.monotonic() - self.ttl
+
+    def _evict(self):
+        if self.max_entries:
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        # Expired keys are dropped from the least recently used end, the others when they are looked up
+        while self._entries and self._expired(next(iter(self._entries.values()))):
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'replayed': self.replayed, 'max_entries': self.max_entries, 'ttl': self.ttl}
@@ -1,95 +1,830 @@
 
-from flask import Flask, request, jsonify
-import requests
+from flask import Flask, Response, request, jsonify, g
 from threading import Thread, Lock
+import hashlib
+import json
 import time
 import logging
 import threading
+import os
+import socket
+import subprocess
+import sys
+import requests
+from werkzeug.serving import make_server
+
+# The modules shared by the master and the secondaries are in the `common` package: next to this file in the
+# Docker image, one folder up in the repository
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wal import SegmentedLog
+from replication import AckTracker, SecondaryReplicator
+from http_pool import SessionPool
+from common.wire import PARTITION_HEADER, BatchPoster, is_valid_message
+from retry import CircuitBreaker, TimerWheel
+from failure_detector import HealthMonitor
+from catchup import CatchUpManager
+from common.dedup import DedupIndex
+from snapshot import SnapshotStore
+from common.read_api import range_args, not_modified, not_modified_response, stream_messages
+from common.metrics import REGISTRY, CONTENT_TYPE, Gauge, Histogram
+from common.tracing import TRACE_HEADER, Tracer
+from membership import MemberList, normalize_url
+from topology import STAR, build_tree, depth, parents
+from partitions import Partition, partition_for
+from write_group import WriteGroups
+from idempotency import IdempotencyKeys
 
 # Initialize Flask app and configure logging
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# Serving: with MASTER_WORKERS > 1 the master runs as one leader process and MASTER_WORKERS - 1 worker processes
+# that accept connections on the same port. Every process appends to the same logs on disk (see SegmentedLog's
+# `shared`), whose lock file hands out the sequence numbers. Only the leader replicates: it follows what the
+# workers append, and a worker asks it over the internal port to wait for the ACKs of a write's write concern.
+# Workers take the writes (POST /messages and /messages/bulk) and pass every other request on to the leader
+MASTER_PORT = int(os.environ.get('MASTER_PORT', 5000))
+MASTER_WORKERS = int(os.environ.get('MASTER_WORKERS', 1))  # Processes serving MASTER_PORT, 1 = the leader alone
+MASTER_INTERNAL_PORT = int(os.environ.get('MASTER_INTERNAL_PORT', MASTER_PORT + 1000))  # Leader, on the loopback only
+LEADER_URL = f"http://127.0.0.1:{MASTER_INTERNAL_PORT}"
+IS_WORKER = os.environ.get('MASTER_ROLE') == 'worker'  # Set by the leader for the processes it starts
+SHARED_LOG = MASTER_WORKERS > 1
+SHARED_LOG_POLL_INTERVAL = 0.005  # Seconds between the leader's checks for records the workers appended
+LEADER_POOL_SIZE = int(os.environ.get('LEADER_POOL_SIZE', 64))  # Connections from a worker to the leader
+
+# Write-ahead log settings
+WAL_DIR = os.environ.get('WAL_DIR', 'data/wal')
+WAL_SEGMENT_BYTES = int(os.environ.get('WAL_SEGMENT_BYTES', 64 * 1024 * 1024))
+WAL_FSYNC = os.environ.get('WAL_FSYNC', '1') == '1'
+
 # Global variables
-next_seq_num = 0
-full_log = []
-log = []
-secondaries = ["http://secondary1:5001", "http://secondary2:5002"]
-seq_num_lock = Lock()
+# The full log lives on disk, so after a restart both the log and the sequence counter are recovered
+full_log = SegmentedLog(WAL_DIR, segment_bytes=WAL_SEGMENT_BYTES, fsync=WAL_FSYNC, shared=SHARED_LOG)
+
+# Cluster membership: secondaries announce themselves at startup (POST /members) and leave with DELETE /members.
+# The member list is kept in MEMBERS_FILE. SECONDARIES (comma-separated base URLs) only seeds it on the first start
+MEMBERS_FILE = os.environ.get('MEMBERS_FILE', 'data/members.json')
+SECONDARIES = [url for url in os.environ.get('SECONDARIES', '').split(',') if url]
+members = MemberList(MEMBERS_FILE, seeds=SECONDARIES)
+membership_lock = Lock()  # One join or leave at a time
+
+# Snapshots: a compressed image of the log up to a sequence number, used to bootstrap secondaries
+# and to truncate the prefix of the log it covers
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', 'data/snapshots')
+SNAPSHOT_INTERVAL_RECORDS = int(os.environ.get('SNAPSHOT_INTERVAL_RECORDS', 100000))  # 0 = only on POST /snapshot
+SNAPSHOT_RETAIN_RECORDS = int(os.environ.get('SNAPSHOT_RETAIN_RECORDS', 10000))  # Kept in the log behind a snapshot
+SNAPSHOT_KEEP = int(os.environ.get('SNAPSHOT_KEEP', 2))
+SNAPSHOT_BOOTSTRAP_TIMEOUT = float(os.environ.get('SNAPSHOT_BOOTSTRAP_TIMEOUT', 300))  # Seconds a secondary has to load one
+SNAPSHOT_CHECK_INTERVAL = 10  # Seconds between checks whether a new snapshot is due
+snapshots = SnapshotStore(SNAPSHOT_DIR, full_log, keep=SNAPSHOT_KEEP)
+
+# Deduplication: sequence numbers are unique by construction (the log index), payloads are optionally
+# checked against a content-hash index so the check costs the same however long the log is
+DEDUP_PAYLOADS = os.environ.get('DEDUP_PAYLOADS', '0') == '1'  # Reject messages whose payload is already logged
+DEDUP_MAX_ENTRIES = int(os.environ.get('DEDUP_MAX_ENTRIES', 1000000))  # 0 = remember every payload
+DEDUP_TTL = float(os.environ.get('DEDUP_TTL', 0))  # Seconds, 0 = no expiry
+payload_index = DedupIndex(max_entries=DEDUP_MAX_ENTRIES, ttl=DEDUP_TTL)
+if DEDUP_PAYLOADS:
+    # Rebuild the index from the newest records of the log after a restart
+    start = full_log.next_seq - DEDUP_MAX_ENTRIES if DEDUP_MAX_ENTRIES else full_log.first_seq
+    for record in full_log.iter_range(start):
+        payload_index.add(record['sequence_number'], record['message'])
+payloads_indexed_to = full_log.next_seq  # Records of the shared log after it were appended by other processes
+
+# Idempotency keys: a write sent with an Idempotency-Key header is logged once, retries with the same key get
+# its outcome back (or wait again for its write concern) instead of logging it again under a new sequence number
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', 100000))  # 0 = remember every key
+IDEMPOTENCY_TTL = float(os.environ.get('IDEMPOTENCY_TTL', 86400))  # Seconds, 0 = no expiry
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+idempotency_keys = IdempotencyKeys(max_entries=IDEMPOTENCY_MAX_KEYS, ttl=IDEMPOTENCY_TTL)
 
 backoff_factor = 2 
 
-## Version-3: Replication with Threads
+# Batched replication settings
+REPLICATION_BATCH_RECORDS = int(os.environ.get('REPLICATION_BATCH_RECORDS', 256))
+REPLICATION_BATCH_BYTES = int(os.environ.get('REPLICATION_BATCH_BYTES', 256 * 1024))
+REPLICATION_BATCH_DELAY_MS = int(os.environ.get('REPLICATION_BATCH_DELAY_MS', 5))
+REPLICATION_WINDOW = int(os.environ.get('REPLICATION_WINDOW', 1024))  # Records on the wire per secondary
+REPLICATION_MAX_IN_FLIGHT = int(os.environ.get('REPLICATION_MAX_IN_FLIGHT', 2))  # Sender threads per secondary
+REPLICATION_MAX_BACKOFF = int(os.environ.get('REPLICATION_MAX_BACKOFF', 30))  # Longest time a breaker stays open
 
-def replicate_to_secondary(secondary, seq_message, acks, write_concern):
-    # It doesn't matter if the replication fails, the message will still be logged in the master
-    # The ACKs are used to determine if the write concern is satisfied
-    for i in range(10): # Try 10 times
-        try:
-            response = requests.post(f"{secondary}/replicate", json=seq_message)
-            if response.status_code == 200:
-                acks.append(secondary)
-            
-            else:
-                app.logger.error(f"Replication failed for {secondary}. Status code: {response.status_code}, Response: {response.text}")
-        except Exception as e:
-            logging.error(f"Error replicating to {secondary}: {e}")
+# Replication topology: 'star' (the master sends every batch to every secondary), 'chain' or 'tree'
+# (the master sends to the first secondaries only, they forward downstream and report the ACKs back up)
+REPLICATION_TOPOLOGY = os.environ.get('REPLICATION_TOPOLOGY', STAR)
+REPLICATION_FANOUT = int(os.environ.get('REPLICATION_FANOUT', 2))  # Children per node in a tree
+TOPOLOGY_CHECK_INTERVAL = 2  # Seconds between checks for secondaries that stopped getting records down the tree
+topology = build_tree([], REPLICATION_TOPOLOGY, REPLICATION_FANOUT)  # See rebuild_topology()
+topology_changed = threading.Event()
+topology_pushed = {}  # Secondary -> (parent, children) it was last told
+
+# Circuit breaker per secondary, all retries are parked on one timer wheel
+REPLICATION_FAILURE_THRESHOLD = int(os.environ.get('REPLICATION_FAILURE_THRESHOLD', 3))  # Failures in a row that open it
+REPLICATION_RETRY_DELAY_MS = int(os.environ.get('REPLICATION_RETRY_DELAY_MS', 100))  # First retry of a failed batch
+REPLICATION_OPEN_TIMEOUT = float(os.environ.get('REPLICATION_OPEN_TIMEOUT', 1))  # Seconds before the first trial request
+retry_wheel = TimerWheel()
+breakers = {}  # Secondary -> CircuitBreaker, see add_secondary()
+
+# Keep-alive connections to the secondaries
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', REPLICATION_MAX_IN_FLIGHT + 2))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 1))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 5))
+http_pool = SessionPool(pool_size=HTTP_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT)
+# A worker's connections to the leader. Writes wait on them for their write concern, so there are many and no read timeout
+leader_pool = SessionPool(pool_size=LEADER_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=None)
+
+# Wire format of replication batches: binary framing (JSON for secondaries that answer 415), zlib for big batches
+REPLICATION_WIRE_FORMAT = os.environ.get('REPLICATION_WIRE_FORMAT', 'binary')  # 'binary' or 'json'
+REPLICATION_COMPRESS_MIN_BYTES = int(os.environ.get('REPLICATION_COMPRESS_MIN_BYTES', 4096))  # 0 = never compress
+wire = BatchPoster(http_pool, binary=REPLICATION_WIRE_FORMAT == 'binary', compress_min_bytes=REPLICATION_COMPRESS_MIN_BYTES)
+
+# Write concern: w=1 is the master alone, every further ACK comes from a secondary
+WRITE_CONCERN_TIMEOUT = float(os.environ.get('WRITE_CONCERN_TIMEOUT', 10))  # Default deadline in seconds
+ack_tracker = AckTracker()
 
+# Partitioned log: with PARTITIONS > 1, POST /messages hashes the message's `key` to a partition. Every partition
+# has its own sequence numbers, log (WAL_DIR-p<n>) and replication workers, so writes to different partitions
+# don't serialize on one lock and one fsync. Partition 0 is full_log: messages without a key go there, and
+# snapshots, catch-up streams, the chain/tree topology and payload deduplication only cover it.
+# Changing PARTITIONS moves keys to other partitions
+PARTITIONS = int(os.environ.get('PARTITIONS', 1))
+partitions = [Partition(0, full_log, ack_tracker)] + [
+    Partition(index, SegmentedLog(f"{WAL_DIR}-p{index}", segment_bytes=WAL_SEGMENT_BYTES, fsync=WAL_FSYNC, shared=SHARED_LOG))
+    for index in range(1, PARTITIONS)
+]
 
+# Group commit: the client writes that arrive at a partition together are logged together and reach the replication
+# workers as one contiguous range, so they go out in one replication batch instead of a round each. A group is
+# capped at one batch (REPLICATION_BATCH_RECORDS, REPLICATION_BATCH_BYTES)
+WRITE_GROUP_WINDOW_MS = float(os.environ.get('WRITE_GROUP_WINDOW_MS', 0))  # Wait for more writes, 0 = take the queued ones
+BULK_MAX_RECORDS = int(os.environ.get('BULK_MAX_RECORDS', 10000))  # Messages per POST /messages/bulk
+write_groups = [WriteGroups(
+    lambda writes, partition=partition: commit_group(partition, writes),
+    window=WRITE_GROUP_WINDOW_MS / 1000,
+    max_records=REPLICATION_BATCH_RECORDS,
+    max_bytes=REPLICATION_BATCH_BYTES,
+) for partition in partitions]
 
-def wait_for_acks(acks, required_acks):
-    # Wait until the required number of ACKs are received or a timeout occurs
-    start_time = time.time()
-    while len(acks) < required_acks and (time.time() - start_time) < 10:
-        time.sleep(0.1)  
-        
-    return len(acks) >= required_acks
+# Latency histograms of the write path, exported on /metrics
+POST_MESSAGE_SECONDS = Histogram('replog_post_message_seconds', 'Latency of POST /messages.', ['w', 'code'])
+WAL_WAIT_SECONDS = Histogram('replog_wal_wait_seconds', 'Time a write waits for the fsync of the log.')
+ACK_WAIT_SECONDS = Histogram('replog_ack_wait_seconds', 'Time a write waits for the ACKs of its write concern.', ['w'])
+POST_BULK_SECONDS = Histogram('replog_post_bulk_seconds', 'Latency of POST /messages/bulk.', ['w', 'code'])
+WRITE_GROUP_RECORDS = Histogram('replog_write_group_records', 'Records logged and replicated together as one group.',
+                                buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384))
+
+# Tracing of the write path: a sample of the writes (and every write sent with an X-Trace-Id header)
+# gets spans for each step, kept in a ring buffer and served on /debug/traces
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))  # 0 = only writes with the header
+TRACE_BUFFER_SPANS = int(os.environ.get('TRACE_BUFFER_SPANS', 10000))
+tracer = Tracer('master', sample_rate=TRACE_SAMPLE_RATE, max_spans=TRACE_BUFFER_SPANS)
+
+# Catch-up streams for secondaries that are far behind
+SYNC_CHUNK_RECORDS = int(os.environ.get('SYNC_CHUNK_RECORDS', 1000))
+SYNC_MAX_RECORDS_PER_SEC = int(os.environ.get('SYNC_MAX_RECORDS_PER_SEC', 50000))  # 0 = no cap
+SYNC_THRESHOLD = int(os.environ.get('SYNC_THRESHOLD', 10000))  # Missing records from which a stream is used
+
+# One long-lived replication worker per secondary the master sends to, fed from the log (see rebuild_topology()).
+# The dict is replaced, never changed in place, so the write path iterates it without a lock
+replicators = {}
+
+
+def on_ack(secondary, last_applied):
+    # A batch that was on the wire when its secondary left the cluster doesn't count any more.
+    # In a chain or tree, the ACKs of the secondaries further down come in on /acks
+    if secondary in members:
+        ack_tracker.ack(secondary, last_applied)
+
+
+def on_sync_start(secondary):
+    # The stream sends the missed range, the replication worker waits until it is done
+    if secondary in replicators:
+        replicators[secondary].pause()
+
+
+def on_sync_finish(stream):
+    if stream.secondary in replicators:
+        replicators[stream.secondary].resume(stream.last_applied, reachable=stream.state == 'done')
+
+
+catch_up = CatchUpManager(
+    full_log,
+    http_pool,
+    on_ack,
+    chunk_records=SYNC_CHUNK_RECORDS,
+    max_records_per_second=SYNC_MAX_RECORDS_PER_SEC,
+    on_start=on_sync_start,
+    on_finish=on_sync_finish,
+    bootstrap_timeout=SNAPSHOT_BOOTSTRAP_TIMEOUT,
+    wire=wire,
+    breakers=breakers,
+)
 
 
 @app.route('/messages', methods=['POST'])
 def post_message():
-    global next_seq_num
-    try:
-        message = request.json['message']
-        write_concern = int(request.json.get('w', 1))
-
-        with seq_num_lock:
-            seq_message = {'sequence_number': next_seq_num, 'message': message}
-            next_seq_num += 1
-
-        full_log.append(seq_message) # Log the message in the master
-
-        if seq_message not in log: # Deduplication 
-            log.append(seq_message)
-
-        acks = []
-        threads = []
-        for secondary in secondaries:
-            # Start a thread for each secondary
-            thread = Thread(target=replicate_to_secondary, args=(secondary, seq_message, acks, write_concern))
-            # Make the thread daemon so that it doesn't block the main thread
-            thread.start()
-            # Keep track of the threads
-            threads.append(thread)
-        
-        # Wait for the threads to finish
-        success = wait_for_acks(acks, write_concern)
-        
-        # Wait for the threads to finish and then continue. Joining the threads blocks the main thread until the threads finish.
-        for thread in threads:
-            thread.join()
+    # Latency of every write, by write concern and status code
+    started = time.perf_counter()
+    g.trace_id = tracer.sample(request.headers.get(TRACE_HEADER))
+    with tracer.span(g.trace_id, 'post_message') as span:
+        response, status_code = idempotent(append_message)
+        span.set(w=g.get('w'), status=status_code, sequence_number=g.get('sequence_number'))
+    POST_MESSAGE_SECONDS.labels(g.get('w', 'invalid'), str(status_code)).observe(time.perf_counter() - started)
+    if g.trace_id:
+        response.headers[TRACE_HEADER] = g.trace_id
+    return response, status_code
+
 
+def write_concern_args(source):
+    """
+    The write concern and its timeout of a write, from its JSON body or its query string.
+
+    Returns:
+        tuple: (w, timeout in seconds)
+
+    Raises:
+        ValueError: If w is not an integer or the timeout not a number.
+    """
+    try:
+        write_concern = source.get('w', 1)
+        if isinstance(write_concern, (bool, float)):
+            raise ValueError
+        write_concern = int(write_concern)
+    except (TypeError, ValueError):
+        raise ValueError('w must be an integer')
+    try:
+        timeout = source.get('timeout', WRITE_CONCERN_TIMEOUT)
+        if isinstance(timeout, bool):
+            raise ValueError
+        timeout = float(timeout)
+    except (TypeError, ValueError):
+        raise ValueError('timeout must be a number of seconds')
+    return write_concern, timeout
+
+
+def write_concern_label(write_concern):
+    # Any w a client sends would be a new series, the ones larger than the cluster are counted together
+    return str(write_concern) if 1 <= write_concern <= len(members) + 1 else 'other'
+
+
+def partition_replicators(partition):
+    # The replication workers of a partition, partition 0 has the master's (see rebuild_topology())
+    return replicators if partition.index == 0 else partition.replicators
+
+
+def append_message():
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or 'message' not in payload:
+        return jsonify({'status': 'error', 'message': 'The body must be a JSON object with a message'}), 400
+    message = payload['message']
+    # Checked like the secondaries check the records, a message they refuse would stall replication
+    if not is_valid_message(message):
+        return jsonify({'status': 'error', 'message': 'Invalid message format: message must be a non-empty UTF-8 string'}), 400
+    key = payload.get('key')
+    if key is not None and not isinstance(key, str):
+        return jsonify({'status': 'error', 'message': 'key must be a string'}), 400
+    try:
+        # Optional per-request deadline for the write concern, in seconds
+        write_concern, timeout = write_concern_args(payload)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    try:
+        partition = partitions[partition_for(key, PARTITIONS) if key is not None and PARTITIONS > 1 else 0]
+        g.w = write_concern_label(write_concern)
+        g.write_concern, g.timeout = write_concern, timeout
+
+        # Logged with the writes that arrive at the same time, see commit_group()
+        trace_id = g.trace_id
+        with tracer.span(trace_id, 'write_group') as span:
+            logged = write_groups[partition.index].submit(
+                {'messages': [message], 'write_concern': write_concern, 'trace_id': trace_id}, len(message))
+            span.set(records=logged['group'])
+        if logged['duplicates']:
+            return jsonify({'status': 'duplicate', 'message': 'Message is already in the log', 'sequence_number': logged['duplicates'][0][1]}), 409
+        sequence_number = logged['sequence_number']
+        waiter = logged['waiter']
+        g.sequence_number = sequence_number
+
+        # Group commit: concurrent writes share one fsync
+        with WAL_WAIT_SECONDS.time(), tracer.span(trace_id, 'fsync_wait'):
+            partition.log.wait_durable(sequence_number)
+
+        # Woken up as soon as the (w-1)-th secondary has applied the message
+        with ACK_WAIT_SECONDS.labels(g.w).time(), tracer.span(trace_id, 'ack_wait', required=write_concern - 1) as span:
+            if IS_WORKER:
+                success, acked_by = wait_on_leader(partition, sequence_number, write_concern, timeout)
+            else:
+                # Wake the replication workers, they pick the whole group up from the log
+                for replicator in partition_replicators(partition).values():
+                    replicator.notify()
+                success = partition.ack_tracker.wait(sequence_number, waiter, timeout)
+                acked_by = sorted(waiter.secondaries)
+            span.set(satisfied=success, acked_by=acked_by)
+
+        placement = {'partition': partition.index, 'sequence_number': sequence_number}
         if success:
-            return jsonify({'status': 'success', 'message': 'Message replicated with required write concern'}), 200
+            return jsonify({'status': 'success', 'message': 'Message replicated with required write concern', **placement}), 200
         else:
-            return jsonify({'status': 'error', 'message': 'Write concern not satisfied'}), 500
+            return jsonify({'status': 'error', 'message': 'Write concern not satisfied', **placement}), 500
 
+    except WriteFailed as e:
+        return jsonify({'status': 'error', 'message': str(e), **failed_placement(partition, e)}), 500
     except Exception as e:
         logging.error(f"An error occurred: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
+def idempotent(write):
+    """
+    Run a write (append_message or append_block) once per Idempotency-Key.
+
+    Without the header the write just runs. The first request with a key runs it, and its outcome is
+    kept once it logged something. A retry with the same key and request gets that outcome back with an
+    Idempotent-Replayed header: nothing is appended or replicated again. If the write was logged but its
+    write concern was not met in time, the retry waits for the write concern of the logged sequence
+    numbers once more. A retry while the write still runs gets 409, the key with another request 422.
+
+    Returns:
+        tuple: (response, status code)
+    """
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if key is None:
+        return write()
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        return jsonify({'status': 'error', 'message': f"{IDEMPOTENCY_HEADER} must have 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters"}), 400
+    fingerprint = hashlib.blake2b(f"{request.path}?{request.query_string.decode('latin-1')}".encode('utf-8'), digest_size=16)
+    fingerprint.update(request.get_data())
+    entry, claimed = idempotency_keys.begin(key, fingerprint.hexdigest())
+
+    if not claimed:
+        if entry['fingerprint'] != fingerprint.hexdigest():
+            return jsonify({'status': 'error', 'message': f"{IDEMPOTENCY_HEADER} was already used with another request"}), 422
+        if entry['state'] == IdempotencyKeys.PENDING:
+            return jsonify({'status': 'error', 'message': f"A request with this {IDEMPOTENCY_HEADER} is in progress"}), 409
+        return replay(entry)
+
+    if 'status_code' in entry:
+        return resume_write_concern(key, entry)
+
+    response, status_code = write()
+    body = response.get_json(silent=True) or {}
+    logged = g.get('sequence_number') is not None  # Set as soon as anything of the write is in the log
+    if logged or body.get('status') == 'duplicate':
+        if logged and 'sequence_number' not in body and 'first_sequence_number' not in body:
+            # It failed after it was logged: the retries get where it is instead of logging it again
+            body = {**body, 'sequence_number': g.sequence_number}
+            response = jsonify(body)
+        idempotency_keys.finish(
+            key, entry, status_code=status_code, body=body, w=g.get('write_concern'), timeout=g.get('timeout'),
+            resumable=status_code == 500 and body.get('message') == 'Write concern not satisfied')
+    else:
+        idempotency_keys.discard(key)  # Nothing was logged, a retry runs the write again
+    return response, status_code
+
+
+def replay(entry):
+    # The stored outcome of a write, for a retry
+    if entry.get('w') is not None:
+        g.w = write_concern_label(entry['w'])
+    g.sequence_number = entry['body'].get('sequence_number', entry['body'].get('first_sequence_number'))
+    response = jsonify(entry['body'])
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response, entry['status_code']
+
+
+def resume_write_concern(key, entry):
+    # A retry of a write that was logged but didn't meet its write concern: wait for the ACKs of the same sequence numbers
+    body = entry['body']
+    partition = partitions[body['partition']]
+    last_seq = body.get('last_sequence_number', body.get('sequence_number'))
+    write_concern = entry['w']
+    g.w = write_concern_label(write_concern)
+    g.sequence_number = body.get('sequence_number', body.get('first_sequence_number'))
+    with ACK_WAIT_SECONDS.labels(g.w).time(), tracer.span(g.trace_id, 'ack_wait', required=write_concern - 1, resumed=True) as span:
+        # Registered late: the tracker counts the ACKs that already cover the sequence numbers
+        waiter = partition.ack_tracker.register(last_seq, write_concern - 1)
+        success = partition.ack_tracker.wait(last_seq, waiter, entry['timeout'])
+        span.set(satisfied=success, acked_by=sorted(waiter.secondaries))
+    if success:
+        entry['body'] = {**body, 'status': 'success', 'message': 'Replicated with required write concern'}
+        entry['status_code'] = 200
+    idempotency_keys.finish(key, entry, resumable=not success)
+    return replay(entry)
+
+
+@app.route('/messages/bulk', methods=['POST'])
+def post_messages_bulk():
+    """
+    Append a block of messages under one write concern: they get a contiguous range of sequence numbers
+    in one partition, are replicated together and the response comes once the whole block is acknowledged.
+    Body: a JSON array of strings, or (Content-Type: application/x-ndjson) one JSON string per line.
+    Query: ?w=<write concern>&timeout=<seconds>&key=<partition key>, all optional.
+    """
+    started = time.perf_counter()
+    g.trace_id = tracer.sample(request.headers.get(TRACE_HEADER))
+    with tracer.span(g.trace_id, 'post_messages_bulk') as span:
+        response, status_code = idempotent(append_block)
+        span.set(w=g.get('w'), status=status_code, records=g.get('records'), sequence_number=g.get('sequence_number'))
+    POST_BULK_SECONDS.labels(g.get('w', 'invalid'), str(status_code)).observe(time.perf_counter() - started)
+    if g.trace_id:
+        response.headers[TRACE_HEADER] = g.trace_id
+    return response, status_code
+
+
+class InvalidBulkMessage(ValueError):
+    def __init__(self, index):
+        super().__init__(f"Invalid message format at index {index}: every message must be a non-empty UTF-8 string")
+        self.index = index
+
+
+def bulk_messages():
+    # The messages of a bulk write, ValueError if the body is not a JSON array or NDJSON of non-empty UTF-8 strings
+    body = request.get_data(as_text=True)
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        messages = [json.loads(line) for line in body.splitlines() if line.strip()]
+    else:
+        messages = json.loads(body)
+        if not isinstance(messages, list):
+            raise ValueError('The body must be a JSON array of messages')
+    for index, message in enumerate(messages):
+        # Checked like the secondaries check the records, one they refuse would stall replication
+        if not is_valid_message(message):
+            raise InvalidBulkMessage(index)
+    return messages
+
+
+def append_block():
+    try:
+        messages = bulk_messages()
+    except InvalidBulkMessage as e:
+        return jsonify({'status': 'error', 'message': str(e), 'index': e.index}), 400
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    try:
+        key = request.args.get('key')
+        partition = partitions[partition_for(key, PARTITIONS) if key is not None and PARTITIONS > 1 else 0]
+        write_concern, timeout = write_concern_args(request.args)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if not messages:
+        return jsonify({'status': 'error', 'message': 'No messages'}), 400
+    if len(messages) > BULK_MAX_RECORDS:
+        return jsonify({'status': 'error', 'message': f"At most {BULK_MAX_RECORDS} messages per request"}), 413
+    g.w = write_concern_label(write_concern)
+    g.write_concern, g.timeout = write_concern, timeout
+    g.records = len(messages)
+
+    try:
+        # A block is one write of a group, so nothing else lands in the middle of its range
+        trace_id = g.trace_id
+        with tracer.span(trace_id, 'write_group') as span:
+            logged = write_groups[partition.index].submit(
+                {'messages': messages, 'write_concern': write_concern, 'trace_id': trace_id},
+                sum(len(message) for message in messages), len(messages))
+            span.set(records=logged['group'])
+        if logged['duplicates']:
+            return jsonify({'status': 'duplicate', 'message': 'Messages are already in the log, nothing was logged',
+                            'duplicates': logged['duplicates']}), 409
+        first_seq = logged['sequence_number']
+        last_seq = logged['last_seq']
+        g.sequence_number = first_seq
+
+        with WAL_WAIT_SECONDS.time(), tracer.span(trace_id, 'fsync_wait'):
+            partition.log.wait_durable(last_seq)
+
+        # One wait for the whole block: the write concern is met once the (w-1)-th secondary has applied its last message
+        with ACK_WAIT_SECONDS.labels(g.w).time(), tracer.span(trace_id, 'ack_wait', required=write_concern - 1) as span:
+            if IS_WORKER:
+                success, acked_by = wait_on_leader(partition, last_seq, write_concern, timeout)
+            else:
+                for replicator in partition_replicators(partition).values():
+                    replicator.notify()
+                success = partition.ack_tracker.wait(last_seq, logged['waiter'], timeout)
+                acked_by = sorted(logged['waiter'].secondaries)
+            span.set(satisfied=success, acked_by=acked_by)
+
+        placement = {'partition': partition.index, 'first_sequence_number': first_seq, 'last_sequence_number': last_seq,
+                     'count': len(messages)}
+        if success:
+            return jsonify({'status': 'success', 'message': 'Messages replicated with required write concern', **placement}), 200
+        else:
+            return jsonify({'status': 'error', 'message': 'Write concern not satisfied', **placement}), 500
+
+    except WriteFailed as e:
+        return jsonify({'status': 'error', 'message': str(e), **failed_placement(partition, e, block=True)}), 500
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+class WriteFailed(Exception):
+    """A write of a group that could not be logged, or only its messages from sequence_number to last_seq."""
+
+    def __init__(self, error, sequence_number=None, last_seq=None):
+        super().__init__(f"The write could not be logged: {error}")
+        self.sequence_number = sequence_number
+        self.last_seq = last_seq
+
+
+def commit_group(partition, writes):
+    """
+    Log a group of concurrent writes to a partition (see WriteGroups). A write is one message or a bulk block.
+
+    The sequence numbers are assigned and appended under the partition's lock (and, with several processes,
+    the lock file of the log), so the log stays in order and the group, and every block in it, gets a contiguous
+    range. Each write is registered with the tracker once it is appended (by its last sequence number; ACKs
+    are cumulative and the tracker counts the ones that came first). With payload deduplication, a write
+    with a payload that is already in the log is not logged at all. A write that fails gets a WriteFailed of
+    its own, the others of the group are logged as usual. The log is held
+    for the whole group, so the group becomes durable with one fsync and the replication workers find all of it
+    at once and send it as one batch. The next group is appended while this one waits for the fsync.
+
+    Args:
+        partition (Partition): The partition the writes go to.
+        writes (list): {'messages', 'write_concern', 'trace_id'} of every write, in arrival order.
+
+    Returns:
+        list: {'sequence_number', 'last_seq', 'waiter', 'duplicates', 'group'} of every write, where
+              sequence_number is the first one of the write and duplicates the [index, sequence number]
+              of its messages that were already logged, or the WriteFailed of a write that failed.
+    """
+    global payloads_indexed_to
+    results = []
+    dedup = DEDUP_PAYLOADS and partition.index == 0
+    lock_requested = time.time()
+    with partition.lock, partition.log.appending():
+        locked = time.time()
+        if dedup and SHARED_LOG:
+            index_new_payloads()
+        for write in writes:
+            tracer.record(write['trace_id'], 'lock_wait', lock_requested, locked)
+            result = {'sequence_number': None, 'last_seq': None, 'waiter': None, 'duplicates': [], 'group': len(writes)}
+            results.append(result)
+            messages = write['messages']
+            first_seq = partition.log.next_seq
+            last_seq = first_seq + len(messages) - 1
+            if dedup:
+                for index, message in enumerate(messages):
+                    duplicate_of = payload_index.lookup(message)
+                    if duplicate_of is not None:
+                        result['duplicates'].append([index, duplicate_of])
+                if result['duplicates']:
+                    continue
+
+            appended = None
+            try:
+                for sequence_number, message in enumerate(messages, first_seq):
+                    partition.log.append({'sequence_number': sequence_number, 'message': message})  # Log the message in the master
+                    appended = sequence_number
+                    if dedup:
+                        payload_index.add(sequence_number, message)
+                    if partition.index == 0:
+                        tracer.link(sequence_number, write['trace_id'])  # The replication batch that carries it records a span too
+            except Exception as e:
+                logging.error(f"Logging a write of {len(messages)} messages from sequence {first_seq} failed: {e}")
+                results[-1] = WriteFailed(e, None if appended is None else first_seq, appended)
+                continue
+            if not IS_WORKER:
+                result['waiter'] = partition.ack_tracker.register(last_seq, write['write_concern'] - 1)
+            result['sequence_number'] = first_seq
+            result['last_seq'] = last_seq
+        if dedup:
+            payloads_indexed_to = partition.log.next_seq
+    WRITE_GROUP_RECORDS.observe(sum(len(write['messages']) for write in writes))
+    return results
+
+
+def failed_placement(partition, failed, block=False):
+    # Where the messages of a failed write that did get logged are: they are replicated like any other
+    if failed.sequence_number is None:
+        return {}
+    g.sequence_number = failed.sequence_number
+    if block:
+        return {'partition': partition.index, 'first_sequence_number': failed.sequence_number,
+                'last_sequence_number': failed.last_seq, 'count': failed.last_seq - failed.sequence_number + 1}
+    return {'partition': partition.index, 'sequence_number': failed.sequence_number}
+
+
+def index_new_payloads():
+    # Payloads other processes appended to the shared log since this one last looked. Call in full_log.appending()
+    global payloads_indexed_to
+    for record in full_log.iter_range(max(payloads_indexed_to, full_log.first_seq)):
+        payload_index.add(record['sequence_number'], record['message'])
+    payloads_indexed_to = full_log.next_seq
+
+
+def wait_on_leader(partition, sequence_number, write_concern, timeout):
+    """
+    In a worker: the leader replicates the logs, so the leader waits for the ACKs of the write concern.
+
+    Returns:
+        tuple: (write concern satisfied, secondaries that acknowledged the message)
+    """
+    if write_concern <= 1:
+        return True, []  # The leader finds the message in the log on its own
+    try:
+        response = leader_pool.post(LEADER_URL, '/internal/appended', json={
+            'partition': partition.index, 'sequence_number': sequence_number, 'w': write_concern, 'timeout': timeout,
+        }, timeout=(HTTP_CONNECT_TIMEOUT, timeout + HTTP_READ_TIMEOUT))
+        if response.status_code == 200:
+            result = response.json()
+            return result['satisfied'], result['acked_by']
+        logging.warning(f"Leader did not wait for the write concern of {sequence_number}. Status code: {response.status_code}")
+    except requests.RequestException as e:
+        logging.warning(f"Leader did not wait for the write concern of {sequence_number}: {e}")
+    return False, []
+
+
+@app.route('/messages', methods=['GET'])
+def get_messages():
+    """
+    Read the log, or a range of it, by sequence number, straight from the write-ahead log.
+    Query: ?since=<first seq>&until=<first seq not returned>&limit=<max messages>&partition=<n>, all optional.
+
+    Only durable messages are returned (the high watermark is the last fsynced sequence number).
+    The response is streamed as chunked JSON, reading the log a chunk at a time, and carries
+    `next_since` for the next incremental read. A poll that sends back the ETag it got
+    gets 304 Not Modified until a new message is durable. A `since` below the start of the
+    compacted log gets 410 Gone: those messages are only in the snapshot.
+    """
+    try:
+        since, until, limit = range_args()
+        log_store = requested_partition().log
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if since is not None and since < log_store.first_seq:
+        return compacted_response(log_store)
+
+    high_watermark = log_store.durable_seq
+    etag = f"{log_store.first_seq}-{high_watermark}"
+    if not_modified(etag):
+        return not_modified_response(etag, high_watermark)
+
+    start = since if since is not None else log_store.first_seq
+    stop = high_watermark + 1
+    if until is not None:
+        stop = min(stop, until)
+    if limit is not None:
+        stop = min(stop, start + limit)
+    stop = max(start, stop)
+
+    messages = (record['message'] for record in log_store.iter_range(start, stop))
+    return stream_messages(messages, stop, high_watermark, etag)
+
+
+def requested_partition():
+    # The partition of a read (?partition=, 0 by default), ValueError if there is no such partition
+    index = request.args.get('partition', '0')
+    if not index.isdigit() or int(index) >= PARTITIONS:
+        raise ValueError(f"partition must be a number from 0 to {PARTITIONS - 1}")
+    return partitions[int(index)]
+
+
+def compacted_response(log_store):
+    # 410 for a read of messages compacted out of the log, with where the log starts now
+    first_seq = log_store.first_seq
+    response = jsonify({'status': 'error', 'first_sequence_number': first_seq,
+                        'message': f"Messages before {first_seq} were compacted, read them from GET /snapshot"})
+    response.headers['X-First-Sequence'] = str(first_seq)
+    return response, 410
+
+
+@app.route('/messages/<int:sequence_number>', methods=['GET'])
+def get_message(sequence_number):
+    # Point lookup of one durable message by its sequence number (in ?partition=, 0 by default)
+    try:
+        log_store = requested_partition().log
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if sequence_number < log_store.first_seq:
+        return compacted_response(log_store)
+    record = log_store.get(sequence_number) if sequence_number <= log_store.durable_seq else None
+    if record is None:
+        return jsonify({'status': 'error', 'message': 'No message with this sequence number'}), 404
+    return jsonify(record), 200
+
+
+def is_position(value):
+    # A position a secondary reports: the last sequence number it applied, -1 if none
+    return isinstance(value, int) and not isinstance(value, bool) and value >= -1
+
+
+# Sync mechanism on reconnection
+@app.route('/sync', methods=['POST'])
+def sync_node():
+    """
+    Endpoint for syncing a secondary node with missed messages.
+    Body: {"secondary_url": "http://secondary1:5001", "last_applied": 41}
+
+    The missed range starts right after the last sequence number the secondary has applied.
+    It is streamed in chunks by a background catch-up stream, so the request returns at once (202).
+    A stream that was interrupted is resumed from where the secondary is now.
+    """
+    payload = request.get_json(silent=True) or {}
+    try:
+        secondary_url = normalize_url(payload.get('secondary_url'))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': f"secondary_url: {e}"}), 400
+    last_applied = payload.get('last_applied')
+    if last_applied is None:
+        # Older secondaries send the last message they know about
+        last_known_msg = payload.get('last_known_msg') or {}
+        last_applied = last_known_msg.get('sequence_number', -1) if isinstance(last_known_msg, dict) else None
+    if not is_position(last_applied):
+        return jsonify({'status': 'error', 'message': 'last_applied must be an integer from -1'}), 400
+    # The log is only streamed to the cluster's own secondaries
+    if secondary_url not in members:
+        return jsonify({'status': 'error', 'message': 'Not a member'}), 404
+
+    stream = catch_up.sync(secondary_url, last_applied)
+    return jsonify({'status': 'accepted', 'sync': stream.progress()}), 202
+
+
+@app.route('/sync', methods=['GET'])
+def get_sync_progress():
+    # Progress of the catch-up streams, optionally of one secondary (?secondary_url=...)
+    secondary_url = request.args.get('secondary_url')
+    if secondary_url:
+        progress = catch_up.progress(secondary_url)
+        if progress is None:
+            return jsonify({'status': 'error', 'message': 'No sync for this secondary'}), 404
+        return jsonify(progress)
+    return jsonify(catch_up.progress())
+
+
+### SNAPSHOTS ###
+
+def take_snapshot(truncate=True):
+    """
+    Snapshot everything that is durable, then drop the part of the log the snapshot covers,
+    except the last SNAPSHOT_RETAIN_RECORDS records (a secondary that is a little behind
+    is still caught up from the log instead of loading the whole snapshot).
+    """
+    manifest = snapshots.take()
+    if manifest is not None and truncate:
+        first_seq = full_log.truncate_prefix(manifest['last_seq'] - SNAPSHOT_RETAIN_RECORDS)
+        logging.info(f"Log compacted, it now starts at {first_seq}")
+    return manifest
+
+
+def snapshot_periodically():
+    while True:
+        time.sleep(SNAPSHOT_CHECK_INTERVAL)
+        latest = snapshots.latest
+        covered = latest['last_seq'] if latest else -1
+        if full_log.durable_seq - covered >= SNAPSHOT_INTERVAL_RECORDS:
+            try:
+                take_snapshot()
+            except (OSError, RuntimeError) as e:
+                logging.error(f"Snapshot failed: {e}")
+
+
+@app.route('/snapshot', methods=['POST'])
+def trigger_snapshot():
+    # Take a snapshot now (?truncate=0 keeps the log as it is)
+    try:
+        manifest = take_snapshot(truncate=request.args.get('truncate', '1') == '1')
+    except (OSError, RuntimeError) as e:
+        logging.error(f"Snapshot failed: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+    if manifest is None:
+        return jsonify({'status': 'error', 'message': 'The log is empty'}), 409
+    return jsonify({'status': 'success', 'snapshot': manifest, 'log_first_seq': full_log.first_seq}), 201
+
+
+@app.route('/snapshot', methods=['GET'])
+def get_snapshot_status():
+    return jsonify({
+        'latest': snapshots.latest,
+        'log_first_seq': full_log.first_seq,
+        'log_last_seq': full_log.last_seq,
+        'interval_records': SNAPSHOT_INTERVAL_RECORDS,
+        'retain_records': SNAPSHOT_RETAIN_RECORDS,
+    })
+
+
+@app.route('/snapshot/latest', methods=['GET'])
+def download_snapshot():
+    """
+    The latest snapshot: gzip-compressed JSON lines [sequence_number, message].
+    X-Snapshot-Last-Seq says how far it goes, X-Snapshot-Checksum is the SHA-256 of its bytes.
+    """
+    manifest = snapshots.latest
+    if manifest is None:
+        return jsonify({'status': 'error', 'message': 'No snapshot yet'}), 404
+    response = Response(snapshots.read(manifest), mimetype='application/gzip')
+    response.headers['Content-Length'] = str(manifest['bytes'])
+    response.headers['X-Snapshot-Last-Seq'] = str(manifest['last_seq'])
+    response.headers['X-Snapshot-Records'] = str(manifest['records'])
+    response.headers['X-Snapshot-Checksum'] = manifest['checksum']
+    response.headers['ETag'] = f'"{manifest["checksum"]}"'
+    return response
+
 
+if SNAPSHOT_INTERVAL_RECORDS and not IS_WORKER:
+    snapshot_thread = threading.Thread(target=snapshot_periodically, daemon=True)
+    snapshot_thread.start()
 
 
 ### HEALTH CHECKS ###
@@ -101,32 +836,539 @@ def post_message():
 #     """
 #     return "Service is up", 200
 
+@app.route('/replication', methods=['GET'])
+def get_replication_status():
+    # Position, backlog and retry state of the replication worker of every secondary
+    return jsonify({secondary: replicator.status() for secondary, replicator in replicators.items()})
+
+
+@app.route('/partitions', methods=['GET'])
+def get_partitions():
+    # Sequence counter, durable head, waiting writes and replication workers of every partition
+    return jsonify({'partitions': PARTITIONS, 'status': [{
+        'partition': partition.index,
+        **partition.status(),
+        'write_groups': write_groups[partition.index].stats(),
+        'replication': {secondary: replicator.status() for secondary, replicator in partition_replicators(partition).items()},
+    } for partition in partitions]})
+
+
+@app.route('/idempotency', methods=['GET'])
+def get_idempotency_stats():
+    # Idempotency keys kept and retries answered from them
+    return jsonify(idempotency_keys.stats())
+
+
+@app.route('/pools', methods=['GET'])
+def get_pool_stats():
+    # Connection pool usage per secondary
+    return jsonify(http_pool.stats())
+
+
 @app.route('/health', methods=['GET'])
 def get_health_status():
-    return jsonify(secondaries_status)
+    # Suspicion level (phi) and availability of every secondary, with the last probe
+    return jsonify(health_monitor.status())
+
+
+def on_availability_change(secondary, available):
+    # Replication to a secondary that is likely down is deferred instead of timing out batch after batch
+    for partition in partitions:
+        workers = partition_replicators(partition)
+        if secondary in workers:
+            workers[secondary].set_available(available)
+    # A secondary that is down must not cut its subtree off: the tree is laid out again without it
+    if REPLICATION_TOPOLOGY != STAR:
+        with membership_lock:
+            if secondary in members:
+                rebuild_topology()
+
+
+# Failure detection: every secondary is probed concurrently, the probes' timing feeds a phi accrual detector
+HEALTH_PROBE_INTERVAL = float(os.environ.get('HEALTH_PROBE_INTERVAL', 1))  # Seconds between probes of a secondary
+HEALTH_PROBE_TIMEOUT = float(os.environ.get('HEALTH_PROBE_TIMEOUT', 0.5))  # Connect and read timeout of a probe
+HEALTH_PHI_THRESHOLD = float(os.environ.get('HEALTH_PHI_THRESHOLD', 8))  # Suspicion level from which a node is down
+HEALTH_ACCEPTABLE_PAUSE = float(os.environ.get('HEALTH_ACCEPTABLE_PAUSE', 1))  # Seconds of delay that are not suspicious
+# The probes have connections of their own, they must not wait behind the replication batches of a busy secondary
+probe_pool = SessionPool(pool_size=1, connect_timeout=HEALTH_PROBE_TIMEOUT, read_timeout=HEALTH_PROBE_TIMEOUT)
+health_monitor = HealthMonitor(
+    probe_pool,
+    interval=HEALTH_PROBE_INTERVAL,
+    timeout=HEALTH_PROBE_TIMEOUT,
+    threshold=HEALTH_PHI_THRESHOLD,
+    acceptable_pause=HEALTH_ACCEPTABLE_PAUSE,
+    on_change=on_availability_change,
+)
+
+
+### MEMBERSHIP ###
 
+def add_secondary(secondary):
+    """Start replicating to a member: its circuit breaker and failure detector. Call rebuild_topology() next."""
+    breakers[secondary] = CircuitBreaker(
+        secondary,
+        retry_wheel,
+        failure_threshold=REPLICATION_FAILURE_THRESHOLD,
+        retry_delay=REPLICATION_RETRY_DELAY_MS / 1000,
+        open_timeout=REPLICATION_OPEN_TIMEOUT,
+        max_open_timeout=REPLICATION_MAX_BACKOFF,
+        backoff_factor=backoff_factor,
+    )
+    for partition in partitions[1:]:
+        partition.add_replicator(secondary, start_partition_replicator(partition, secondary))
+    health_monitor.add(secondary)
 
-SECONDARY_CHECK_INTERVAL = 10  # Time interval between health checks in seconds
-secondaries_status = {url: "Healthy" for url in secondaries}
 
-def check_secondary_health():
+def start_partition_replicator(partition, secondary):
+    # The replication worker of a partition after 0: a star, with a circuit breaker of its own and no catch-up streams
+    def on_partition_ack(secondary, last_applied):
+        if secondary in members:
+            partition.ack_tracker.ack(secondary, last_applied)
+
+    return SecondaryReplicator(
+        secondary,
+        partition.log,
+        http_pool,
+        on_partition_ack,
+        max_records=REPLICATION_BATCH_RECORDS,
+        max_bytes=REPLICATION_BATCH_BYTES,
+        max_delay=REPLICATION_BATCH_DELAY_MS / 1000,
+        window=REPLICATION_WINDOW,
+        max_in_flight=REPLICATION_MAX_IN_FLIGHT,
+        wire=wire,
+        breaker=CircuitBreaker(
+            f"{secondary} partition {partition.index}",
+            retry_wheel,
+            failure_threshold=REPLICATION_FAILURE_THRESHOLD,
+            retry_delay=REPLICATION_RETRY_DELAY_MS / 1000,
+            open_timeout=REPLICATION_OPEN_TIMEOUT,
+            max_open_timeout=REPLICATION_MAX_BACKOFF,
+            backoff_factor=backoff_factor,
+        ),
+        headers={PARTITION_HEADER: str(partition.index)},
+    )
+
+
+def start_replicator(secondary):
+    replicator = SecondaryReplicator(
+        secondary,
+        full_log,
+        http_pool,
+        on_ack,
+        max_records=REPLICATION_BATCH_RECORDS,
+        max_bytes=REPLICATION_BATCH_BYTES,
+        max_delay=REPLICATION_BATCH_DELAY_MS / 1000,
+        window=REPLICATION_WINDOW,
+        max_in_flight=REPLICATION_MAX_IN_FLIGHT,
+        on_behind=lambda secondary, last_applied: catch_up.sync(secondary, last_applied),
+        catch_up_threshold=SYNC_THRESHOLD,
+        wire=wire,
+        breaker=breakers[secondary],
+        tracer=tracer,
+    )
+    if not health_monitor.is_available(secondary):
+        replicator.set_available(False)
+    return replicator
+
+
+def remove_secondary(secondary):
+    """Stop everything that runs for a member that left. It no longer counts for write concerns. Call rebuild_topology() next."""
+    global replicators
+    remaining = dict(replicators)
+    replicator = remaining.pop(secondary, None)
+    replicators = remaining
+    topology_pushed.pop(secondary, None)
+    for partition in partitions[1:]:
+        partition.remove_replicator(secondary)
+    health_monitor.remove(secondary)
+    catch_up.remove(secondary)
+    if replicator is not None:
+        replicator.stop()
+    breaker = breakers.pop(secondary, None)
+    if breaker is not None:
+        breaker.reset()  # Cancels its timers
+    ack_tracker.remove(secondary)
+    http_pool.close(secondary)
+    probe_pool.close(secondary)
+
+
+def rebuild_topology():
+    """
+    Lay the members out in the replication tree and run a replication worker for every secondary
+    the master sends to (every member in a star). Call with membership_lock held.
+
+    Secondaries that are suspected to be down are left out of the tree and fed by the master
+    directly, so they don't cut off the secondaries below them.
+    """
+    global replicators, topology
+    urls = members.urls()
+    tree = build_tree([url for url in urls if health_monitor.is_available(url)], REPLICATION_TOPOLOGY, REPLICATION_FANOUT)
+    for url in urls:
+        if url not in tree:
+            tree[None].append(url)
+            tree[url] = []
+
+    current = replicators
+    replicators = {url: current.get(url) or start_replicator(url) for url in tree[None]}
+    for url, replicator in current.items():
+        if url not in replicators:
+            replicator.stop()  # It gets the records from its parent now
+    if tree != topology:
+        logging.info(f"Replication topology ({REPLICATION_TOPOLOGY}): master -> {tree[None]}, "
+                     f"{ {url: children for url, children in tree.items() if url and children} }")
+    topology = tree
+    topology_changed.set()
+
+
+def push_topology(tree):
+    """
+    Tell every secondary whose place in the tree changed its parent and children (POST /topology).
+
+    Returns:
+        list: The secondaries that moved under a new parent and were told so.
+    """
+    moved = []
+    up = parents(tree)
+    for url in members.urls():
+        if url not in up or not health_monitor.is_available(url):
+            continue  # A secondary that is down is told when it is back
+        assignment = (up[url], tree.get(url, []))
+        previous = topology_pushed.get(url)
+        if previous == assignment:
+            continue
+        try:
+            response = http_pool.post(url, '/topology', json={'parent': assignment[0], 'children': assignment[1]})
+            if response.status_code != 200:
+                logging.warning(f"Topology update of {url} failed. Status code: {response.status_code}")
+                continue
+        except requests.RequestException as e:
+            logging.warning(f"Topology update of {url} failed: {e}")
+            continue
+        topology_pushed[url] = assignment
+        if previous is None or previous[0] != assignment[0]:
+            moved.append(url)
+    return moved
+
+
+def maintain_topology():
+    """
+    Keep the secondaries in a chain or tree up to date: push every change of the tree to them, and
+    catch up a secondary below the top of the tree that is behind the log and not moving, as a
+    forwarded batch can get lost (its parent restarted, moved or dropped its queue).
+    """
+    last_seen = {}
     while True:
-        for secondary in secondaries:
-            try:
-                response = requests.get(f"{secondary}/health")
-                if response.status_code == 200:
-                    secondaries_status[secondary] = "Healthy"
-                else:
-                    secondaries_status[secondary] = "Suspected"
-            except requests.RequestException:
-                secondaries_status[secondary] = "Unhealthy"
-        time.sleep(SECONDARY_CHECK_INTERVAL)
+        topology_changed.wait(TOPOLOGY_CHECK_INTERVAL)
+        topology_changed.clear()
+        tree = topology
+        moved = push_topology(tree)
+        head = full_log.durable_seq
+        for url in members.urls():
+            if url in tree[None]:
+                continue  # Its replication worker catches it up
+            position = ack_tracker.position(url)
+            if position is None:
+                # Nothing heard from it through the tree yet: ask it where it is
+                try:
+                    response = http_pool.get(url, '/status')
+                    if response.status_code == 200:
+                        on_ack(url, response.json()['last_applied'])
+                except (requests.RequestException, ValueError, KeyError) as e:
+                    logging.warning(f"Status of {url} is not available: {e}")
+                continue
+            if position < head and (url in moved or last_seen.get(url) == position):
+                catch_up.sync(url, position)
+            last_seen[url] = position
+
+
+def member_url(payload):
+    # The normalized URL of a /members request (JSON body or ?url=), ValueError if it is missing or invalid
+    return normalize_url(payload.get('url') or request.args.get('url'))
+
+
+@app.route('/members', methods=['GET'])
+def list_members():
+    # Every member with its replication position, availability and catch-up stream
+    listed = []
+    for url in members.urls():
+        replicator = replicators.get(url)
+        listed.append({
+            **(members.get(url) or {'url': url}),
+            'acked': replicator.acked_seq if replicator else ack_tracker.position(url),
+            'available': health_monitor.is_available(url),
+            'sync': catch_up.progress(url),
+        })
+    return jsonify({'members': listed, 'max_write_concern': len(members) + 1})
+
+
+@app.route('/members', methods=['POST'])
+def register_member():
+    """
+    A secondary joins the cluster, or announces itself again after a restart.
+    Body: {"url": "http://secondary3:5003", "last_applied": 41}
+
+    A new member gets a replication worker and a failure detector at once. With last_applied, the
+    records it is missing are streamed by a catch-up stream (like POST /sync), without it the
+    replication worker asks the secondary where it is and catches it up from there.
+    Answers 201 for a new member, 200 for a known one.
+    """
+    payload = request.get_json(silent=True) or {}
+    try:
+        url = member_url(payload)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    last_applied = payload.get('last_applied')
+    if last_applied is not None and not is_position(last_applied):
+        return jsonify({'status': 'error', 'message': 'last_applied must be an integer from -1'}), 400
+
+    with membership_lock:
+        joined = members.add(url)
+        if joined:
+            add_secondary(url)
+        rebuild_topology()
+        topology_pushed.pop(url, None)  # A restarted secondary has forgotten its place in the tree
+    response = {'status': 'joined' if joined else 'member', 'member': members.get(url), 'members': len(members)}
+    if last_applied is not None:
+        response['sync'] = catch_up.sync(url, last_applied).progress()
+    return jsonify(response), 201 if joined else 200
+
+
+@app.route('/members', methods=['DELETE'])
+def deregister_member():
+    """
+    A secondary leaves the cluster: replication to it stops and it no longer counts for write concerns.
+    Body: {"url": "http://secondary3:5003"}, or ?url=...
+    """
+    try:
+        url = member_url(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    with membership_lock:
+        if not members.remove(url):
+            return jsonify({'status': 'error', 'message': 'Not a member'}), 404
+        remove_secondary(url)
+        rebuild_topology()
+    return jsonify({'status': 'left', 'members': len(members)}), 200
+
+
+@app.route('/acks', methods=['POST'])
+def receive_acks():
+    """
+    ACKs that come up a chain or tree: a secondary reports how far its descendants have applied the log.
+    Body: {"from": "http://secondary1:5001", "positions": {"http://secondary3:5003": 41, ...}}
+    """
+    payload = request.get_json(silent=True)
+    positions = payload.get('positions') if isinstance(payload, dict) else None
+    if not isinstance(positions, dict):
+        return jsonify({'status': 'error', 'message': 'positions must be an object of URL: last applied sequence number'}), 400
+    try:
+        positions = {normalize_url(url): last_applied for url, last_applied in positions.items()}
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    if not all(is_position(last_applied) for last_applied in positions.values()):
+        return jsonify({'status': 'error', 'message': 'Every position must be an integer from -1'}), 400
+    for url, last_applied in positions.items():
+        on_ack(url, last_applied)
+    return jsonify({'status': 'ACK', 'positions': len(positions)}), 200
+
+
+@app.route('/topology', methods=['GET'])
+def get_topology():
+    # The replication tree: who sends to whom, how deep every secondary is and what it has acknowledged
+    tree = topology
+    up = parents(tree)
+    return jsonify({
+        'topology': REPLICATION_TOPOLOGY,
+        'fanout': REPLICATION_FANOUT,
+        'master': tree[None],
+        'nodes': {url: {
+            'parent': up[url] or 'master',
+            'children': tree[url],
+            'depth': depth(tree, url),
+            'acked': ack_tracker.position(url),
+            'informed': url in topology_pushed,
+        } for url in up},
+        'head': full_log.durable_seq,
+    })
+
+
+# Workers don't replicate, the leader does it for every process
+if not IS_WORKER:
+    with membership_lock:
+        for secondary in members.urls():
+            add_secondary(secondary)
+        rebuild_topology()
+    if REPLICATION_TOPOLOGY != STAR:
+        Thread(target=maintain_topology, name="topology", daemon=True).start()
+
+
+### METRICS ###
+
+def replication_gauge(value):
+    # {(secondary,): value(status, durable head)} over the replication workers, read at scrape time
+    head = full_log.durable_seq
+    return {(secondary,): value(replicator.status(), head) for secondary, replicator in replicators.items()}
+
+
+Gauge('replog_log_first_seq', 'First sequence number still in the log (older ones are in the snapshot).',
+      lambda: full_log.first_seq)
+Gauge('replog_log_durable_seq', 'Last sequence number written to disk.', lambda: full_log.durable_seq)
+Gauge('replog_partition_durable_seq', 'Last sequence number of the partition written to disk.',
+      lambda: {(str(partition.index),): partition.log.durable_seq for partition in partitions}, ['partition'])
+Gauge('replog_write_concern_waiting', 'Writes waiting for the ACKs of their write concern.', lambda: ack_tracker.pending)
+Gauge('replog_retry_timers', 'Retries and breaker timeouts parked on the timer wheel.', lambda: len(retry_wheel))
+Gauge('replog_replication_lag_records', 'Records durable on the master and not applied by the secondary yet.',
+      lambda: replication_gauge(lambda status, head: status['backlog']), ['secondary'])
+Gauge('replog_replication_queue_records', 'Records durable on the master and not sent to the secondary yet.',
+      lambda: replication_gauge(lambda status, head: None if status['next_to_send'] is None
+                                else max(0, head - status['next_to_send'] + 1)), ['secondary'])
+Gauge('replog_replication_in_flight_records', 'Records sent to the secondary and not acknowledged yet.',
+      lambda: replication_gauge(lambda status, head: status['in_flight']), ['secondary'])
+Gauge('replog_circuit_breaker_state', 'State of the circuit breaker of the secondary (1 for the current state).',
+      lambda: {(secondary, state): int(breaker.state == state)
+               for secondary, breaker in list(breakers.items())
+               for state in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN)},
+      ['secondary', 'state'])
+Gauge('replog_secondary_phi', 'Suspicion level of the failure detector for the secondary.',
+      lambda: {(secondary,): health_monitor.phi(secondary) for secondary in members.urls()}, ['secondary'])
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus text format: write latency by w, replication RTT, ACK wait, retries, queues and lag
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+@app.route('/debug/traces', methods=['GET'])
+def get_traces():
+    """
+    The sampled traces of the write path, newest last.
+    Query: ?trace_id=<one trace>&limit=<number of traces, default 20>&format=chrome (Chrome trace JSON).
+    """
+    trace_id = request.args.get('trace_id')
+    limit = request.args.get('limit', 20, type=int)
+    if request.args.get('format') == 'chrome':
+        return jsonify(tracer.chrome_trace(trace_id, limit))
+    return jsonify(tracer.traces(trace_id, limit))
+
+
+### WORKERS ###
+
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+                      'transfer-encoding', 'upgrade', 'host'}
+
+
+def follow_shared_log(partition):
+    # Leader: replicate what the workers appended to the log of a partition
+    if partition.log.refresh():
+        partition.log.wait_durable(partition.log.last_seq)
+        for replicator in partition_replicators(partition).values():
+            replicator.notify()
+
+
+def follow_workers():
+    while True:
+        time.sleep(SHARED_LOG_POLL_INTERVAL)
+        for partition in partitions:
+            follow_shared_log(partition)
+
+
+@app.route('/internal/appended', methods=['POST'])
+def worker_appended():
+    """
+    A worker appended a message: the leader replicates it and answers once its write concern is satisfied or timed out.
+    Body: {"partition": 0, "sequence_number": 42, "w": 3, "timeout": 10}. Only served on the leader's internal port.
+    """
+    if IS_WORKER or request.environ.get('SERVER_PORT') != str(MASTER_INTERNAL_PORT):
+        return jsonify({'status': 'error', 'message': 'Not found'}), 404
+    payload = request.get_json(silent=True) or {}
+    try:
+        index = int(payload['partition'])
+        sequence_number = int(payload['sequence_number'])
+        write_concern = int(payload['w'])
+        timeout = float(payload['timeout'])
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'status': 'error', 'message': f"Invalid request: {e}"}), 400
+    if not 0 <= index < PARTITIONS:
+        return jsonify({'status': 'error', 'message': f"partition must be between 0 and {PARTITIONS - 1}"}), 400
+    partition = partitions[index]
+    # Registered late: the tracker counts the ACKs that already cover the message
+    waiter = partition.ack_tracker.register(sequence_number, write_concern - 1)
+    follow_shared_log(partition)
+    satisfied = partition.ack_tracker.wait(sequence_number, waiter, timeout)
+    return jsonify({'satisfied': satisfied, 'acked_by': sorted(waiter.secondaries)}), 200
+
+
+@app.before_request
+def proxy_to_leader():
+    # Workers take the writes, every other request (reads, membership, ACKs, metrics...) is served by the leader,
+    # and so are the writes with an Idempotency-Key: the leader keeps the keys of every process
+    if not IS_WORKER:
+        return None
+    if request.endpoint in ('post_message', 'post_messages_bulk') and IDEMPOTENCY_HEADER not in request.headers:
+        return None
+    if request.endpoint == 'worker_appended':
+        return jsonify({'status': 'error', 'message': 'Not found'}), 404
+    path = request.path
+    if request.query_string:
+        path = f"{path}?{request.query_string.decode('latin-1')}"
+    headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+    try:
+        upstream = leader_pool.request(request.method, LEADER_URL, path, data=request.get_data(), headers=headers,
+                                       stream=True, allow_redirects=False)
+    except requests.RequestException as e:
+        logging.warning(f"Leader unreachable: {e}")
+        return jsonify({'status': 'error', 'message': 'Leader unreachable'}), 502
+
+    def relay():
+        try:
+            yield from upstream.raw.stream(64 * 1024, decode_content=False)
+        finally:
+            upstream.close()
+
+    response_headers = [(name, value) for name, value in upstream.raw.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS]
+    return Response(relay(), status=upstream.status_code, headers=response_headers)
+
+
+def supervise_worker(number, listen_fd):
+    # Leader: run a worker process on the shared listening socket, start it again when it exits
+    env = {**os.environ, 'MASTER_ROLE': 'worker', 'MASTER_LISTEN_FD': str(listen_fd)}
+    while True:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env, pass_fds=(listen_fd,))
+        logging.info(f"Worker {number} started, pid {process.pid}")
+        code = process.wait()
+        logging.warning(f"Worker {number} exited with code {code}, starting it again")
+        time.sleep(1)
+
+
+def watch_leader(leader_pid):
+    # Worker: without the leader nothing is replicated, so a worker doesn't outlive it
+    while os.getppid() == leader_pid:
+        time.sleep(1)
+    logging.error("Leader exited, worker stops")
+    os._exit(1)
+
+
+def serve():
+    if IS_WORKER:
+        Thread(target=watch_leader, args=(os.getppid(),), name="watch-leader", daemon=True).start()
+        make_server('0.0.0.0', MASTER_PORT, app, threaded=True, fd=int(os.environ['MASTER_LISTEN_FD'])).serve_forever()
+        return
 
-# Start the health check thread
-health_check_thread = threading.Thread(target=check_secondary_health)
-health_check_thread.daemon = True  # Daemonize thread
-health_check_thread.start()
+    # The listening socket is created once and inherited by the workers, the kernel spreads the connections
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('0.0.0.0', MASTER_PORT))
+    listener.listen(1024)
+    listener.set_inheritable(True)
 
+    internal = make_server('127.0.0.1', MASTER_INTERNAL_PORT, app, threaded=True)
+    Thread(target=internal.serve_forever, name="internal", daemon=True).start()
+    Thread(target=follow_workers, name="follow-workers", daemon=True).start()
+    for number in range(1, MASTER_WORKERS):
+        Thread(target=supervise_worker, args=(number, listener.fileno()), name=f"worker-{number}", daemon=True).start()
+    make_server('0.0.0.0', MASTER_PORT, app, threaded=True, fd=listener.fileno()).serve_forever()
 
 
 ### MASTER ENDPOINTS ###
@@ -140,4 +1382,7 @@ def home():
     return "Welcome to the Master Server!", 200
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000)
+    if MASTER_WORKERS > 1:
+        serve()
+    else:
+        app.run(host='0.0.0.0', port=MASTER_PORT)
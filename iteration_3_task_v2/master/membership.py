@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+def normalize_url(url):
+    """
+    The canonical form of a secondary's base URL, used as its identity.
+
+    Raises:
+        ValueError: If it is not an http(s) URL.
+    """
+    if not isinstance(url, str) or not url.startswith(('http://', 'https://')):
+        raise ValueError(f"Not an http(s) URL: {url!r}")
+    return url.rstrip('/')
+
+
+class MemberList:
+    """
+    The secondaries the master replicates to, kept in a JSON file so registrations survive a restart.
+
+    On the very first start (no file yet) the list is seeded with `seeds`, the secondaries given
+    in the configuration. From then on the file is the source of truth: secondaries register and
+    deregister through the master's /members endpoints. The file is rewritten (temporary file and
+    rename) on every change, which is rare.
+
+    Args:
+        path (str): The JSON file.
+        seeds (list): URLs of the secondaries to start with when there is no file.
+    """
+
+    def __init__(self, path, seeds=()):
+        self.path = path
+        self._members = {}  # URL -> {'url', 'registered_at'}, in registration order
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as f:
+                for member in json.load(f)['members']:
+                    self._members[member['url']] = member
+        else:
+            for url in seeds:
+                url = normalize_url(url)
+                self._members[url] = {'url': url, 'registered_at': time.time()}
+            self._save()
+
+    def __contains__(self, url):
+        return url in self._members
+
+    def __len__(self):
+        return len(self._members)
+
+    def urls(self):
+        """The member URLs, a copy that can be iterated while members change."""
+        return list(self._members)
+
+    def get(self, url):
+        return self._members.get(url)
+
+    def add(self, url):
+        """
+        Returns:
+            bool: True if `url` was not a member yet.
+        """
+        with self._lock:
+            if url in self._members:
+                return False
+            self._members[url] = {'url': url, 'registered_at': time.time()}
+            self._save()
+        logging.info(f"{url} joined the cluster")
+        return True
+
+    def remove(self, url):
+        """
+        Returns:
+            bool: True if `url` was a member.
+        """
+        with self._lock:
+            if self._members.pop(url, None) is None:
+                return False
+            self._save()
+        logging.info(f"{url} left the cluster")
+        return True
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'members': list(self._members.values())}, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
@@ -0,0 +1,59 @@
+import hashlib
+import threading
+
+from replication import AckTracker
+
+
+def partition_for(key, partitions):
+    """
+    The partition of a partition key. The hash is stable (the same in every process and after a
+    restart), so the messages of a key always go to the same partition and keep their order,
+    as long as the number of partitions doesn't change.
+    """
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % partitions
+
+
+class Partition:
+    """
+    One sequence space of the log: its own write-ahead log, lock and ACK tracker.
+
+    Writes to different partitions don't wait for each other: each partition assigns its sequence
+    numbers (the next sequence number of its log) under its own lock and appends and fsyncs its own log, and is replicated by replication
+    workers of its own (one per secondary), so secondaries keep a separate last applied sequence
+    number per partition. Messages are ordered within a partition, not across partitions.
+
+    Args:
+        index (int): Number of the partition. Partition 0 is the log of an unpartitioned master.
+        log_store (SegmentedLog): The log of the partition.
+        ack_tracker (AckTracker): Tracker of the write concerns, a new one if not given.
+    """
+
+    def __init__(self, index, log_store, ack_tracker=None):
+        self.index = index
+        self.log = log_store
+        self.lock = threading.Lock()  # Sequence numbers are assigned and appended under it, so the log stays in order
+        self.ack_tracker = ack_tracker or AckTracker()
+        # Secondary -> SecondaryReplicator of the partitions after 0 (partition 0 has the master's replicators).
+        # Replaced, never changed in place, so the write path iterates it without a lock
+        self.replicators = {}
+
+    def add_replicator(self, secondary, replicator):
+        self.replicators = {**self.replicators, secondary: replicator}
+
+    def remove_replicator(self, secondary):
+        """Stop and forget the replication worker of a secondary that left the cluster."""
+        remaining = dict(self.replicators)
+        replicator = remaining.pop(secondary, None)
+        self.replicators = remaining
+        if replicator is not None:
+            replicator.stop()
+            replicator.breaker.reset()  # Cancels its timers
+        self.ack_tracker.remove(secondary)
+
+    def status(self):
+        return {
+            'next_seq': self.log.next_seq,
+            'durable_seq': self.log.durable_seq,
+            'waiting_writes': self.ack_tracker.pending,
+        }
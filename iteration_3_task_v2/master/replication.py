@@ -0,0 +1,401 @@
+import logging
+import threading
+import time
+
+import requests
+
+from common.metrics import Counter, Histogram
+from retry import CircuitBreaker, TimerWheel
+from common.tracing import TRACE_HEADER
+from common.wire import FORWARD_HEADER, BatchPoster
+
+REPLICATION_RTT = Histogram('replog_replication_rtt_seconds',
+                            'Round trip of a replication batch, from sending it to its ACK.', ['secondary'])
+REPLICATION_BATCH_RECORDS = Histogram('replog_replication_batch_records', 'Records per replication batch.',
+                                      ['secondary'], buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+REPLICATION_RETRIES = Counter('replog_replication_retries_total',
+                              'Failed replication requests, each one is retried.', ['secondary', 'sender'])
+REPLICATION_INVALID_RECORDS = Counter('replog_replication_invalid_records_total',
+                                      'Records a secondary refused as invalid and skipped.', ['secondary'])
+
+
+class AckWaiter:
+    """The secondaries that acknowledged one message, and an event set once there are enough of them."""
+
+    def __init__(self, required):
+        self.required = required
+        self.secondaries = set()
+        self.done = threading.Event()
+
+    def add(self, secondary):
+        self.secondaries.add(secondary)
+        if len(self.secondaries) >= self.required:
+            self.done.set()
+
+
+class AckTracker:
+    """
+    Resolves write concerns from the cumulative ACKs of the replication workers.
+
+    Every secondary reports the highest contiguous sequence number it has applied. The tracker keeps
+    that position per secondary and, when it moves forward, counts the secondary once for every
+    message waiting in between. A waiting request is woken up the moment its required number of
+    ACKs is reached - there is no polling and no queue shared between requests.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._applied = {}   # secondary -> last sequence number applied
+        self._waiters = {}   # sequence number -> AckWaiter
+
+    @property
+    def pending(self):
+        """Number of messages whose writers are waiting for ACKs."""
+        return len(self._waiters)
+
+    def register(self, seq, required):
+        """
+        Start tracking the ACKs of the message `seq`. Must be called before the message can be replicated.
+
+        Returns:
+            AckWaiter: Pass it to wait().
+        """
+        waiter = AckWaiter(required)
+        if required <= 0:
+            waiter.done.set()
+            return waiter
+        with self._lock:
+            for secondary, applied in self._applied.items():
+                if applied >= seq:
+                    waiter.add(secondary)
+            self._waiters[seq] = waiter
+        return waiter
+
+    def ack(self, secondary, last_applied):
+        """Record that `secondary` has applied every message up to `last_applied`."""
+        with self._lock:
+            previous = self._applied.get(secondary, -1)
+            # The position can also go back if the secondary lost its log, the counted ACKs stay counted
+            self._applied[secondary] = last_applied
+            if last_applied <= previous:
+                return
+            for seq, waiter in self._waiters.items():
+                if previous < seq <= last_applied:
+                    waiter.add(secondary)
+
+    def position(self, secondary):
+        """Last sequence number `secondary` has applied, None if it never answered."""
+        return self._applied.get(secondary)
+
+    def remove(self, secondary):
+        """Forget the position of a secondary that left the cluster."""
+        with self._lock:
+            self._applied.pop(secondary, None)
+
+    def wait(self, seq, waiter, timeout):
+        """
+        Block until the message has enough ACKs or `timeout` seconds have passed, then stop tracking it.
+
+        Returns:
+            bool: True if the write concern is satisfied.
+        """
+        try:
+            return waiter.done.wait(timeout)
+        finally:
+            with self._lock:
+                self._waiters.pop(seq, None)
+
+
+class SecondaryReplicator:
+    """
+    Long-lived replication worker for one secondary.
+
+    The replication queue of a secondary is the part of the master's log after the last sequence
+    number the secondary has acknowledged, so nothing is copied per message and an outage of any
+    length costs no extra memory or threads. A fixed set of `max_in_flight` sender threads reads
+    contiguous batches from that queue and ships them, in order, to the secondary's
+    `/replicate_batch` endpoint:
+    - at most `window` records are on the wire (sent but not acknowledged) at any time;
+    - the secondary answers with the highest contiguous sequence number it has applied, which
+      moves the acknowledged position forward and is passed on as on_ack(secondary, last_applied);
+    - if a send fails, or the secondary stopped at a gap that no batch on the wire will fill, sending
+      goes back to the first unacknowledged record (go-back-N);
+    - failures go through the secondary's circuit breaker: a failed delivery is parked on the
+      retry timer wheel (no thread sleeps on it), repeated failures open the breaker, and while it
+      is open nothing is sent. The half-open trial is an empty batch; when it succeeds the breaker
+      closes and the backlog drains in full batches (or through on_behind if it is large);
+    - the first request is an empty batch that asks the secondary where it is, so a secondary
+      that was down or restarted is caught up from the log. If it is more than `catch_up_threshold`
+      records behind, on_behind(secondary, last_applied) is called instead, so the gap can be
+      streamed by a catch-up stream while the worker is paused;
+    - if the records after the acknowledged position were compacted out of the log (a snapshot
+      covers them), nothing is sent from the log: the secondary is probed and on_behind is called,
+      so the catch-up stream can bootstrap it from the snapshot;
+    - the failure detector opens the breaker as soon as it suspects the secondary
+      (set_available(False)) and lets the trial through as soon as it is back.
+
+    Args:
+        secondary (str): The URL of the secondary node.
+        log_store (SegmentedLog): The master's log, records are read from it by sequence number.
+        http (SessionPool): Pooled keep-alive sessions used to reach the secondary.
+        on_ack (callable): Called as on_ack(secondary, last_applied) after every ACK.
+        max_records (int): Maximum number of records in one batch.
+        max_bytes (int): Maximum total message size of one batch.
+        max_delay (float): Seconds to wait for a batch to fill up while other batches are on the wire.
+        window (int): Maximum number of records sent but not yet acknowledged.
+        max_in_flight (int): Number of sender threads, i.e. batches that can be on the wire at once.
+        idle_probe_interval (float): Seconds without traffic after which the secondary is asked where it is.
+        on_behind (callable): Called as on_behind(secondary, last_applied) when the secondary is far behind.
+        catch_up_threshold (int): Number of missing records from which on_behind is called.
+        wire (BatchPoster): Encodes and posts the batches, JSON if not given.
+        breaker (CircuitBreaker): Circuit breaker of the secondary, shared with its catch-up stream.
+        tracer (Tracer): Records a span on the trace of every sampled record a batch carries.
+        headers (dict): Extra headers sent with every batch (the partition of a partitioned log).
+    """
+
+    def __init__(self, secondary, log_store, http, on_ack, max_records=256, max_bytes=256 * 1024, max_delay=0.005,
+                 window=1024, max_in_flight=2, idle_probe_interval=5,
+                 on_behind=None, catch_up_threshold=10000, wire=None, breaker=None, tracer=None, headers=None):
+        self.secondary = secondary
+        self.log_store = log_store
+        self.http = http
+        self.on_ack = on_ack
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.window = window
+        self.idle_probe_interval = idle_probe_interval
+        self.on_behind = on_behind
+        self.catch_up_threshold = catch_up_threshold
+        self.wire = wire or BatchPoster(http, binary=False)
+        self.breaker = breaker or CircuitBreaker(secondary, TimerWheel())
+        self.breaker.on_ready = self.notify  # The workers wait on their condition while the breaker holds them back
+        self.tracer = tracer
+        self.headers = headers or {}
+
+        self._cond = threading.Condition()
+        self._acked = None      # Last sequence number applied by the secondary, None until it answers
+        self._cursor = None     # Next sequence number to send
+        self._in_flight = 0     # Records sent and not acknowledged yet
+        self._probing = False
+        self._fill_deadline = None
+        self._last_contact = 0
+        self._paused = False
+        self._stopped = False
+        self._rtt = REPLICATION_RTT.labels(secondary)
+        self._batch_records = REPLICATION_BATCH_RECORDS.labels(secondary)
+        self._retries = REPLICATION_RETRIES.labels(secondary, 'replicator')
+
+        self._threads = [
+            threading.Thread(target=self._run, name=f"replicate-{secondary}-{i}", daemon=True)
+            for i in range(max_in_flight)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def acked_seq(self):
+        return self._acked
+
+    def notify(self):
+        """Wake the workers up, new records are available in the log."""
+        with self._cond:
+            self._cond.notify_all()
+
+    def pause(self):
+        """Stop sending, a catch-up stream is taking care of the secondary."""
+        with self._cond:
+            self._paused = True
+
+    def resume(self, last_applied, reachable=True):
+        """
+        Continue sending right after `last_applied`, where the catch-up stream stopped.
+        If the stream finished, the secondary is `reachable` and earlier failures are forgotten.
+        """
+        if reachable:
+            self.breaker.reset()
+        with self._cond:
+            self._paused = False
+            if self._acked is None or last_applied > self._acked:
+                self._acked = last_applied
+            self._cursor = self._acked + 1
+            self._cond.notify_all()
+
+    def stop(self):
+        """Stop the workers for good, the secondary left the cluster. A batch on the wire still completes."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def set_available(self, available):
+        """Open the breaker while the secondary is suspected to be down, send the trial right away when it is back."""
+        if available:
+            self.breaker.try_now()
+        else:
+            self.breaker.trip()
+
+    def status(self):
+        with self._cond:
+            head = self.log_store.durable_seq
+            return {
+                'acked': self._acked,
+                'next_to_send': self._cursor,
+                'in_flight': self._in_flight,
+                'backlog': None if self._acked is None else head - self._acked,
+                'breaker': self.breaker.status(),
+                'threads': len(self._threads),
+                'paused': self._paused,
+                'wire_format': self.wire.format_for(self.secondary),
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._take_batch()
+                while batch is None:
+                    if self._stopped:
+                        return
+                    self._cond.wait(self._wait_timeout())
+                    batch = self._take_batch()
+            self._send(batch)
+
+    def _wait_timeout(self):
+        now = time.monotonic()
+        deadlines = [self._last_contact + self.idle_probe_interval]
+        if self._fill_deadline is not None:
+            deadlines.append(self._fill_deadline)
+        return max(0.001, min(deadlines) - now)
+
+    def _take_batch(self):
+        # Called with the condition held. Returns the records to send (an empty list asks
+        # the secondary where it is) or None if there is nothing to send right now.
+        now = time.monotonic()
+        if self._probing or self._paused or self._stopped:
+            return None
+
+        # Half-open: the trial is an empty batch, it tells whether the secondary is back and where it is
+        if self.breaker.state == CircuitBreaker.HALF_OPEN:
+            if not self.breaker.allow_request():
+                return None
+            self._probing = True
+            return []
+        if not self.breaker.allow_request():
+            return None
+
+        head = self.log_store.durable_seq
+        if self._acked is None or self._cursor < self.log_store.first_seq or (
+                self._in_flight == 0 and self._cursor > head and now - self._last_contact >= self.idle_probe_interval):
+            self._probing = True
+            return []
+
+        available = head - self._cursor + 1
+        room = self.window - self._in_flight
+        if available <= 0 or room <= 0:
+            return None
+
+        # While other batches are on the wire, give this one a moment to fill up
+        if self._in_flight and available < self.max_records:
+            if self._fill_deadline is None:
+                self._fill_deadline = now + self.max_delay
+            if now < self._fill_deadline:
+                return None
+        self._fill_deadline = None
+
+        records = self.log_store.read_range(self._cursor, head + 1, limit=min(available, room, self.max_records))
+        batch = []
+        size = 0
+        for record in records:
+            size += len(record['message'])
+            if batch and size > self.max_bytes:
+                break
+            batch.append(record)
+        if not batch:
+            return None
+
+        self._cursor = batch[-1]['sequence_number'] + 1
+        self._in_flight += len(batch)
+        return batch
+
+    def _send(self, batch):
+        trace_ids = self.tracer.linked(batch[0]['sequence_number'], batch[-1]['sequence_number']) if batch and self.tracer else []
+        # Live batches are forwarded down the replication tree, catch-up chunks are not
+        headers = {FORWARD_HEADER: '1', **self.headers}
+        if trace_ids:
+            headers[TRACE_HEADER] = ','.join(trace_ids)
+        started_at = time.time()
+        outcome = None
+        try:
+            started = time.perf_counter()
+            response = self.wire.post_batch(self.secondary, batch, headers=headers)
+            outcome = response.status_code
+            if response.status_code == 200:
+                ack = response.json()
+                self._rtt.observe(time.perf_counter() - started)
+                if batch:
+                    self._batch_records.observe(len(batch))
+                self._trace(trace_ids, batch, started_at, outcome)
+                if ack.get('invalid') is not None:
+                    # The secondary stepped over it and its last_applied is past it, so it is not sent again
+                    logging.error(f"{self.secondary} skipped the invalid record {ack['invalid']}")
+                    REPLICATION_INVALID_RECORDS.labels(self.secondary).inc()
+                self._on_success(batch, ack['last_applied'], ack.get('rejected'))
+                return
+            logging.error(f"Batch replication failed for {self.secondary}. Status code: {response.status_code}, Response: {response.text}")
+        except (requests.RequestException, ValueError, KeyError) as e:
+            outcome = type(e).__name__
+            logging.error(f"Error replicating batch to {self.secondary}: {e}")
+        self._trace(trace_ids, batch, started_at, outcome)
+        self._on_failure(batch)
+
+    def _trace(self, trace_ids, batch, started_at, outcome):
+        # One span per sampled write in the batch, every attempt is recorded
+        ended_at = time.time()
+        for trace_id in trace_ids:
+            self.tracer.record(trace_id, 'replicate', started_at, ended_at, secondary=self.secondary,
+                               first_seq=batch[0]['sequence_number'], records=len(batch), outcome=outcome,
+                               failures=self.breaker.failures)
+
+    def _on_success(self, batch, last_applied, rejected=None):
+        closed = self.breaker.record_success()
+        with self._cond:
+            self._in_flight -= len(batch)
+            if not batch:
+                self._probing = False
+            self._last_contact = time.monotonic()
+
+            # The breaker just closed: a large backlog goes to a catch-up stream instead of the window
+            behind = closed and self.log_store.durable_seq - last_applied > self.catch_up_threshold
+            if self._acked is None or last_applied < self._acked:
+                # First contact, or the secondary lost its log: continue right after what it has applied
+                self._acked = last_applied
+                self._cursor = last_applied + 1
+                behind = self.log_store.durable_seq - last_applied > self.catch_up_threshold
+            else:
+                self._acked = max(self._acked, last_applied)
+                self._cursor = max(self._cursor, self._acked + 1)
+                if batch and last_applied < batch[-1]['sequence_number'] and (rejected != 0 or not self._in_flight):
+                    # The secondary stopped at a gap that no batch on the wire is going to fill
+                    # (records it keeps in its reorder buffer wait for the batches still in flight),
+                    # so go back to the first record it is missing
+                    self._cursor = min(self._cursor, last_applied + 1)
+            if self._acked + 1 < self.log_store.first_seq:
+                # What the secondary is missing is only in the snapshot now
+                behind = True
+            acked = self._acked
+            self._cond.notify_all()
+
+        self.on_ack(self.secondary, acked)
+        if behind and self.on_behind:
+            self.on_behind(self.secondary, acked)
+
+    def _on_failure(self, batch):
+        # The breaker parks the retry (or opens) and wakes the workers up when they may send again
+        self._retries.inc()
+        self.breaker.record_failure()
+        with self._cond:
+            self._in_flight -= len(batch)
+            if not batch:
+                self._probing = False
+            if self._acked is not None:
+                self._cursor = self._acked + 1
+            self._cond.notify_all()
@@ -0,0 +1,267 @@
+import itertools
+import logging
+import math
+import threading
+import time
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel: a single thread fires every scheduled retry, nothing else sleeps on a timer.
+
+    Timers are dropped into one of `slots` buckets by their deadline, so scheduling and cancelling
+    cost O(1) however many retries are parked. The thread advances one slot per `tick` and runs the
+    callbacks that are due. Callbacks run on the wheel thread and must be quick (wake a worker up,
+    flip a state).
+
+    Args:
+        tick (float): Resolution of the timers, in seconds.
+        slots (int): Number of buckets, timers further away than slots * tick go round more than once.
+    """
+
+    def __init__(self, tick=0.01, slots=512):
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)]  # timer id -> [remaining rounds, callback]
+        self._current = 0
+        self._count = 0
+        self._ids = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='retry-wheel', daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay, callback):
+        """
+        Call `callback()` after `delay` seconds (rounded up to the next tick).
+
+        Returns:
+            tuple: A handle for cancel().
+        """
+        ticks = max(1, math.ceil(delay / self.tick))
+        with self._cond:
+            slot = (self._current + ticks) % len(self._slots)
+            timer_id = next(self._ids)
+            self._slots[slot][timer_id] = [(ticks - 1) // len(self._slots), callback]
+            self._count += 1
+            self._cond.notify()
+        return slot, timer_id
+
+    def cancel(self, handle):
+        slot, timer_id = handle
+        with self._cond:
+            if self._slots[slot].pop(timer_id, None) is not None:
+                self._count -= 1
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            with self._cond:
+                while not self._count:
+                    # Nothing parked: sleep until something is scheduled instead of ticking idle
+                    self._cond.wait()
+                    next_tick = time.monotonic() + self.tick
+                delay = next_tick - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                due = []
+                bucket = self._slots[self._current]
+                for timer_id, timer in list(bucket.items()):
+                    if timer[0] == 0:
+                        del bucket[timer_id]
+                        due.append(timer[1])
+                    else:
+                        timer[0] -= 1
+                self._count -= len(due)
+                self._current = (self._current + 1) % len(self._slots)
+                next_tick += self.tick
+
+            for callback in due:
+                try:
+                    callback()
+                except Exception:
+                    logging.exception("Retry timer callback failed")
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker of one secondary: closed, open or half-open.
+
+    - closed: requests go through. A failed delivery is parked on the timer wheel for a short,
+      growing delay (`retry_delay * backoff_factor ** (failures - 1)`), and after `failure_threshold`
+      failures in a row the breaker opens;
+    - open: nothing is sent. After `open_timeout` (doubled every time the breaker opens again,
+      up to `max_open_timeout`) the wheel moves it to half-open;
+    - half-open: one trial request is let through. Success closes the breaker, failure opens it again.
+
+    Every time requests are allowed again on_ready() is called, so the senders wait on
+    their own condition instead of sleeping.
+
+    Args:
+        name (str): The secondary, for the logs.
+        wheel (TimerWheel): Scheduler of the retries and of the open timeout.
+        failure_threshold (int): Failures in a row that open the breaker.
+        retry_delay (float): Delay before retrying the first failure, in seconds.
+        open_timeout (float): Seconds the breaker stays open the first time.
+        max_open_timeout (float): Upper bound of the open time, in seconds.
+        backoff_factor (float): Growth of the retry delay and of the open timeout.
+        on_ready (callable): Called without arguments when requests are allowed again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, wheel, failure_threshold=3, retry_delay=0.1, open_timeout=1.0, max_open_timeout=30.0,
+                 backoff_factor=2, on_ready=None):
+        self.name = name
+        self.wheel = wheel
+        self.failure_threshold = failure_threshold
+        self.retry_delay = retry_delay
+        self.open_timeout = open_timeout
+        self.max_open_timeout = max_open_timeout
+        self.backoff_factor = backoff_factor
+        self.on_ready = on_ready
+
+        self.state = self.CLOSED
+        self.failures = 0        # Failures in a row
+        self.opened = 0          # Times the breaker opened in a row
+        self._parked = False     # A failed delivery waits for its retry delay
+        self._trial = False      # The half-open trial request is on the wire
+        self._timer = None
+        self._timer_generation = 0  # A timer that fires after it was replaced or cancelled is ignored
+        self._wake_at = None
+        self._cond = threading.Condition()
+
+    def allow_request(self):
+        """
+        True if a request may be sent now. In the half-open state this takes the single trial slot,
+        so call it right before sending.
+        """
+        with self._cond:
+            if self.state == self.CLOSED:
+                return not self._parked
+            if self.state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def wait_ready(self, timeout):
+        """Block until a request may be sent (see allow_request) or the timeout expires."""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: (self.state == self.CLOSED and not self._parked) or (self.state == self.HALF_OPEN and not self._trial),
+                timeout)
+
+    def record_success(self):
+        """
+        Returns:
+            bool: True if this success closed the breaker.
+        """
+        with self._cond:
+            closed = self.state != self.CLOSED
+            self._cancel_timer()
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened = 0
+            self._parked = False
+            self._trial = False
+        if closed:
+            logging.info(f"Circuit breaker of {self.name} closed")
+            self._ready()
+        return closed
+
+    def record_failure(self):
+        with self._cond:
+            self.failures += 1
+            if self.state == self.OPEN:
+                # A request that was already on the wire when the breaker opened
+                return
+            self._trial = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._open(f"after {self.failures} failures")
+            elif not self._parked:
+                self._parked = True
+                self._set_timer(self.retry_delay * self.backoff_factor ** (self.failures - 1), self._unpark)
+
+    def trip(self):
+        """Open the breaker now (the failure detector says the secondary is down)."""
+        with self._cond:
+            if self.state != self.OPEN:
+                self._open("by the failure detector")
+
+    def try_now(self):
+        """Skip the rest of the open timeout and let a trial request through (the secondary is back)."""
+        with self._cond:
+            if self.state != self.OPEN:
+                return
+            self._cancel_timer()
+            self.state = self.HALF_OPEN
+            self._trial = False
+        self._ready()
+
+    def reset(self):
+        """Close the breaker and forget the failures (the secondary was reached some other way)."""
+        self.record_success()
+
+    def _open(self, reason):
+        # Called with the condition held
+        self._cancel_timer()
+        self.state = self.OPEN
+        self._parked = False
+        self.opened += 1
+        timeout = min(self.open_timeout * self.backoff_factor ** (self.opened - 1), self.max_open_timeout)
+        logging.warning(f"Circuit breaker of {self.name} open for {timeout:g}s {reason}")
+        self._set_timer(timeout, self._half_open)
+
+    def _half_open(self, generation):
+        with self._cond:
+            if generation != self._timer_generation or self.state != self.OPEN:
+                return
+            self._timer = None
+            self._wake_at = None
+            self.state = self.HALF_OPEN
+            self._trial = False
+        self._ready()
+
+    def _unpark(self, generation):
+        with self._cond:
+            if generation != self._timer_generation:
+                return
+            self._timer = None
+            self._wake_at = None
+            self._parked = False
+        self._ready()
+
+    def _set_timer(self, delay, callback):
+        # Called with the condition held
+        self._timer_generation += 1
+        generation = self._timer_generation
+        self._wake_at = time.monotonic() + delay
+        self._timer = self.wheel.schedule(delay, lambda: callback(generation))
+
+    def _cancel_timer(self):
+        # Called with the condition held
+        self._timer_generation += 1
+        if self._timer is not None:
+            self.wheel.cancel(self._timer)
+            self._timer = None
+        self._wake_at = None
+
+    def _ready(self):
+        with self._cond:
+            self._cond.notify_all()
+        if self.on_ready:
+            self.on_ready()
+
+    def status(self):
+        with self._cond:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'parked': self._parked,
+                'retry_in': max(0, round(self._wake_at - time.monotonic(), 3)) if self._wake_at else 0,
+            }
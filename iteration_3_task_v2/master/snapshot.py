@@ -0,0 +1,164 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+SNAPSHOT_PREFIX = 'snapshot-'
+DATA_FILE = 'snapshots.jsonl.gz'
+MANIFEST_SUFFIX = '.json'
+COPY_CHUNK_BYTES = 1024 * 1024
+
+
+class SnapshotStore:
+    """
+    Snapshots of the master's log: a compressed image of every message up to a sequence number.
+
+    All snapshots share one data file of gzip-compressed JSON lines `[sequence_number, message]`.
+    A new snapshot appends one gzip member with the records logged since the previous one (gzip
+    readers read concatenated members as one stream), so the previous snapshot is never copied or
+    decompressed again. A snapshot is the first `bytes` bytes of the file: everything from the first
+    message ever logged up to `last_seq`, which still covers the part of the log truncated since.
+    Its manifest holds that length and the SHA-256 checksum of those bytes.
+
+    The manifest is written after the member is fsynced, to a temporary name that is renamed,
+    and whatever follows the latest snapshot in the data file (a member a crash cut short) is
+    cut off before the next member is appended, so a half-written snapshot is never served.
+
+    Args:
+        directory (str): Folder that holds the snapshot files.
+        log_store (SegmentedLog): The master's log.
+        keep (int): Number of snapshots kept on disk, older ones are deleted.
+    """
+
+    def __init__(self, directory, log_store, keep=2):
+        self.directory = os.path.abspath(directory)
+        self.log_store = log_store
+        self.keep = max(1, keep)
+        self._lock = threading.Lock()  # One snapshot at a time
+
+        os.makedirs(directory, exist_ok=True)
+        manifests = self._manifests()
+        self._latest = manifests[-1] if manifests else None
+        self._checksum = None  # SHA-256 of the latest snapshot's bytes, hashed again after a restart
+
+    def _manifests(self):
+        # Complete snapshots on disk, oldest first
+        size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        manifests = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith(SNAPSHOT_PREFIX) and name.endswith(MANIFEST_SUFFIX):
+                with open(os.path.join(self.directory, name)) as f:
+                    manifest = json.load(f)
+                if manifest['bytes'] <= size:
+                    manifests.append(manifest)
+        return manifests
+
+    def _name(self, last_seq):
+        return f"{SNAPSHOT_PREFIX}{last_seq:020d}"
+
+    @property
+    def data_path(self):
+        """Path of the data file the snapshots are prefixes of."""
+        return os.path.join(self.directory, DATA_FILE)
+
+    def read(self, manifest):
+        """
+        Stream the bytes of a snapshot: the start of the data file, up to where the snapshot ends.
+        A snapshot taken meanwhile only appends behind it.
+
+        Yields:
+            bytes: Chunks of the snapshot.
+        """
+        remaining = manifest['bytes']
+        with open(self.data_path, 'rb') as f:
+            while remaining > 0:
+                chunk = f.read(min(COPY_CHUNK_BYTES, remaining))
+                if not chunk:
+                    raise RuntimeError(f"The snapshot data file is shorter than the snapshot up to {manifest['last_seq']}")
+                remaining -= len(chunk)
+                yield chunk
+
+    def _hash_latest(self):
+        # The checksum to continue from, hashed from the file once after a restart
+        checksum = hashlib.sha256()
+        if self._latest is not None:
+            for chunk in self.read(self._latest):
+                checksum.update(chunk)
+            if f"sha256:{checksum.hexdigest()}" != self._latest['checksum']:
+                raise RuntimeError(f"The snapshot up to {self._latest['last_seq']} does not match its checksum")
+        return checksum
+
+    @property
+    def latest(self):
+        """Manifest of the newest snapshot, or None if there is none."""
+        return self._latest
+
+    def take(self, upto=None):
+        """
+        Write a snapshot of the log up to `upto` (by default everything that is durable).
+
+        Returns:
+            dict: The manifest of the new snapshot (or of the latest one if it already covers `upto`).
+
+        Raises:
+            RuntimeError: If the records between the latest snapshot and the log are missing.
+        """
+        with self._lock:
+            upto = self.log_store.durable_seq if upto is None else min(upto, self.log_store.durable_seq)
+            latest = self._latest
+            if upto < 0 or (latest is not None and latest['last_seq'] >= upto):
+                return latest
+
+            start = latest['last_seq'] + 1 if latest else 0
+            if start < self.log_store.first_seq:
+                raise RuntimeError(f"The log starts at {self.log_store.first_seq}, records from {start} are missing")
+
+            started_at = time.time()
+            if self._checksum is None:
+                self._checksum = self._hash_latest()
+            checksum = self._checksum.copy()
+            member_start = latest['bytes'] if latest else 0
+            records = latest['records'] if latest else 0
+            with open(self.data_path, 'r+b' if os.path.exists(self.data_path) else 'w+b') as raw:
+                raw.truncate(member_start)  # What a failed snapshot left behind the latest one
+                raw.seek(member_start)
+                # mtime=0 keeps the bytes of a snapshot independent of when it was written
+                with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as out:
+                    for record in self.log_store.iter_range(start, upto + 1):
+                        out.write((json.dumps([record['sequence_number'], record['message']]) + '\n').encode('utf-8'))
+                        records += 1
+                raw.flush()
+                os.fsync(raw.fileno())
+                size = raw.tell()
+                raw.seek(member_start)
+                for chunk in iter(lambda: raw.read(COPY_CHUNK_BYTES), b''):
+                    checksum.update(chunk)
+
+            manifest = {
+                'last_seq': upto,
+                'records': records,
+                'bytes': size,
+                'checksum': f"sha256:{checksum.hexdigest()}",
+                'created_at': time.time(),
+            }
+            name = self._name(upto)
+            manifest_path = os.path.join(self.directory, name + MANIFEST_SUFFIX)
+            with open(manifest_path + '.tmp', 'w') as f:
+                json.dump(manifest, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(manifest_path + '.tmp', manifest_path)
+
+            self._latest, self._checksum = manifest, checksum
+            self._prune()
+            logging.info(f"Snapshot up to {upto} written: {records} records, {manifest['bytes']} bytes "
+                         f"in {time.time() - started_at:.2f}s")
+            return manifest
+
+    def _prune(self):
+        # Older snapshots are prefixes of the data file, only their manifests go
+        for manifest in self._manifests()[:-self.keep]:
+            os.remove(os.path.join(self.directory, self._name(manifest['last_seq']) + MANIFEST_SUFFIX))
@@ -0,0 +1,64 @@
+import json
+import threading
+
+
+def post_bulk(client, body, w=1, content_type='application/json'):
+    return client.post(f'/messages/bulk?w={w}', data=body, content_type=content_type)
+
+
+def messages_in(master, first, last):
+    return [record['message'] for record in master.partitions[0].log.read_range(first, last + 1)]
+
+
+def test_block_gets_a_contiguous_range(master):
+    response = post_bulk(master.app.test_client(), json.dumps(['a', 'b', 'c']))
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['count'] == 3
+    assert body['last_sequence_number'] - body['first_sequence_number'] == 2
+    assert messages_in(master, body['first_sequence_number'], body['last_sequence_number']) == ['a', 'b', 'c']
+
+
+def test_concurrent_writes_never_land_inside_a_block(master):
+    blocks = {}
+
+    def bulk(number):
+        messages = [f"block{number}-{i}" for i in range(20)]
+        blocks[number] = (messages, post_bulk(master.app.test_client(), json.dumps(messages)).get_json())
+
+    def single(number):
+        client = master.app.test_client()
+        for i in range(20):
+            client.post('/messages', json={'message': f"single{number}-{i}", 'w': 1})
+
+    threads = [threading.Thread(target=bulk, args=(n,)) for n in range(4)]
+    threads += [threading.Thread(target=single, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    for messages, body in blocks.values():
+        assert messages_in(master, body['first_sequence_number'], body['last_sequence_number']) == messages
+
+
+def test_block_with_a_bad_message_logs_nothing(master):
+    client = master.app.test_client()
+    log = master.partitions[0].log
+    for body, content_type in ((b'["a", "\\ud800", "b"]', 'application/json'),
+                               (b'["a", "", "b"]', 'application/json'),
+                               (b'["a", 3, "b"]', 'application/json'),
+                               (b'"a"\n""\n"b"\n', 'application/x-ndjson')):
+        next_seq = log.next_seq
+        response = post_bulk(client, body, content_type=content_type)
+        assert response.status_code == 400
+        assert response.get_json()['index'] == 1
+        assert log.next_seq == next_seq
+
+
+def test_bad_block_requests(master):
+    client = master.app.test_client()
+    assert post_bulk(client, b'[]').status_code == 400
+    assert post_bulk(client, b'{"message": "a"}').status_code == 400
+    assert post_bulk(client, b'not json').status_code == 400
+    assert post_bulk(client, b'["a"]', w='x').status_code == 400
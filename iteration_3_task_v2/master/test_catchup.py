@@ -0,0 +1,100 @@
+import time
+
+import pytest
+import requests
+
+from catchup import CatchUpManager
+from wal import SegmentedLog
+
+
+class Response:
+    status_code = 200
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class Secondary:
+    """A /replicate_batch that applies records in order, and goes down after `up_for` batches."""
+
+    def __init__(self, last_applied=-1, up_for=None):
+        self.last_applied = last_applied
+        self.up_for = up_for
+        self.batches = []
+
+    def post_batch(self, secondary, records):
+        if self.up_for is not None and len(self.batches) >= self.up_for:
+            raise requests.ConnectionError('secondary is down')
+        self.batches.append([r['sequence_number'] for r in records])
+        for record in records:
+            if record['sequence_number'] == self.last_applied + 1:
+                self.last_applied += 1
+        return Response({'status': 'ACK', 'last_applied': self.last_applied})
+
+
+@pytest.fixture
+def log(tmp_path):
+    log = SegmentedLog(str(tmp_path), fsync=False)
+    for n in range(10):
+        log.append({'sequence_number': n, 'message': f"m{n}"})
+    yield log
+    log.close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+
+
+def finished(stream):
+    stream._thread.join(5)
+    return stream.progress()
+
+
+def manager(log, secondary, acks, **kwargs):
+    return CatchUpManager(log, None, lambda url, last_applied: acks.append(last_applied), chunk_records=3,
+                          wire=secondary, **kwargs)
+
+
+def test_stream_sends_the_missed_range_in_chunks(log):
+    secondary, acks = Secondary(last_applied=3), []
+    progress = finished(manager(log, secondary, acks).sync('http://s1', 3))
+    assert secondary.batches == [[4, 5, 6], [7, 8, 9]]
+    assert acks == [6, 9]
+    assert progress['state'] == 'done' and progress['remaining'] == 0 and progress['sent'] == 6
+
+
+def test_interrupted_stream_resumes_where_the_secondary_is(log):
+    secondary, acks, finishes = Secondary(up_for=2), [], []
+    catch_up = manager(log, secondary, acks, on_finish=lambda stream: finishes.append(stream.state))
+    stream = catch_up.sync('http://s1', -1)
+    progress = finished(stream)
+    assert progress['state'] == 'interrupted' and progress['last_applied'] == 5
+    assert stream.cursor == 6  # Kept for the next /sync
+
+    secondary.up_for = None
+    assert catch_up.sync('http://s1', 5) is stream  # The same stream, resumed
+    progress = finished(stream)
+    assert secondary.batches == [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]  # Nothing sent twice
+    assert progress['state'] == 'done' and progress['start'] == 0 and progress['sent'] == 10
+    assert finishes == ['interrupted', 'done']
+
+
+def test_stream_follows_a_secondary_that_is_further_behind(log):
+    secondary, acks = Secondary(last_applied=-1), []
+    progress = finished(manager(log, secondary, acks).sync('http://s1', 5))  # It claimed more than it has
+    assert secondary.batches[0] == [6, 7, 8]
+    assert secondary.batches[1] == [0, 1, 2]  # Back to its last_applied + 1
+    assert secondary.last_applied == 9 and progress['state'] == 'done'
+
+
+def test_sync_of_a_running_stream_returns_it(log):
+    catch_up = manager(log, Secondary(), [])
+    stream = catch_up.sync('http://s1', -1)
+    stream._thread.join(5)
+    stream.state = 'running'  # As if it were still on the wire
+    assert catch_up.sync('http://s1', 7) is stream
+    assert stream.cursor == 10
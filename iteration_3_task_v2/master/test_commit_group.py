@@ -0,0 +1,30 @@
+def write(*messages, w=2):
+    return {'messages': list(messages), 'write_concern': w, 'trace_id': None}
+
+
+def test_bad_message_fails_only_its_own_write(master):
+    partition = master.partitions[0]
+    first = partition.log.next_seq
+    pending = partition.ack_tracker.pending
+
+    results = master.commit_group(partition, [write('before'), write('\ud800'), write('x', 'y'), write('after')])
+
+    assert isinstance(results[1], master.WriteFailed)
+    assert results[1].sequence_number is None  # Nothing of it was logged
+    assert [(r['sequence_number'], r['last_seq']) for r in (results[0], results[2], results[3])] == [
+        (first, first), (first + 1, first + 2), (first + 3, first + 3)]
+    assert [r['message'] for r in partition.log.read_range(first)] == ['before', 'x', 'y', 'after']
+    # A waiter for every write that was logged, none for the failed one
+    assert partition.ack_tracker.pending == pending + 3
+    for result in (results[0], results[2], results[3]):
+        partition.ack_tracker.wait(result['last_seq'], result['waiter'], timeout=0)
+    assert partition.ack_tracker.pending == pending
+
+
+def test_message_that_is_not_utf8_is_refused(master):
+    client = master.app.test_client()
+    first = master.partitions[0].log.next_seq
+    response = client.post('/messages', data=b'{"message": "\\ud800", "w": 1}', content_type='application/json')
+    assert response.status_code == 400
+    assert master.partitions[0].log.next_seq == first
+    assert client.post('/messages', json={'message': 'ok', 'w': 1}).get_json()['sequence_number'] == first
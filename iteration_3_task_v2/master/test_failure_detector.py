@@ -0,0 +1,80 @@
+import threading
+import time
+
+import requests
+
+from failure_detector import HealthMonitor, PhiAccrualDetector
+
+
+def test_regular_heartbeats_keep_phi_low():
+    detector = PhiAccrualDetector(first_interval=1.0, now=0.0)
+    for now in range(1, 20):
+        detector.heartbeat(now=float(now))
+    assert detector.phi(now=19.5) < 1
+    assert detector.is_available(now=20.5)
+
+
+def test_phi_grows_with_the_silence():
+    detector = PhiAccrualDetector(first_interval=1.0, now=0.0)
+    for now in range(1, 20):
+        detector.heartbeat(now=float(now))
+    phis = [detector.phi(now=19.0 + silence) for silence in (1, 2, 3, 5)]
+    assert phis == sorted(phis)
+    assert not detector.is_available(now=30.0)
+
+
+def test_node_that_never_answers_becomes_suspect():
+    detector = PhiAccrualDetector(first_interval=1.0, acceptable_pause=1.0, now=100.0)
+    assert detector.is_available(now=100.5)
+    assert not detector.is_available(now=110.0)
+    assert detector.seconds_since_heartbeat(now=110.0) is None
+
+
+class FakeProbes:
+    """Stands in for the SessionPool of the probes."""
+
+    def __init__(self, up):
+        self.up = up
+
+    def get(self, secondary, path, **kwargs):
+        if not self.up:
+            raise requests.ConnectionError()
+        response = requests.Response()
+        response.status_code = 200
+        return response
+
+
+def test_monitor_reports_a_secondary_that_is_down_from_the_start():
+    changes = []
+    changed = threading.Event()
+
+    def on_change(secondary, available):
+        changes.append((secondary, available))
+        changed.set()
+
+    monitor = HealthMonitor(FakeProbes(up=False), interval=0.05, threshold=3, acceptable_pause=0.05, on_change=on_change)
+    monitor.add('http://down')
+    try:
+        assert changed.wait(5)
+        assert changes == [('http://down', False)]
+        assert monitor.status()['http://down']['last_probe']['error'] == 'ConnectionError'
+    finally:
+        monitor.remove('http://down')
+
+
+def test_monitor_keeps_a_secondary_that_answers_available():
+    changes = []
+    monitor = HealthMonitor(FakeProbes(up=True), interval=0.05, threshold=3, acceptable_pause=0.05,
+                            on_change=lambda secondary, available: changes.append(available))
+    monitor.add('http://up')
+    try:
+        time.sleep(0.5)
+        assert monitor.is_available('http://up')
+        assert changes == []
+    finally:
+        monitor.remove('http://up')
+
+
+def test_probes_do_not_share_the_replication_connections(master):
+    assert master.health_monitor.http is master.probe_pool
+    assert master.probe_pool is not master.http_pool
@@ -0,0 +1,82 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from http_pool import SessionPool
+
+
+class Ok(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def secondary():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Ok)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_requests_reuse_the_connections(secondary):
+    pool = SessionPool(pool_size=2)
+    for _ in range(5):
+        assert pool.get(secondary, '/health').status_code == 200
+    stats = pool.stats()[secondary]
+    assert (stats['requests'], stats['errors'], stats['connections_opened']) == (5, 0, 1)
+
+
+def test_errors_are_counted():
+    pool = SessionPool(connect_timeout=0.2, read_timeout=0.2)
+    with pytest.raises(requests.RequestException):
+        pool.get('http://127.0.0.1:1', '/health')
+    assert pool.stats()['http://127.0.0.1:1']['errors'] == 1
+
+
+def test_concurrent_requests_are_all_counted(secondary):
+    pool = SessionPool(pool_size=4)
+
+    def send():
+        for _ in range(25):
+            pool.get(secondary, '/health')
+
+    threads = [threading.Thread(target=send) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert pool.stats()[secondary]['requests'] == 200
+
+
+def test_close_while_requests_are_sent(secondary):
+    pool = SessionPool(pool_size=4)
+    errors = []
+
+    def send():
+        for _ in range(50):
+            try:
+                pool.get(secondary, '/health')
+            except requests.RequestException:
+                pass  # The session was closed under the request
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=send) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for _ in range(20):
+        pool.close(secondary)
+        pool.stats()
+    for thread in threads:
+        thread.join(10)
+    assert errors == []
@@ -0,0 +1,168 @@
+import hashlib
+import time
+
+from idempotency import IdempotencyKeys
+
+
+def test_first_request_claims_the_key():
+    keys = IdempotencyKeys()
+    entry, claimed = keys.begin('k', 'f1')
+    assert claimed and entry['state'] == IdempotencyKeys.PENDING
+
+
+def test_retry_while_pending_is_not_claimed():
+    keys = IdempotencyKeys()
+    keys.begin('k', 'f1')
+    entry, claimed = keys.begin('k', 'f1')
+    assert not claimed and entry['state'] == IdempotencyKeys.PENDING  # 409
+
+
+def test_key_with_another_request_is_not_claimed():
+    keys = IdempotencyKeys()
+    entry, _ = keys.begin('k', 'f1')
+    keys.finish('k', entry, status_code=200, body={})
+    entry, claimed = keys.begin('k', 'f2')
+    assert not claimed and entry['fingerprint'] == 'f1'  # 422
+    assert keys.replayed == 0
+
+
+def test_finished_write_is_replayed():
+    keys = IdempotencyKeys()
+    entry, _ = keys.begin('k', 'f1')
+    keys.finish('k', entry, status_code=200, body={'sequence_number': 4})
+    entry, claimed = keys.begin('k', 'f1')
+    assert not claimed and entry['state'] == IdempotencyKeys.DONE and entry['body'] == {'sequence_number': 4}
+    assert keys.replayed == 1
+
+
+def test_resumable_write_is_claimed_again():
+    keys = IdempotencyKeys()
+    entry, _ = keys.begin('k', 'f1')
+    keys.finish('k', entry, status_code=500, body={}, resumable=True)
+    entry, claimed = keys.begin('k', 'f1')
+    assert claimed and entry['status_code'] == 500
+
+
+def test_discarded_key_runs_again():
+    keys = IdempotencyKeys()
+    keys.begin('k', 'f1')
+    keys.discard('k')
+    assert keys.begin('k', 'f1')[1]
+
+
+def test_least_recently_used_keys_are_evicted():
+    keys = IdempotencyKeys(max_entries=2)
+    for key in ('a', 'b'):
+        keys.finish(key, keys.begin(key, key)[0], status_code=200, body={})
+    keys.begin('a', 'a')  # Used again, so 'b' is the least recently used
+    keys.begin('c', 'c')
+    assert len(keys) == 2
+    assert keys.begin('b', 'b')[1]
+
+
+def test_keys_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    keys = IdempotencyKeys(ttl=10)
+    keys.finish('k', keys.begin('k', 'f1')[0], status_code=200, body={})
+    now[0] += 5
+    assert not keys.begin('k', 'f1')[1]
+    now[0] += 10
+    assert keys.begin('k', 'f1')[1]
+
+
+def post(client, body, key):
+    return client.post('/messages', data=body, content_type='application/json', headers={'Idempotency-Key': key})
+
+
+def test_endpoint_replays_a_logged_write(master):
+    client = master.app.test_client()
+    first = post(client, b'{"message": "replay", "w": 1}', 'replay')
+    retry = post(client, b'{"message": "replay", "w": 1}', 'replay')
+    assert first.status_code == retry.status_code == 200
+    assert retry.get_json() == first.get_json()
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert 'Idempotent-Replayed' not in first.headers
+
+
+def test_endpoint_refuses_the_key_with_another_request(master):
+    client = master.app.test_client()
+    post(client, b'{"message": "one", "w": 1}', 'other')
+    response = post(client, b'{"message": "two", "w": 1}', 'other')
+    assert response.status_code == 422
+
+
+def test_endpoint_refuses_a_retry_while_the_write_runs(master):
+    body = b'{"message": "slow", "w": 1}'
+    fingerprint = hashlib.blake2b(b'/messages?', digest_size=16)
+    fingerprint.update(body)
+    master.idempotency_keys.begin('pending', fingerprint.hexdigest())  # The first request is still running
+    response = post(master.app.test_client(), body, 'pending')
+    assert response.status_code == 409
+
+
+def test_endpoint_waits_again_for_an_unmet_write_concern(master):
+    client = master.app.test_client()
+    body = b'{"message": "unmet", "w": 2, "timeout": 0.01}'
+    first = post(client, body, 'unmet')
+    assert first.status_code == 500
+    sequence_number = first.get_json()['sequence_number']
+
+    master.partitions[0].ack_tracker.ack('http://secondary', sequence_number)
+    retry = post(client, body, 'unmet')
+    assert retry.status_code == 200
+    assert retry.get_json()['sequence_number'] == sequence_number
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+
+
+def test_endpoint_without_a_key_logs_every_request(master):
+    client = master.app.test_client()
+    numbers = [client.post('/messages', json={'message': 'again', 'w': 1}).get_json()['sequence_number'] for _ in range(2)]
+    assert numbers[0] != numbers[1]
+
+
+def test_endpoint_keeps_the_key_of_a_block_that_failed_half_logged(master, monkeypatch):
+    log = master.partitions[0].log
+    append = log.append
+
+    def append_once(record):
+        if record['message'] == 'second':
+            raise OSError('disk full')
+        return append(record)
+
+    monkeypatch.setattr(log, 'append', append_once)
+    client = master.app.test_client()
+    body = b'["first", "second"]'
+    headers = {'Idempotency-Key': 'half'}
+    first = client.post('/messages/bulk', data=body, content_type='application/json', headers=headers)
+    assert first.status_code == 500
+    assert first.get_json()['first_sequence_number'] == log.last_seq
+
+    next_seq = log.next_seq
+    retry = client.post('/messages/bulk', data=body, content_type='application/json', headers=headers)
+    assert retry.get_json() == first.get_json()
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert log.next_seq == next_seq  # "first" is not logged a second time
+
+
+def test_endpoint_keeps_the_key_of_a_write_that_failed_after_it_was_logged(master, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('lost the fsync')
+
+    log = master.partitions[0].log
+    monkeypatch.setattr(log, 'wait_durable', fail)
+    client = master.app.test_client()
+    first = post(client, b'{"message": "logged then failed", "w": 1}', 'failed')
+    assert first.status_code == 500
+    assert first.get_json()['sequence_number'] == log.last_seq
+
+    next_seq = log.next_seq
+    retry = post(client, b'{"message": "logged then failed", "w": 1}', 'failed')
+    assert retry.status_code == 500 and retry.get_json() == first.get_json()
+    assert log.next_seq == next_seq
+
+
+def test_endpoint_discards_the_key_of_a_write_that_logged_nothing(master):
+    client = master.app.test_client()
+    assert post(client, b'{"message": "", "w": 1}', 'nothing').status_code == 400
+    assert post(client, b'{"message": "", "w": 1}', 'nothing').headers.get('Idempotent-Replayed') is None
@@ -0,0 +1,54 @@
+import pytest
+
+from wal import SegmentedLog
+
+
+@pytest.fixture
+def client(tmp_path, master, monkeypatch):
+    # The master's reads, on a log of ten messages 'a' to 'j'
+    log = SegmentedLog(str(tmp_path), fsync=False)
+    for n, message in enumerate('abcdefghij'):
+        log.append({'sequence_number': n, 'message': message})
+    monkeypatch.setattr(master.partitions[0], 'log', log)
+    yield master.app.test_client()
+    log.close()
+
+
+def test_range_read(client):
+    response = client.get('/messages?since=2&until=5')
+    assert response.get_json() == {'messages': ['c', 'd', 'e'], 'next_since': 5, 'high_watermark': 9}
+    assert response.headers['X-Next-Since'] == '5' and response.headers['X-High-Watermark'] == '9'
+    assert client.get('/messages').get_json()['messages'] == list('abcdefghij')
+
+
+def test_incremental_reads_follow_next_since(client, master):
+    body = client.get('/messages?since=6&limit=3').get_json()
+    assert body['messages'] == ['g', 'h', 'i'] and body['next_since'] == 9
+    body = client.get(f"/messages?since={body['next_since']}&limit=3").get_json()
+    assert body['messages'] == ['j'] and body['next_since'] == 10
+    assert client.get('/messages?since=10').get_json() == {'messages': [], 'next_since': 10, 'high_watermark': 9}
+
+    master.partitions[0].log.append({'sequence_number': 10, 'message': 'k'})
+    assert client.get('/messages?since=10').get_json()['messages'] == ['k']
+
+
+def test_unchanged_log_is_not_modified(client, master):
+    first = client.get('/messages?since=8')
+    etag = first.headers['ETag']
+    again = client.get('/messages?since=8', headers={'If-None-Match': etag})
+    assert again.status_code == 304 and again.headers['X-High-Watermark'] == '9'
+
+    master.partitions[0].log.append({'sequence_number': 10, 'message': 'k'})
+    changed = client.get('/messages?since=8', headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+    assert changed.get_json()['messages'] == ['i', 'j', 'k']
+
+
+def test_point_read(client):
+    assert client.get('/messages/3').get_json() == {'sequence_number': 3, 'message': 'd'}
+    assert client.get('/messages/10').status_code == 404
+
+
+@pytest.mark.parametrize('query', ['since=-1', 'until=x', 'limit=1.5', 'partition=7', 'partition=-1'])
+def test_bad_range_is_refused_with_400(client, query):
+    assert client.get(f"/messages?{query}").status_code == 400
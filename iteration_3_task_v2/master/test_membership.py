@@ -0,0 +1,44 @@
+import pytest
+
+from membership import MemberList, normalize_url
+
+
+def test_normalize_url():
+    assert normalize_url('http://secondary1:5001/') == 'http://secondary1:5001'
+    for url in ('secondary1:5001', '', None, 5001):
+        with pytest.raises(ValueError):
+            normalize_url(url)
+
+
+def test_members_survive_a_restart(tmp_path):
+    path = str(tmp_path / 'members.json')
+    members = MemberList(path, seeds=['http://s1:5001/', 'http://s2:5002'])
+    assert members.urls() == ['http://s1:5001', 'http://s2:5002']
+    assert members.add('http://s3:5003')
+    assert not members.add('http://s3:5003')
+    assert members.remove('http://s1:5001')
+    assert not members.remove('http://s1:5001')
+
+    # The file is the source of truth from now on, the seeds are ignored
+    members = MemberList(path, seeds=['http://s1:5001'])
+    assert members.urls() == ['http://s2:5002', 'http://s3:5003']
+
+
+@pytest.mark.parametrize('last_applied', [-5, True, '3', 1.5, [1]])
+def test_register_refuses_a_bad_position(master, last_applied):
+    response = master.app.test_client().post('/members', json={'url': 'http://127.0.0.1:9', 'last_applied': last_applied})
+    assert response.status_code == 400
+    assert 'http://127.0.0.1:9' not in master.members
+
+
+def test_register_and_deregister(master):
+    client = master.app.test_client()
+    assert client.post('/members', json={'url': 'not a url'}).status_code == 400
+    try:
+        assert client.post('/members', json={'url': 'http://127.0.0.1:9/', 'last_applied': -1}).status_code == 201
+        assert client.post('/members', json={'url': 'http://127.0.0.1:9'}).status_code == 200
+        assert 'http://127.0.0.1:9' in [member['url'] for member in client.get('/members').get_json()['members']]
+    finally:
+        assert client.delete('/members', json={'url': 'http://127.0.0.1:9'}).status_code == 200
+    assert client.delete('/members', json={'url': 'http://127.0.0.1:9'}).status_code == 404
+    assert 'http://127.0.0.1:9' not in master.members
@@ -0,0 +1,57 @@
+import pytest
+
+from partitions import partition_for
+
+
+def test_key_always_goes_to_the_same_partition():
+    assert partition_for('user-42', 8) == partition_for('user-42', 8)
+    assert {partition_for(f"user-{n}", 8) for n in range(200)} == set(range(8))
+
+
+@pytest.mark.parametrize('body', [
+    b'not json',
+    b'["a list"]',
+    b'{"w": 1}',
+    b'{"message": "m", "w": "two"}',
+    b'{"message": "m", "w": null}',
+    b'{"message": "m", "w": 1.5}',
+    b'{"message": "m", "timeout": "soon"}',
+    b'{"message": "m", "key": 7}',
+])
+def test_bad_write_is_refused_with_400(master, body):
+    next_seq = master.partitions[0].log.next_seq
+    response = master.app.test_client().post('/messages', data=body, content_type='application/json')
+    assert response.status_code == 400
+    assert response.get_json()['status'] == 'error'
+    assert master.partitions[0].log.next_seq == next_seq
+
+
+def test_bad_write_concern_is_refused_like_on_the_bulk_path(master):
+    client = master.app.test_client()
+    single = client.post('/messages', json={'message': 'm', 'w': 'two'})
+    bulk = client.post('/messages/bulk?w=two', json=['m'])
+    assert single.status_code == bulk.status_code == 400
+    assert single.get_json()['message'] == bulk.get_json()['message'] == 'w must be an integer'
+
+
+@pytest.mark.parametrize('payload', [
+    None,
+    {'from': 'http://secondary1:5001'},
+    {'positions': ['http://secondary3:5003', 41]},
+    {'positions': {'http://secondary3:5003': 'forty-one'}},
+    {'positions': {'http://secondary3:5003': -2}},
+    {'positions': {'http://secondary3:5003': True}},
+    {'positions': {'http://secondary3:5003': 41, 'http://secondary4:5004': 4.5}},
+])
+def test_bad_acks_are_refused_with_400(master, payload):
+    response = master.app.test_client().post('/acks', json=payload)
+    assert response.status_code == 400
+
+
+def test_acks_of_descendants_are_counted(master, monkeypatch):
+    acked = []
+    monkeypatch.setattr(master, 'on_ack', lambda url, last_applied: acked.append((url, last_applied)))
+    response = master.app.test_client().post('/acks', json={'from': 'http://secondary1:5001', 'positions': {
+        'http://secondary3:5003': 41, 'http://secondary4:5004/': -1}})
+    assert response.status_code == 200 and response.get_json()['positions'] == 2
+    assert acked == [('http://secondary3:5003', 41), ('http://secondary4:5004', -1)]
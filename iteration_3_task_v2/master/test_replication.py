@@ -0,0 +1,78 @@
+import threading
+
+from replication import AckTracker
+
+
+def register(tracker, seq, w):
+    # Like the master: w counts the master itself, which has the message logged already
+    return tracker.register(seq, w - 1)
+
+
+def test_w1_is_met_by_the_master_alone():
+    tracker = AckTracker()
+    waiter = register(tracker, 0, 1)
+    assert tracker.wait(0, waiter, timeout=0)
+    assert tracker.pending == 0
+
+
+def test_w_counts_the_master_and_the_secondaries():
+    tracker = AckTracker()
+    waiter = register(tracker, 0, 3)
+    tracker.ack('http://s1', 0)
+    assert not waiter.done.is_set()
+    tracker.ack('http://s1', 0)  # The same secondary again is not a second ACK
+    assert not waiter.done.is_set()
+    tracker.ack('http://s2', 0)
+    assert tracker.wait(0, waiter, timeout=0)
+    assert waiter.secondaries == {'http://s1', 'http://s2'}
+
+
+def test_cumulative_ack_covers_every_message_up_to_it():
+    tracker = AckTracker()
+    waiters = {seq: register(tracker, seq, 2) for seq in range(3)}
+    tracker.ack('http://s1', 1)
+    assert [waiters[seq].done.is_set() for seq in range(3)] == [True, True, False]
+    tracker.ack('http://s1', 2)
+    assert waiters[2].done.is_set()
+
+
+def test_late_registration_counts_the_positions_already_acked():
+    tracker = AckTracker()
+    tracker.ack('http://s1', 5)
+    tracker.ack('http://s2', 3)
+    assert register(tracker, 4, 2).done.is_set()
+    assert not register(tracker, 4, 3).done.is_set()
+    assert register(tracker, 3, 3).done.is_set()
+
+
+def test_position_going_back_does_not_uncount():
+    tracker = AckTracker()
+    waiter = register(tracker, 2, 3)
+    tracker.ack('http://s1', 2)
+    tracker.ack('http://s1', -1)  # The secondary lost its log
+    assert tracker.position('http://s1') == -1
+    tracker.ack('http://s2', 2)
+    assert waiter.done.is_set()
+
+
+def test_wait_times_out_and_stops_tracking():
+    tracker = AckTracker()
+    waiter = register(tracker, 0, 2)
+    assert tracker.pending == 1
+    assert not tracker.wait(0, waiter, timeout=0.01)
+    assert tracker.pending == 0
+
+
+def test_wait_is_woken_by_an_ack():
+    tracker = AckTracker()
+    waiter = register(tracker, 0, 2)
+    threading.Timer(0.05, tracker.ack, args=('http://s1', 0)).start()
+    assert tracker.wait(0, waiter, timeout=5)
+
+
+def test_removed_secondary_is_forgotten():
+    tracker = AckTracker()
+    tracker.ack('http://s1', 3)
+    tracker.remove('http://s1')
+    assert tracker.position('http://s1') is None
+    assert not register(tracker, 0, 2).done.is_set()
@@ -0,0 +1,113 @@
+from retry import CircuitBreaker
+
+
+class ManualWheel:
+    """A TimerWheel whose timers fire only when the test says so."""
+
+    def __init__(self):
+        self.timers = {}
+        self._next_handle = 0
+
+    def schedule(self, delay, callback):
+        self._next_handle += 1
+        self.timers[self._next_handle] = (delay, callback)
+        return self._next_handle
+
+    def cancel(self, handle):
+        self.timers.pop(handle, None)
+
+    def delays(self):
+        return [delay for delay, _ in self.timers.values()]
+
+    def fire(self):
+        timers, self.timers = self.timers, {}
+        for _, callback in timers.values():
+            callback()
+
+
+def breaker(**kwargs):
+    wheel = ManualWheel()
+    ready = []
+    settings = dict(failure_threshold=3, retry_delay=0.1, open_timeout=1.0, max_open_timeout=3.0, backoff_factor=2)
+    settings.update(kwargs)
+    return CircuitBreaker('http://s1', wheel, on_ready=lambda: ready.append(True), **settings), wheel, ready
+
+
+def test_failures_below_the_threshold_park_with_backoff():
+    cb, wheel, ready = breaker()
+    assert cb.allow_request()
+    cb.record_failure()
+    assert cb.state == CircuitBreaker.CLOSED
+    assert not cb.allow_request()
+    assert wheel.delays() == [0.1]
+    wheel.fire()
+    assert cb.allow_request() and ready == [True]
+
+    cb.record_failure()
+    assert wheel.delays() == [0.2]
+    wheel.fire()
+    cb.record_success()
+    assert cb.status()['failures'] == 0
+
+
+def test_breaker_opens_then_half_opens_for_one_trial():
+    cb, wheel, ready = breaker()
+    for _ in range(2):
+        cb.record_failure()
+        wheel.fire()  # The retry delay
+    cb.record_failure()
+    assert cb.state == CircuitBreaker.OPEN
+    assert not cb.allow_request()
+    assert wheel.delays() == [1.0]
+
+    wheel.fire()
+    assert cb.state == CircuitBreaker.HALF_OPEN
+    assert cb.allow_request()
+    assert not cb.allow_request()  # The single trial slot is taken
+    assert cb.record_success()
+    assert cb.state == CircuitBreaker.CLOSED
+    assert cb.allow_request()
+
+
+def test_failed_trial_reopens_for_longer_up_to_the_max():
+    cb, wheel, _ = breaker(failure_threshold=1)
+    cb.record_failure()
+    assert wheel.delays() == [1.0]
+    for expected in (2.0, 3.0, 3.0):
+        wheel.fire()
+        assert cb.allow_request()
+        cb.record_failure()
+        assert cb.state == CircuitBreaker.OPEN
+        assert wheel.delays() == [expected]
+
+
+def test_failure_of_a_request_sent_before_the_breaker_opened_is_ignored():
+    cb, wheel, _ = breaker()
+    cb.trip()
+    cb.record_failure()
+    assert cb.state == CircuitBreaker.OPEN
+    assert cb.opened == 1
+    assert wheel.delays() == [1.0]
+
+
+def test_trip_and_try_now():
+    cb, wheel, ready = breaker()
+    cb.trip()
+    assert cb.state == CircuitBreaker.OPEN
+    cb.try_now()
+    assert cb.state == CircuitBreaker.HALF_OPEN
+    assert wheel.timers == {}  # The open timeout was cancelled
+    assert ready == [True]
+    assert cb.wait_ready(0)
+
+
+def test_timer_that_was_replaced_is_ignored():
+    cb, wheel, _ = breaker()
+    cb.record_failure()
+    _, stale_unpark = next(iter(wheel.timers.values()))
+    cb.trip()
+    stale_unpark()
+    assert cb.state == CircuitBreaker.OPEN
+    cb.reset()
+    assert cb.state == CircuitBreaker.CLOSED and cb.allow_request()
+    assert wheel.timers == {}
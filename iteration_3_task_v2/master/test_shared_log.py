@@ -0,0 +1,51 @@
+import multiprocessing
+
+from wal import RECORD_HEADER, SegmentedLog
+
+SEGMENT_BYTES = 8 * (RECORD_HEADER.size + 8)  # Small, so the workers roll over segments the others are appending to
+
+
+def append_as_worker(directory, worker, count):
+    log = SegmentedLog(directory, segment_bytes=SEGMENT_BYTES, fsync=False, shared=True)
+    for n in range(count):
+        with log.appending():
+            log.append({'sequence_number': log.next_seq, 'message': f"w{worker}-{n:05d}"})
+    log.close()
+
+
+def test_processes_get_distinct_contiguous_sequence_numbers(tmp_path):
+    directory = str(tmp_path)
+    workers, count = 4, 200
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=append_as_worker, args=(directory, worker, count)) for worker in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(30)
+        assert process.exitcode == 0
+
+    log = SegmentedLog(directory, segment_bytes=SEGMENT_BYTES, fsync=False, shared=True)
+    records = log.read_range(0)
+    assert [r['sequence_number'] for r in records] == list(range(workers * count))
+    messages = [r['message'] for r in records]
+    assert sorted(messages) == sorted(f"w{worker}-{n:05d}" for worker in range(workers) for n in range(count))
+    for worker in range(workers):
+        own = [m for m in messages if m.startswith(f"w{worker}-")]
+        assert own == sorted(own)  # Every worker's writes keep their order
+    log.close()
+
+
+def test_appending_picks_up_what_another_process_appended(tmp_path):
+    first = SegmentedLog(str(tmp_path), segment_bytes=SEGMENT_BYTES, fsync=False, shared=True)
+    second = SegmentedLog(str(tmp_path), segment_bytes=SEGMENT_BYTES, fsync=False, shared=True)
+    for n in range(20):
+        log = first if n % 3 else second
+        with log.appending():
+            log.append({'sequence_number': log.next_seq, 'message': f"m{n}"})
+
+    assert second.refresh() == 1 and first.refresh() == 0  # The last append was the first log's
+    for log in (first, second):
+        assert log.durable_seq == log.last_seq == 19
+        assert [r['message'] for r in log.read_range(0)] == [f"m{n}" for n in range(20)]
+    first.close()
+    second.close()
@@ -0,0 +1,112 @@
+import gzip
+import hashlib
+import json
+import os
+
+import pytest
+
+from snapshot import SnapshotStore
+from wal import RECORD_HEADER, SegmentedLog
+
+
+def append(log, *messages):
+    for message in messages:
+        log.append({'sequence_number': log.next_seq, 'message': message})
+
+
+def records(data):
+    return [json.loads(line) for line in gzip.decompress(data).decode('utf-8').splitlines()]
+
+
+def checksum(data):
+    return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+
+@pytest.fixture
+def log(tmp_path):
+    # Two records per segment, so truncate_prefix has sealed segments to drop
+    log = SegmentedLog(str(tmp_path / 'wal'), segment_bytes=2 * (RECORD_HEADER.size + 1), fsync=False)
+    yield log
+    log.close()
+
+
+def test_snapshot_holds_every_message_up_to_last_seq(tmp_path, log):
+    store = SnapshotStore(str(tmp_path / 'snapshots'), log)
+    assert store.take() is None  # Nothing logged yet
+    append(log, 'a', 'b', 'c')
+    manifest = store.take()
+    assert (manifest['last_seq'], manifest['records']) == (2, 3)
+
+    data = b''.join(store.read(manifest))
+    assert len(data) == manifest['bytes'] and checksum(data) == manifest['checksum']
+    assert records(data) == [[0, 'a'], [1, 'b'], [2, 'c']]
+    assert store.take() is manifest  # Already covers the log
+
+
+def test_next_snapshot_appends_to_the_previous_one(tmp_path, log):
+    store = SnapshotStore(str(tmp_path / 'snapshots'), log, keep=2)
+    append(log, 'a', 'b', 'c', 'd')
+    first = store.take()
+    before = b''.join(store.read(first))
+    assert log.truncate_prefix(first['last_seq']) == 2  # Records 0 and 1 are only in the snapshot now
+
+    append(log, 'e', 'f')
+    second = store.take()
+    data = b''.join(store.read(second))
+    assert data[:first['bytes']] == before  # The previous snapshot was not rewritten
+    assert checksum(data) == second['checksum']
+    assert records(data) == [[n, m] for n, m in enumerate('abcdef')]
+    assert b''.join(store.read(first)) == before  # Still served, it is a prefix of the data file
+
+    append(log, 'g')
+    store.take()
+    assert [m['last_seq'] for m in store._manifests()] == [5, 6]  # keep=2
+
+
+def test_missing_records_are_not_snapshotted(tmp_path, log):
+    append(log, 'a', 'b', 'c', 'd')
+    log.truncate_prefix(1)
+    with pytest.raises(RuntimeError):
+        SnapshotStore(str(tmp_path / 'snapshots'), log).take()
+
+
+def test_restart_cuts_off_a_half_written_member(tmp_path, log):
+    directory = str(tmp_path / 'snapshots')
+    append(log, 'a', 'b')
+    first = SnapshotStore(directory, log).take()
+    with open(os.path.join(directory, 'snapshots.jsonl.gz'), 'ab') as f:
+        f.write(b'\x1f\x8b\x08 cut short by a crash')
+
+    store = SnapshotStore(directory, log)  # A restart
+    assert store.latest == first
+    assert records(b''.join(store.read(first))) == [[0, 'a'], [1, 'b']]  # Served up to where it ends
+    append(log, 'c')
+    data = b''.join(store.read(store.take()))
+    assert checksum(data) == store.latest['checksum']
+    assert records(data) == [[0, 'a'], [1, 'b'], [2, 'c']]
+
+
+def test_compacted_read_is_gone_and_served_from_the_snapshot(tmp_path, master, monkeypatch):
+    log = SegmentedLog(str(tmp_path / 'wal'), segment_bytes=2 * (RECORD_HEADER.size + 1), fsync=False)
+    monkeypatch.setattr(master, 'full_log', log)
+    monkeypatch.setattr(master.partitions[0], 'log', log)
+    monkeypatch.setattr(master, 'snapshots', SnapshotStore(str(tmp_path / 'snapshots'), log))
+    monkeypatch.setattr(master, 'SNAPSHOT_RETAIN_RECORDS', 0)
+    append(log, *'abcde')
+    client = master.app.test_client()
+
+    response = client.post('/snapshot')
+    assert response.status_code == 201
+    assert response.get_json()['log_first_seq'] == log.first_seq == 4
+
+    gone = client.get('/messages?since=1')
+    assert gone.status_code == 410
+    assert gone.headers['X-First-Sequence'] == '4' and gone.get_json()['first_sequence_number'] == 4
+    assert client.get('/messages/1').status_code == 410
+    assert client.get('/messages?since=4').get_json()['messages'] == ['e']
+
+    download = client.get('/snapshot/latest')
+    assert download.headers['X-Snapshot-Last-Seq'] == '4'
+    assert download.headers['X-Snapshot-Checksum'] == checksum(download.data)
+    assert records(download.data) == [[n, m] for n, m in enumerate('abcde')]
+    log.close()
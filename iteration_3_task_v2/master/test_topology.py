@@ -0,0 +1,94 @@
+import pytest
+
+from membership import MemberList
+from topology import CHAIN, STAR, TREE, build_tree, depth, parents
+
+NODES = ['s1', 's2', 's3', 's4', 's5']
+S1, S2, S3, S4, S5 = (f"http://secondary{n}:{5000 + n}" for n in range(1, 6))
+
+
+def test_star():
+    assert build_tree(NODES, STAR) == {None: NODES, **{node: [] for node in NODES}}
+
+
+def test_chain():
+    tree = build_tree(NODES, CHAIN)
+    assert tree[None] == ['s1'] and tree['s1'] == ['s2'] and tree['s4'] == ['s5'] and tree['s5'] == []
+    assert [depth(tree, node) for node in NODES] == [1, 2, 3, 4, 5]
+
+
+def test_tree_is_filled_breadth_first():
+    tree = build_tree(NODES, TREE, fanout=2)
+    assert tree == {None: ['s1', 's2'], 's1': ['s3', 's4'], 's2': ['s5'], 's3': [], 's4': [], 's5': []}
+    assert parents(tree) == {'s1': None, 's2': None, 's3': 's1', 's4': 's1', 's5': 's2'}
+    assert depth(tree, 's5') == 2
+
+
+def test_unknown_topology():
+    with pytest.raises(ValueError):
+        build_tree(NODES, 'ring')
+
+
+class Replicator:
+    def __init__(self, url):
+        self.url = url
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+@pytest.fixture
+def cluster(tmp_path, master, monkeypatch):
+    # The master's membership and replication workers, in a tree of fanout 2
+    down = set()
+    started = []
+
+    def start_replicator(url):
+        started.append(url)
+        return Replicator(url)
+
+    monkeypatch.setattr(master, 'members', MemberList(str(tmp_path / 'members.json'), seeds=[S1, S2, S3, S4]))
+    monkeypatch.setattr(master, 'replicators', {})
+    monkeypatch.setattr(master, 'topology', build_tree([]))
+    monkeypatch.setattr(master, 'start_replicator', start_replicator)
+    monkeypatch.setattr(master.health_monitor, 'is_available', lambda url: url not in down)
+    monkeypatch.setattr(master, 'REPLICATION_TOPOLOGY', TREE)
+    monkeypatch.setattr(master, 'REPLICATION_FANOUT', 2)
+    return master, down, started
+
+
+def test_rebuild_runs_workers_only_for_the_master_children(cluster):
+    master, _, started = cluster
+    master.rebuild_topology()
+    assert master.topology == {None: [S1, S2], S1: [S3, S4], S2: [], S3: [], S4: []}
+    assert started == [S1, S2] and sorted(master.replicators) == [S1, S2]
+
+
+def test_rebuild_after_a_join_keeps_the_running_workers(cluster):
+    master, _, started = cluster
+    master.rebuild_topology()
+    workers = dict(master.replicators)
+    master.members.add(S5)
+    master.rebuild_topology()
+    assert master.topology[S2] == [S5]
+    assert master.replicators == workers and started == [S1, S2]
+
+
+def test_suspected_secondary_is_fed_by_the_master(cluster):
+    master, down, started = cluster
+    master.rebuild_topology()
+    s1 = master.replicators[S1]
+    down.add(S1)
+    master.rebuild_topology()
+    # s1 no longer cuts off the secondaries below it, and keeps its worker
+    assert master.topology[None] == [S2, S3, S1] and master.topology[S2] == [S4]
+    assert master.replicators[S1] is s1 and not s1.stopped
+    assert started == [S1, S2, S3]
+    s3 = master.replicators[S3]
+
+    down.clear()
+    master.rebuild_topology()
+    assert master.topology[None] == [S1, S2]
+    assert s3.stopped and S3 not in master.replicators  # s3 gets its records from s1 again
+    assert started == [S1, S2, S3]
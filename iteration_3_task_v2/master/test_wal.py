@@ -0,0 +1,137 @@
+import os
+
+import pytest
+
+from wal import INDEX_ENTRY, INDEX_SUFFIX, RECORD_HEADER, SEGMENT_SUFFIX, SegmentedLog
+
+
+def append(log, *messages):
+    for message in messages:
+        log.append({'sequence_number': log.next_seq, 'message': message})
+
+
+def files(directory, suffix):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(suffix))
+
+
+def test_append_and_read(tmp_path):
+    log = SegmentedLog(str(tmp_path), fsync=False)
+    append(log, 'a', 'b', 'c')
+    assert (log.first_seq, log.last_seq, len(log)) == (0, 2, 3)
+    assert log.get(1) == {'sequence_number': 1, 'message': 'b'}
+    assert log.get(3) is None
+    assert [r['message'] for r in log.read_range(1)] == ['b', 'c']
+    assert [r['message'] for r in log.iter_range(0, chunk_size=2)] == ['a', 'b', 'c']
+    log.close()
+
+
+def test_out_of_order_append_is_refused(tmp_path):
+    log = SegmentedLog(str(tmp_path), fsync=False)
+    append(log, 'a')
+    with pytest.raises(ValueError):
+        log.append({'sequence_number': 5, 'message': 'b'})
+    log.close()
+
+
+def test_fsynced_records_become_durable(tmp_path):
+    log = SegmentedLog(str(tmp_path), group_commit_delay=0)
+    append(log, 'a', 'b')
+    assert log.wait_durable(1, timeout=5)
+    assert log.durable_seq == 1
+    log.close()
+
+
+def test_segments_roll_and_survive_a_restart(tmp_path):
+    # Every record takes 16 bytes of header + 8 of payload, so a segment holds 2 of them
+    log = SegmentedLog(str(tmp_path), segment_bytes=2 * (RECORD_HEADER.size + 8), fsync=False)
+    messages = [f"message{i}" for i in range(5)]
+    append(log, *messages)
+    log.close()
+    assert [os.path.basename(path) for path in files(str(tmp_path), SEGMENT_SUFFIX)] == [
+        f"{base:020d}{SEGMENT_SUFFIX}" for base in (0, 2, 4)]
+
+    log = SegmentedLog(str(tmp_path), segment_bytes=2 * (RECORD_HEADER.size + 8), fsync=False)
+    assert [r['message'] for r in log.read_range(0)] == messages
+    append(log, 'message5')
+    assert log.get(5)['message'] == 'message5'
+    log.close()
+
+
+def test_torn_append_is_cut_off_on_recovery(tmp_path):
+    # The process was killed in the middle of writing the third record
+    log = SegmentedLog(str(tmp_path), fsync=False)
+    append(log, 'a', 'b')
+    log.close()
+    segment = files(str(tmp_path), SEGMENT_SUFFIX)[-1]
+    intact = os.path.getsize(segment)
+    with open(segment, 'ab') as f:
+        f.write(RECORD_HEADER.pack(0, 2, 100) + b'only part of the pay')
+
+    log = SegmentedLog(str(tmp_path), fsync=False)
+    assert log.last_seq == 1
+    assert os.path.getsize(segment) == intact
+    append(log, 'c')
+    assert [r['message'] for r in log.read_range(0)] == ['a', 'b', 'c']
+    log.close()
+
+
+def test_corrupt_last_record_is_cut_off_on_recovery(tmp_path):
+    log = SegmentedLog(str(tmp_path), fsync=False)
+    append(log, 'a', 'b')
+    log.close()
+    segment = files(str(tmp_path), SEGMENT_SUFFIX)[-1]
+    with open(segment, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'X')  # The crc no longer matches
+
+    log = SegmentedLog(str(tmp_path), fsync=False)
+    assert log.last_seq == 0
+    log.close()
+
+
+def test_index_entry_without_its_record_is_dropped(tmp_path):
+    log = SegmentedLog(str(tmp_path), fsync=False)
+    append(log, 'a')
+    log.close()
+    index = files(str(tmp_path), INDEX_SUFFIX)[-1]
+    with open(index, 'ab') as f:
+        f.write(INDEX_ENTRY.pack(10 ** 6))
+
+    log = SegmentedLog(str(tmp_path), fsync=False)
+    assert log.last_seq == 0
+    append(log, 'b')
+    assert log.get(1)['message'] == 'b'
+    log.close()
+
+
+@pytest.mark.parametrize('kept_entries', [0, 1])
+def test_index_of_the_active_segment_is_rebuilt(tmp_path, kept_entries):
+    # Records whose index entries were lost (or the whole index) are indexed again from the segment
+    log = SegmentedLog(str(tmp_path), fsync=False)
+    append(log, 'a', 'b', 'c')
+    log.close()
+    index = files(str(tmp_path), INDEX_SUFFIX)[-1]
+    with open(index, 'r+b') as f:
+        f.truncate(kept_entries * INDEX_ENTRY.size)
+
+    log = SegmentedLog(str(tmp_path), fsync=False)
+    assert [r['message'] for r in log.read_range(0)] == ['a', 'b', 'c']
+    log.close()
+    assert os.path.getsize(index) == 3 * INDEX_ENTRY.size
+
+
+def test_truncate_prefix_drops_whole_sealed_segments(tmp_path):
+    segment_bytes = 2 * (RECORD_HEADER.size + 1)
+    log = SegmentedLog(str(tmp_path), segment_bytes=segment_bytes, fsync=False)
+    append(log, *'abcdef')  # Segments [0, 1], [2, 3], [4, 5]
+
+    assert log.truncate_prefix(2) == 2  # Record 2 shares its segment with 3, which is kept
+    assert log.get(1) is None
+    assert [r['message'] for r in log.read_range(0)] == ['c', 'd', 'e', 'f']
+    assert log.truncate_prefix(100) == 4  # The active segment is never deleted
+    assert len(files(str(tmp_path), SEGMENT_SUFFIX)) == len(files(str(tmp_path), INDEX_SUFFIX)) == 1
+    log.close()
+
+    log = SegmentedLog(str(tmp_path), segment_bytes=segment_bytes, fsync=False)
+    assert (log.first_seq, log.last_seq) == (4, 5)
+    log.close()
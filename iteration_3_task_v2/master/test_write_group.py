@@ -0,0 +1,143 @@
+import threading
+import time
+
+import pytest
+
+from write_group import WriteGroups
+
+
+class Log:
+    """A commit() that numbers the items of a group and can hold the group being committed."""
+
+    def __init__(self):
+        self.groups = []
+        self.next_seq = 0
+        self.hold = threading.Event()
+        self.hold.set()
+        self.committing = threading.Event()
+
+    def commit(self, items):
+        self.committing.set()
+        self.hold.wait(5)
+        self.groups.append(list(items))
+        results = list(range(self.next_seq, self.next_seq + len(items)))
+        self.next_seq += len(items)
+        return results
+
+
+def submit_in_thread(groups, item, results, **kwargs):
+    thread = threading.Thread(target=lambda: results.__setitem__(item, groups.submit(item, **kwargs)))
+    thread.start()
+    return thread
+
+
+def wait_queued(groups, records):
+    deadline = time.monotonic() + 5
+    while groups.stats()['queued'] < records and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+
+def test_a_lone_write_is_a_group_of_its_own():
+    log = Log()
+    groups = WriteGroups(log.commit)
+    assert groups.submit('a') == 0
+    assert groups.submit('b') == 1
+    assert log.groups == [['a'], ['b']]
+    assert groups.stats()['groups'] == 2
+
+
+def test_writes_queued_behind_a_commit_form_the_next_group():
+    log = Log()
+    log.hold.clear()
+    groups = WriteGroups(log.commit)
+    results = {}
+    threads = [submit_in_thread(groups, 'first', results)]
+    assert log.committing.wait(5)
+    for item in ('b', 'c', 'd'):
+        threads.append(submit_in_thread(groups, item, results))
+        wait_queued(groups, len(threads) - 1)
+    log.hold.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert log.groups == [['first'], ['b', 'c', 'd']]  # In arrival order
+    assert results == {'first': 0, 'b': 1, 'c': 2, 'd': 3}  # Every write gets its own result
+    assert groups.stats() == {'groups': 2, 'records': 4, 'queued': 0, 'window': 0, 'max_records': 256,
+                              'max_bytes': 256 * 1024}
+
+
+def test_group_is_capped_by_records_and_bytes():
+    log = Log()
+    log.hold.clear()
+    groups = WriteGroups(log.commit, max_records=3, max_bytes=100)
+    results = {}
+    threads = [submit_in_thread(groups, 'first', results)]
+    assert log.committing.wait(5)
+    queued = 0
+    for item, records, size in (('a', 2, 10), ('b', 1, 10), ('c', 1, 10), ('d', 1, 95), ('e', 1, 10)):
+        threads.append(submit_in_thread(groups, item, results, records=records, size=size))
+        queued += records
+        wait_queued(groups, queued)
+    log.hold.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert log.groups == [['first'], ['a', 'b'], ['c'], ['d'], ['e']]
+
+
+def test_window_gathers_writes_that_arrive_later():
+    log = Log()
+    groups = WriteGroups(log.commit, window=0.2)
+    results = {}
+    threads = [submit_in_thread(groups, 'a', results)]
+    wait_queued(groups, 1)
+    threads.append(submit_in_thread(groups, 'b', results))
+    for thread in threads:
+        thread.join(5)
+    assert log.groups == [['a', 'b']]
+
+
+def test_commit_error_is_raised_in_every_write_of_the_group():
+    def commit(items):
+        raise OSError('disk full')
+
+    groups = WriteGroups(commit)
+    with pytest.raises(OSError):
+        groups.submit('a')
+    assert groups.stats()['groups'] == 1
+
+
+def test_failed_write_does_not_fail_the_rest_of_its_group():
+    hold = threading.Event()
+    committing = threading.Event()
+    groups_seen = []
+
+    def commit(items):
+        committing.set()
+        hold.wait(5)
+        groups_seen.append(list(items))
+        return [ValueError(item) if item == 'bad' else item.upper() for item in items]
+
+    groups = WriteGroups(commit)
+    outcomes = {}
+
+    def submit(item):
+        try:
+            outcomes[item] = groups.submit(item)
+        except ValueError as e:
+            outcomes[item] = e
+
+    threads = [threading.Thread(target=submit, args=('first',))]
+    threads[0].start()
+    assert committing.wait(5)
+    for item in ('a', 'bad', 'b'):
+        threads.append(threading.Thread(target=submit, args=(item,)))
+        threads[-1].start()
+        wait_queued(groups, len(threads) - 1)
+    hold.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert groups_seen == [['first'], ['a', 'bad', 'b']]
+    assert outcomes['a'] == 'A' and outcomes['b'] == 'B'
+    assert isinstance(outcomes['bad'], ValueError)
@@ -0,0 +1,49 @@
+STAR = 'star'
+CHAIN = 'chain'
+TREE = 'tree'
+TOPOLOGIES = (STAR, CHAIN, TREE)
+
+
+def build_tree(nodes, kind=STAR, fanout=2):
+    """
+    Who sends the replication batches to whom.
+
+    - star: the master sends every batch to every secondary;
+    - chain: the master sends to the first secondary, each secondary forwards to the next one;
+    - tree: the master sends to the first `fanout` secondaries and every secondary forwards to
+      `fanout` more, breadth-first in the order of `nodes` (so the tree stays balanced).
+
+    Args:
+        nodes (list): URLs of the secondaries in the tree, in a stable order.
+        kind (str): 'star', 'chain' or 'tree'.
+        fanout (int): Children per node in a tree.
+
+    Returns:
+        dict: {None: [URLs the master sends to], URL: [URLs that secondary forwards to], ...}
+    """
+    if kind not in TOPOLOGIES:
+        raise ValueError(f"Unknown replication topology: {kind}")
+    nodes = list(nodes)
+    if kind == STAR:
+        return {None: nodes, **{node: [] for node in nodes}}
+    width = 1 if kind == CHAIN else max(1, fanout)
+    tree = {None: nodes[:width]}
+    for i, node in enumerate(nodes):
+        first = width * (i + 1)
+        tree[node] = nodes[first:first + width]
+    return tree
+
+
+def parents(tree):
+    """{URL: URL of its parent, None for the master} of every secondary in the tree."""
+    return {child: parent for parent, children in tree.items() for child in children}
+
+
+def depth(tree, node):
+    """Hops from the master to `node` (1 for the secondaries the master sends to)."""
+    up = parents(tree)
+    hops = 0
+    while node is not None:
+        node = up[node]
+        hops += 1
+    return hops
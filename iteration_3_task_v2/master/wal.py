@@ -0,0 +1,427 @@
+import array
+import bisect
+import contextlib
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+# Every record on disk is: header (crc32, sequence number, payload length) + UTF-8 payload.
+# The crc covers the sequence number, the length and the payload, so a torn write at the
+# end of the active segment is detected and cut off during recovery.
+RECORD_HEADER = struct.Struct('<IQI')
+INDEX_ENTRY = struct.Struct('<Q')
+
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+APPEND_LOCK_FILE = 'append.lock'
+
+
+def segment_path(directory, base_seq):
+    return os.path.join(directory, f"{base_seq:020d}{SEGMENT_SUFFIX}")
+
+
+class Segment:
+    """
+    One segment file of the log plus its sequence-number index.
+
+    The index file holds one 8-byte offset per record, so the offset of `seq` is
+    `offsets[seq - base_seq]`. Reads go through an mmap of the segment file which is
+    re-mapped when the file has grown past the mapped length.
+    """
+
+    def __init__(self, directory, base_seq):
+        self.base_seq = base_seq
+        self.path = segment_path(directory, base_seq)
+        self.index_path = os.path.join(directory, f"{base_seq:020d}{INDEX_SUFFIX}")
+        self.offsets = array.array('Q')
+        self.size = 0
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(self.index_path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._mm = None
+
+    @property
+    def next_seq(self):
+        return self.base_seq + len(self.offsets)
+
+    def load(self, verify_tail):
+        """
+        Load the index from disk and check it against the segment file.
+
+        Args:
+            verify_tail (bool): If True (active segment), also scan past the last indexed record
+                                for records whose index entry was never written and cut off a torn tail.
+        """
+        self.size = os.fstat(self.fd).st_size
+        raw = os.pread(self.index_fd, os.fstat(self.index_fd).st_size, 0)
+        raw = raw[:len(raw) - len(raw) % INDEX_ENTRY.size]
+        self.offsets = array.array('Q')
+        self.offsets.frombytes(raw)
+
+        # Drop index entries that point past the end of the data (index written, data lost)
+        while self.offsets and self.offsets[-1] >= self.size:
+            self.offsets.pop()
+
+        if not verify_tail:
+            return
+
+        # Re-check the last indexed record, then pick up any records written after it
+        position = 0
+        if self.offsets:
+            position = self.offsets[-1]
+            self.offsets.pop()
+        while True:
+            record = self._read_at(position, self.size)
+            if record is None or record[0] != self.next_seq:
+                break
+            self.offsets.append(position)
+            position = record[2]
+
+        # Anything past `position` is a torn write
+        if position < self.size:
+            os.ftruncate(self.fd, position)
+            self.size = position
+        os.ftruncate(self.index_fd, 0)
+        os.pwrite(self.index_fd, self.offsets.tobytes(), 0)
+
+    def refresh(self):
+        """Index the records another process appended to the segment since this one last looked."""
+        size = os.fstat(self.fd).st_size
+        position = self.size
+        while True:
+            record = self._read_at(position, size)
+            if record is None or record[0] != self.next_seq:
+                break
+            self.offsets.append(position)
+            position = record[2]
+        self.size = position
+
+    def _read_at(self, position, limit):
+        # Returns (sequence_number, payload, end_position) or None if the record is missing or corrupt
+        if position + RECORD_HEADER.size > limit:
+            return None
+        header = os.pread(self.fd, RECORD_HEADER.size, position)
+        crc, seq, length = RECORD_HEADER.unpack(header)
+        end = position + RECORD_HEADER.size + length
+        if end > limit:
+            return None
+        payload = os.pread(self.fd, length, position + RECORD_HEADER.size)
+        if zlib.crc32(header[4:] + payload) != crc:
+            return None
+        return seq, payload, end
+
+    def append(self, seq, payload):
+        header_tail = RECORD_HEADER.pack(0, seq, len(payload))[4:]
+        crc = zlib.crc32(header_tail + payload)
+        os.write(self.fd, struct.pack('<I', crc) + header_tail + payload)
+        os.write(self.index_fd, INDEX_ENTRY.pack(self.size))
+        self.offsets.append(self.size)
+        self.size += RECORD_HEADER.size + len(payload)
+
+    def read(self, seq):
+        position = self.offsets[seq - self.base_seq]
+        mm = self._mapping(position + RECORD_HEADER.size)
+        _, _, length = RECORD_HEADER.unpack_from(mm, position)
+        start = position + RECORD_HEADER.size
+        mm = self._mapping(start + length)
+        return bytes(mm[start:start + length])
+
+    def _mapping(self, needed):
+        if self._mm is None or len(self._mm) < needed:
+            if self._mm is not None:
+                self._mm.close()
+            self._mm = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        return self._mm
+
+    def sync(self):
+        os.fsync(self.fd)
+        os.fsync(self.index_fd)
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        os.close(self.fd)
+        os.close(self.index_fd)
+
+
+class SegmentedLog:
+    """
+    Append-only, segmented on-disk log of `{'sequence_number', 'message'}` records.
+
+    The log replaces the in-memory `full_log` list of the master:
+    - records are appended in sequence-number order and rolled over into a new segment
+      once the active one reaches `segment_bytes`;
+    - durability uses group commit: `append` only writes to the page cache, and a single
+      flusher thread fsyncs everything written so far for all waiting callers of `wait_durable`;
+    - each segment has an index file (one offset per sequence number) so recovery only
+      loads the indexes and re-checks the tail of the active segment;
+    - reads are served from mmap-ed segments, so historical ranges don't have to live in RAM;
+    - a `shared` log can be appended to by several processes: appends go through appending(),
+      which takes a lock file and first picks up what the other processes appended, so the lock
+      file is the allocator of the sequence numbers.
+
+    Args:
+        directory (str): Folder that holds the segment and index files.
+        segment_bytes (int): Size after which the active segment is sealed and a new one started.
+        fsync (bool): If False, records are considered durable as soon as they are written (no fsync).
+        group_commit_delay (float): Seconds the flusher waits to gather more writes into one fsync.
+        shared (bool): Other processes append to the same directory.
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, fsync=True, group_commit_delay=0.002, shared=False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.group_commit_delay = group_commit_delay
+        self.shared = shared
+
+        self._lock = threading.RLock()
+        self._durable = threading.Condition(self._lock)
+        self._segments = []
+        self._bases = []
+        self._durable_seq = -1
+        self._closed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self._append_lock = None
+        if shared:
+            self._append_lock = os.open(os.path.join(directory, APPEND_LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+            # Recovery cuts off a torn tail, which must not be a record another process is writing
+            fcntl.flock(self._append_lock, fcntl.LOCK_EX)
+        try:
+            self._recover()
+        finally:
+            if shared:
+                fcntl.flock(self._append_lock, fcntl.LOCK_UN)
+
+        self._flusher = None
+        if self.fsync:
+            self._flusher = threading.Thread(target=self._flush_loop, name='wal-flusher', daemon=True)
+            self._flusher.start()
+
+    def _recover(self):
+        bases = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        for i, base in enumerate(bases):
+            segment = Segment(self.directory, base)
+            segment.load(verify_tail=(i == len(bases) - 1))
+            self._segments.append(segment)
+            self._bases.append(base)
+
+        if not self._segments:
+            self._open_segment(0)
+        self._durable_seq = self.last_seq
+
+    def _open_segment(self, base_seq):
+        segment = Segment(self.directory, base_seq)
+        self._segments.append(segment)
+        self._bases.append(base_seq)
+        return segment
+
+    @property
+    def first_seq(self):
+        return self._segments[0].base_seq
+
+    @property
+    def next_seq(self):
+        return self._segments[-1].next_seq
+
+    @property
+    def last_seq(self):
+        return self.next_seq - 1
+
+    @property
+    def durable_seq(self):
+        """Last sequence number that is on disk (only these are safe to replicate)."""
+        return self._durable_seq
+
+    def __len__(self):
+        return self.next_seq - self.first_seq
+
+    @contextlib.contextmanager
+    def appending(self):
+        """
+        Hold the log to assign the next sequence numbers and append them.
+
+        In a shared log this takes the lock file, so appends of other processes wait, and picks up
+        the records they appended first, so next_seq is the next sequence number of the log.
+        """
+        with self._lock:
+            if self._append_lock is None:
+                yield
+                return
+            fcntl.flock(self._append_lock, fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                yield
+            finally:
+                fcntl.flock(self._append_lock, fcntl.LOCK_UN)
+
+    def refresh(self):
+        """
+        Pick up the records (and new segments) other processes appended to a shared log.
+        They are durable once the flusher of this process has fsynced them too.
+
+        Returns:
+            int: Number of new records.
+        """
+        with self._lock:
+            before = self.next_seq
+            self._segments[-1].refresh()
+            rolled = False
+            while self.next_seq != self._segments[-1].base_seq and os.path.exists(segment_path(self.directory, self.next_seq)):
+                if self.fsync:
+                    self._segments[-1].sync()  # The flusher only syncs the active segment
+                self._open_segment(self.next_seq).refresh()
+                rolled = True
+            if rolled:
+                # Segments another process truncated (see truncate_prefix()) are closed here too
+                while len(self._segments) > 1 and not os.path.exists(self._segments[0].path):
+                    self._segments.pop(0).close()
+                    self._bases.pop(0)
+            added = self.next_seq - before
+            if added:
+                if self.fsync:
+                    self._durable.notify_all()
+                else:
+                    self._durable_seq = self.last_seq
+            return added
+
+    def append(self, seq_message):
+        """
+        Append a record to the active segment.
+
+        The record must carry the next sequence number of the log, so callers assign the
+        sequence number and append under the same lock (and in appending() for a shared log).
+
+        Returns:
+            int: The sequence number of the appended record.
+        """
+        seq = seq_message['sequence_number']
+        payload = seq_message['message'].encode('utf-8')
+        with self._lock:
+            if seq != self.next_seq:
+                raise ValueError(f"Out of order append: expected {self.next_seq}, got {seq}")
+
+            active = self._segments[-1]
+            if active.size and active.size + RECORD_HEADER.size + len(payload) > self.segment_bytes:
+                if self.fsync:
+                    active.sync()
+                active = self._open_segment(seq)
+
+            active.append(seq, payload)
+            if not self.fsync:
+                self._durable_seq = seq
+            else:
+                self._durable.notify_all()
+        return seq
+
+    def wait_durable(self, seq, timeout=None):
+        """
+        Block until the record `seq` has been fsynced (or the timeout expires).
+
+        Returns:
+            bool: True if the record is durable.
+        """
+        with self._durable:
+            return self._durable.wait_for(lambda: self._durable_seq >= seq, timeout)
+
+    def _flush_loop(self):
+        while True:
+            with self._durable:
+                self._durable.wait_for(lambda: self._closed or self.last_seq > self._durable_seq)
+                if self._closed:
+                    return
+
+            # Give concurrent writers a moment to join this commit
+            if self.group_commit_delay:
+                threading.Event().wait(self.group_commit_delay)
+
+            with self._lock:
+                target = self.last_seq
+                segment = self._segments[-1]
+            segment.sync()
+
+            with self._durable:
+                self._durable_seq = max(self._durable_seq, target)
+                self._durable.notify_all()
+
+    def _segment_for(self, seq):
+        return self._segments[bisect.bisect_right(self._bases, seq) - 1]
+
+    def get(self, seq):
+        """Return the record with sequence number `seq`, or None if it is not in the log."""
+        with self._lock:
+            if seq < self.first_seq or seq > self.last_seq:
+                return None
+            payload = self._segment_for(seq).read(seq)
+        return {'sequence_number': seq, 'message': payload.decode('utf-8')}
+
+    def read_range(self, start, stop=None, limit=None):
+        """
+        Return the records with `start <= sequence_number < stop`, at most `limit` of them.
+
+        Args:
+            start (int): First sequence number to return.
+            stop (int): Sequence number to stop before. Defaults to the end of the log.
+            limit (int): Maximum number of records to return.
+        """
+        records = []
+        with self._lock:
+            start = max(start, self.first_seq)
+            stop = self.next_seq if stop is None else min(stop, self.next_seq)
+            if limit is not None:
+                stop = min(stop, start + limit)
+            for seq in range(start, stop):
+                payload = self._segment_for(seq).read(seq)
+                records.append({'sequence_number': seq, 'message': payload.decode('utf-8')})
+        return records
+
+    def iter_range(self, start, stop=None, chunk_size=1024):
+        """Yield the records from `start` (up to `stop`) reading `chunk_size` records at a time."""
+        while True:
+            chunk = self.read_range(start, stop, limit=chunk_size)
+            if not chunk:
+                return
+            yield from chunk
+            start = chunk[-1]['sequence_number'] + 1
+
+    def truncate_prefix(self, seq):
+        """
+        Delete the sealed segments whose records all have a sequence number up to `seq`.
+
+        The log is only cut at segment boundaries and the active segment is always kept,
+        so `first_seq` can stay below `seq + 1` afterwards.
+
+        Returns:
+            int: The first sequence number still in the log.
+        """
+        with self._lock:
+            while len(self._segments) > 1 and self._segments[1].base_seq <= seq + 1:
+                segment = self._segments.pop(0)
+                self._bases.pop(0)
+                segment.close()
+                # The data file goes first: a leftover index without its segment is ignored on recovery
+                os.remove(segment.path)
+                os.remove(segment.index_path)
+            return self.first_seq
+
+    def close(self):
+        with self._durable:
+            self._closed = True
+            self._durable.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+        with self._lock:
+            for segment in self._segments:
+                if self.fsync:
+                    segment.sync()
+                segment.close()
+            if self._append_lock is not None:
+                os.close(self._append_lock)
@@ -0,0 +1,131 @@
+import threading
+import time
+
+
+class _Write:
+    def __init__(self, item, size, records):
+        self.item = item
+        self.size = size
+        self.records = records
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class WriteGroups:
+    """
+    Group commit of the client writes of one log: concurrent writes are logged and handed to the
+    replication workers together, as one contiguous range of sequence numbers.
+
+    The first write that finds no group being committed leads the next group: it waits up to
+    `window` seconds for more writes (or until the group holds `max_records` records or
+    `max_bytes` bytes), takes the writes that queued up, in arrival order, and passes them to
+    commit(items) in one call. Writes that arrive while a group is committed queue up for the next
+    one, so the busier the master, the bigger the groups, even without a window. The other writes of
+    the group sleep until it is committed and get their own result back, so every request still
+    waits for its own write concern afterwards.
+
+    Args:
+        commit (callable): commit(items) logs the items of a group and returns one result per item. A result
+                           that is an exception is raised in its own write only, an exception commit()
+                           raises in every write of the group.
+        window (float): Seconds the leader of a group waits for more writes, 0 to take only the queued ones.
+        max_records (int): Maximum number of records in one group.
+        max_bytes (int): Maximum total size of one group (a single larger write is a group of its own, so is a
+                         write of more than max_records records).
+    """
+
+    def __init__(self, commit, window=0, max_records=256, max_bytes=256 * 1024):
+        self.commit = commit
+        self.window = window
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.groups = 0
+        self.records = 0
+        self._queue = []
+        self._queued_bytes = 0
+        self._queued_records = 0
+        self._committing = False
+        self._cond = threading.Condition()
+
+    def submit(self, item, size=0, records=1):
+        """
+        Log `item` with the next group and return its result.
+
+        Args:
+            item: Passed on to commit().
+            size (int): Size of the item, counted against max_bytes.
+            records (int): Records the item holds, counted against max_records.
+        """
+        write = _Write(item, size, records)
+        with self._cond:
+            self._queue.append(write)
+            self._queued_bytes += size
+            self._queued_records += records
+            self._cond.notify_all()
+        while True:
+            with self._cond:
+                while not write.done and self._committing:
+                    self._cond.wait()
+                if write.done:
+                    break
+                self._committing = True
+                group = self._take_group()
+            self._commit(group)
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def _take_group(self):
+        # Called with the condition held, as the leader of the next group
+        deadline = time.monotonic() + self.window
+        while not self._full():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._cond.wait(remaining)
+        count = size = records = 0
+        for write in self._queue:
+            if count and (records + write.records > self.max_records or size + write.size > self.max_bytes):
+                break
+            count += 1
+            size += write.size
+            records += write.records
+        group = self._queue[:count]
+        del self._queue[:count]
+        self._queued_bytes -= size
+        self._queued_records -= records
+        return group
+
+    def _full(self):
+        return self._queued_records >= self.max_records or self._queued_bytes >= self.max_bytes
+
+    def _commit(self, group):
+        try:
+            results = self.commit([write.item for write in group])
+            for write, result in zip(group, results):
+                if isinstance(result, Exception):
+                    write.error = result
+                else:
+                    write.result = result
+        except Exception as e:
+            for write in group:
+                write.error = e
+        with self._cond:
+            for write in group:
+                write.done = True
+            self.groups += 1
+            self.records += sum(write.records for write in group)
+            self._committing = False
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'groups': self.groups,
+                'records': self.records,
+                'queued': self._queued_records,
+                'window': self.window,
+                'max_records': self.max_records,
+                'max_bytes': self.max_bytes,
+            }
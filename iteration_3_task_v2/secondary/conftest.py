@@ -0,0 +1,28 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+from common.dedup import DedupIndex
+from reorder_buffer import ReorderBuffer
+
+
+@pytest.fixture(scope='session')
+def secondary_app():
+    # The secondary app, without the artificial delay
+    os.environ['ARTIFICIAL_DELAY'] = '0'
+    # The master has a partitions module too, the secondary must find its own first
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    sys.modules.pop('partitions', None)
+    return importlib.import_module('secondary')
+
+
+@pytest.fixture
+def secondary(secondary_app, monkeypatch):
+    # An empty log for every test
+    for name, value in (('log', []), ('log_sequences', []), ('last_processed_sequence', -1),
+                        ('reorder_buffer', ReorderBuffer()), ('payload_index', DedupIndex())):
+        monkeypatch.setattr(secondary_app, name, value)
+    return secondary_app
+
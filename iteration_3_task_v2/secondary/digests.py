@@ -0,0 +1,114 @@
+"""
+Digests over sequence ranges of a secondary's log, for anti-entropy repair between secondaries.
+
+The sequence numbers are cut into leaves of `leaf_records` numbers: leaf i covers
+[i * leaf_records, (i + 1) * leaf_records). The digest of a leaf is a hash over the (sequence
+number, message) pairs the log holds in that range, and the digest of a range of leaves is a hash
+over the leaf digests, like an inner node of a Merkle tree with any fanout. Two secondaries find
+the leaves on which they differ by comparing a few range digests, then only the ranges that differ,
+each split into `fanout` smaller ones, and so on down to single leaves: a handful of round trips,
+whatever the size of the log.
+
+Only complete leaves (every sequence number in them applied) are compared; the records after them
+are simply pulled from the peer that is further ahead.
+"""
+import hashlib
+import struct
+
+
+def _hash():
+    return hashlib.blake2b(digest_size=16)
+
+
+class LogDigests:
+    """
+    Leaf digests of a log, computed on first use and cached.
+
+    Not thread-safe: call with the log lock held.
+
+    Args:
+        records (callable): records(start, end) returns the (sequence_number, message) pairs of
+                            the log in [start, end), in order.
+        leaf_records (int): Sequence numbers per leaf.
+    """
+
+    def __init__(self, records, leaf_records=1024):
+        self.records = records
+        self.leaf_records = leaf_records
+        self._leaves = {}  # Leaf index -> digest, only for complete leaves
+
+    def complete_leaves(self, last_applied):
+        """Number of leaves whose every sequence number is applied, when the log is applied up to `last_applied`."""
+        return (last_applied + 1) // self.leaf_records
+
+    def leaf(self, index):
+        digest = self._leaves.get(index)
+        if digest is None:
+            leaf_hash = _hash()
+            start = index * self.leaf_records
+            for sequence_number, message in self.records(start, start + self.leaf_records):
+                payload = message.encode('utf-8')
+                leaf_hash.update(struct.pack('>qI', sequence_number, len(payload)))
+                leaf_hash.update(payload)
+            digest = self._leaves[index] = leaf_hash.digest()
+        return digest
+
+    def ranges(self, first, end, span):
+        """
+        Digests of the leaves [first, end) in groups of `span` leaves (the last group may be shorter).
+
+        Returns:
+            list: Hex digests, one per group.
+        """
+        digests = []
+        for start in range(first, end, span):
+            range_hash = _hash()
+            for index in range(start, min(start + span, end)):
+                range_hash.update(self.leaf(index))
+            digests.append(range_hash.hexdigest())
+        return digests
+
+    def invalidate(self, sequence_number):
+        """A record was added below the head of the log (a repaired hole): its leaf is hashed again."""
+        self._leaves.pop(sequence_number // self.leaf_records, None)
+
+    def stats(self):
+        return {'leaf_records': self.leaf_records, 'cached_leaves': len(self._leaves)}
+
+
+def divergent_leaves(local, remote, leaves, fanout=16):
+    """
+    The leaves in [0, leaves) on which two logs differ.
+
+    Every round compares the ranges that differed in the round before, each split into `fanout`
+    groups, until the groups are single leaves.
+
+    Args:
+        local (callable): local(first, end, span) returns this log's digests, as LogDigests.ranges().
+        remote (callable): The same for the peer (one request per call).
+        leaves (int): Number of leaves complete on both sides.
+        fanout (int): Groups a differing range is split into.
+
+    Returns:
+        tuple: (list of leaf indices, number of remote calls)
+    """
+    pending = [(0, leaves)] if leaves else []
+    divergent = []
+    calls = 0
+    while pending:
+        narrower = []
+        for first, end in pending:
+            span = max(1, -(-(end - first) // fanout))
+            theirs = remote(first, end, span)
+            calls += 1
+            for group, (mine, their) in enumerate(zip(local(first, end, span), theirs)):
+                if mine == their:
+                    continue
+                start = first + group * span
+                stop = min(start + span, end)
+                if span == 1:
+                    divergent.append(start)
+                else:
+                    narrower.append((start, stop))
+        pending = narrower
+    return divergent, calls
@@ -0,0 +1,187 @@
+"""
+Forwarding of replication batches down a chain or tree topology, and the ACKs back up.
+
+In a chain or tree the master sends each batch only to the secondaries at the top. Every
+secondary passes the live batches it receives on to its children, and reports how far its
+descendants have applied the log to its parent (or to the master), so the master still knows
+which write concerns are met. See the master's topology.py.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+import requests
+
+from common.wire import FORWARD_HEADER, encode_batch
+
+
+class Forwarder:
+    """
+    Forwards batches to one child, from a queue, in a background thread.
+
+    Records are queued in the order they are received (inside the log lock) and sent in batches of
+    up to `max_batch_records` to the child's `/replicate_batch`; the child's reorder buffer takes
+    care of batches that arrive out of order. A failed batch goes back to the front of the queue and
+    is retried after an exponential delay. If the child falls `max_queue_records` behind, the queue
+    is dropped: the master sees the child stall and catches it up with a catch-up stream.
+
+    Args:
+        child (str): The URL of the child secondary.
+        on_ack (callable): Called as on_ack(child, last_applied) after every ACK of the child.
+        max_queue_records (int): Queued records from which the queue is dropped.
+        max_batch_records (int): Maximum number of records in one batch.
+        timeout (float): Connect and read timeout of a request, in seconds.
+        max_retry_delay (float): Longest delay between two attempts, in seconds.
+    """
+
+    def __init__(self, child, on_ack, max_queue_records=100000, max_batch_records=1024, timeout=5, max_retry_delay=5):
+        self.child = child
+        self.on_ack = on_ack
+        self.max_queue_records = max_queue_records
+        self.max_batch_records = max_batch_records
+        self.timeout = timeout
+        self.max_retry_delay = max_retry_delay
+
+        self.last_applied = None
+        self.forwarded = 0
+        self.dropped = 0
+        self.failures = 0
+        self.error = None
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._session = requests.Session()
+        threading.Thread(target=self._run, name=f"forward-{child}", daemon=True).start()
+
+    def put(self, records):
+        """Queue records received from the parent for the child."""
+        with self._cond:
+            if len(self._queue) + len(records) > self.max_queue_records:
+                self.dropped += len(self._queue) + len(records)
+                self._queue.clear()
+                logging.warning(f"Forwarding queue of {self.child} is full, dropped it (the master catches the child up)")
+                return
+            self._queue.extend(records)
+            self._cond.notify()
+
+    def stop(self):
+        """Stop forwarding, the child moved elsewhere in the tree. A batch on the wire still completes."""
+        with self._cond:
+            self._stopped = True
+            self._queue.clear()
+            self._cond.notify()
+
+    def status(self):
+        with self._cond:
+            return {
+                'last_applied': self.last_applied,
+                'queued': len(self._queue),
+                'forwarded': self.forwarded,
+                'dropped': self.dropped,
+                'failures': self.failures,
+                'error': self.error,
+            }
+
+    def _run(self):
+        delay = 0.1
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    self._session.close()
+                    return
+                batch = [self._queue.popleft() for _ in range(min(self.max_batch_records, len(self._queue)))]
+
+            ack = self._post(batch)
+            if ack is not None:
+                delay = 0.1
+                with self._cond:
+                    self.forwarded += len(batch)
+                    self.last_applied = ack['last_applied']
+                    self.error = None
+                self.on_ack(self.child, ack['last_applied'])
+                continue
+
+            with self._cond:
+                self.failures += 1
+                if not self._stopped and len(self._queue) + len(batch) <= self.max_queue_records:
+                    self._queue.extendleft(reversed(batch))
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+    def _post(self, batch):
+        # The ACK of the child, None if the batch has to be sent again
+        body, headers = encode_batch(batch)
+        headers[FORWARD_HEADER] = '1'
+        try:
+            response = self._session.post(f"{self.child}/replicate_batch", data=body, headers=headers,
+                                          timeout=self.timeout)
+        except requests.RequestException as e:
+            self.error = type(e).__name__
+            logging.warning(f"Forwarding to {self.child} failed: {e}")
+            return None
+        if response.status_code != 200:
+            self.error = f"Status code: {response.status_code}"
+            logging.warning(f"Forwarding to {self.child} failed. Status code: {response.status_code}")
+            return None
+        return response.json()
+
+
+class AckReporter:
+    """
+    Reports the positions of this secondary's descendants to its upstream (`/acks` of the parent or the master).
+
+    Positions are merged while a report is on the wire, so however many ACKs come in there is at
+    most one request in flight, carrying the newest position of every descendant. A failed report
+    is merged back and retried.
+
+    Args:
+        source (str): The URL of this secondary, sent along as "from".
+        upstream (str): The URL the positions are reported to.
+        timeout (float): Connect and read timeout of a report, in seconds.
+        retry_delay (float): Seconds to wait after a failed report.
+    """
+
+    def __init__(self, source, upstream, timeout=5, retry_delay=0.5):
+        self.source = source
+        self.upstream = upstream
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.reports = 0
+        self._pending = {}  # descendant URL -> last sequence number applied, not reported yet
+        self._cond = threading.Condition()
+        self._session = requests.Session()
+        threading.Thread(target=self._run, name="ack-reporter", daemon=True).start()
+
+    def report(self, positions):
+        """Queue {descendant URL: last_applied} for the next report."""
+        with self._cond:
+            for url, last_applied in positions.items():
+                if last_applied > self._pending.get(url, -1):
+                    self._pending[url] = last_applied
+            self._cond.notify()
+
+    def set_upstream(self, upstream):
+        with self._cond:
+            self.upstream = upstream
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                positions, self._pending = self._pending, {}
+                upstream = self.upstream
+            try:
+                response = self._session.post(f"{upstream}/acks", json={'from': self.source, 'positions': positions},
+                                              timeout=self.timeout)
+                if response.status_code == 200:
+                    self.reports += 1
+                    continue
+                logging.warning(f"Reporting ACKs to {upstream} failed. Status code: {response.status_code}")
+            except requests.RequestException as e:
+                logging.warning(f"Reporting ACKs to {upstream} failed: {e}")
+            self.report(positions)
+            time.sleep(self.retry_delay)
@@ -0,0 +1,70 @@
+import logging
+import threading
+
+from reorder_buffer import ReorderBuffer
+
+
+class PartitionLog:
+    """
+    The log of one partition after 0 on a secondary, with its own sequence space.
+
+    Partition 0 is the secondary's main log. The master replicates every other partition with
+    replication workers of its own (batches with an X-Partition header), and this secondary keeps
+    a separate last applied sequence number, reorder buffer and lock for each, so the partitions
+    are applied independently. Payload deduplication, forwarding and anti-entropy only cover partition 0.
+
+    Args:
+        index (int): Number of the partition.
+        reorder_buffer_size (int): Maximum number of records kept ahead of a gap.
+    """
+
+    def __init__(self, index, reorder_buffer_size=10000):
+        self.index = index
+        self.log = []
+        self.log_sequences = []
+        self.last_applied = -1
+        self.lock = threading.Lock()
+        self.reorder_buffer = ReorderBuffer(max_size=reorder_buffer_size)
+
+    def apply(self, sequence_number, message):
+        """
+        Apply one replicated record in order. Call with the partition's lock held.
+
+        Returns:
+            str: 'applied', 'duplicate', 'buffered' or 'rejected' (early record and the buffer is full).
+        """
+        if sequence_number <= self.last_applied:
+            return 'duplicate'
+        if sequence_number > self.last_applied + 1:
+            if self.reorder_buffer.add(sequence_number, message):
+                return 'buffered'
+            logging.warning(f"Reorder buffer of partition {self.index} is full, record {sequence_number} rejected")
+            return 'rejected'
+        self._append(sequence_number, message)
+        for buffered_sequence, buffered_message in self.reorder_buffer.pop_ready(self.last_applied + 1):
+            self._append(buffered_sequence, buffered_message)
+        return 'applied'
+
+    def skip(self, sequence_number):
+        """
+        Step over an invalid record that is next in order (nothing is stored for it). Call with the partition's lock held.
+
+        Returns:
+            bool: False if the record is not next in order.
+        """
+        if sequence_number != self.last_applied + 1:
+            return False
+        logging.warning(f"Invalid message of partition {self.index} skipped. Sequence: {sequence_number}")
+        self.last_applied = sequence_number
+        for buffered_sequence, buffered_message in self.reorder_buffer.pop_ready(self.last_applied + 1):
+            self._append(buffered_sequence, buffered_message)
+        return True
+
+    def _append(self, sequence_number, message):
+        self.log.append(message)
+        self.log_sequences.append(sequence_number)
+        self.last_applied = sequence_number
+
+    def status(self):
+        with self.lock:
+            return {'last_applied': self.last_applied, 'log_size': len(self.log), 'reorder_buffer': self.reorder_buffer.stats()}
@@ -0,0 +1,63 @@
+import time
+
+
+class ReorderBuffer:
+    """
+    Holds replicated records that arrived ahead of a gap, until the gap is filled.
+
+    Records are kept in a dict keyed by sequence number. When the missing record arrives,
+    pop_ready() returns the whole contiguous run that can now be applied.
+
+    Args:
+        max_size (int): Maximum number of buffered records. Past it, early arrivals are rejected
+                        and the master has to send them again.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._records = {}
+        self._gap_since = None  # When the current gap was first seen
+
+    def __len__(self):
+        return len(self._records)
+
+    def add(self, sequence_number, message):
+        """
+        Buffer an early record.
+
+        Returns:
+            bool: False if the buffer is full and the record was not kept.
+        """
+        if sequence_number in self._records:
+            return True
+        if len(self._records) >= self.max_size:
+            return False
+        if not self._records:
+            self._gap_since = time.monotonic()
+        self._records[sequence_number] = message
+        return True
+
+    def pop_ready(self, next_sequence):
+        """Remove and return the contiguous run of records [(sequence_number, message), ...] starting at `next_sequence`."""
+        ready = []
+        while next_sequence in self._records:
+            ready.append((next_sequence, self._records.pop(next_sequence)))
+            next_sequence += 1
+        if ready:
+            # Whatever is still buffered is waiting on a new gap
+            self._gap_since = time.monotonic() if self._records else None
+        return ready
+
+    def gap_age(self):
+        """Seconds the oldest open gap has been waiting to be filled (0 if there is no gap)."""
+        if self._gap_since is None:
+            return 0.0
+        return time.monotonic() - self._gap_since
+
+    def stats(self):
+        return {
+            'depth': len(self._records),
+            'max_size': self.max_size,
+            'gap_age': round(self.gap_age(), 3),
+            'lowest_buffered': min(self._records) if self._records else None,
+        }
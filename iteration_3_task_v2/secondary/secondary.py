@@ -0,0 +1,934 @@
+from flask import Flask, Response, request, jsonify
+import gzip
+import hashlib
+import json
+import os
+import random
+import tempfile
+import time
+import logging
+import sys
+import requests
+from bisect import bisect_left, bisect_right
+from threading import Condition, Lock, Thread
+
+# The modules shared by the master and the secondaries are in the `common` package: next to this file in the
+# Docker image, one folder up in the repository
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reorder_buffer import ReorderBuffer
+from common.dedup import DedupIndex
+from common.read_api import range_args, not_modified, not_modified_response, stream_messages
+from common.wire import FORWARD_HEADER, MEDIA_TYPE, PARTITION_HEADER, decode_batch, decode_records, encode_batch, is_valid_message
+from common.metrics import REGISTRY, CONTENT_TYPE, Counter, Gauge, Histogram
+from common.tracing import TRACE_HEADER, Tracer
+from forwarding import AckReporter, Forwarder
+from digests import LogDigests, divergent_leaves
+from partitions import PartitionLog
+
+# Initialize Flask application
+app = Flask(__name__)
+
+# Global variables
+log = []  # Stores messages
+log_sequences = []  # Sequence number of every message in `log` (payload duplicates are skipped, so they have gaps)
+last_processed_sequence = -1  # Tracks the last processed sequence number
+log_lock = Lock()  # Replication requests are handled concurrently
+log_appended = Condition(log_lock)  # Wakes the tail readers when the log grows
+
+# Read the artificial delay from an environment variable
+ARTIFICIAL_DELAY = int(os.environ.get('ARTIFICIAL_DELAY', 1))
+
+# Messages that arrive ahead of a gap wait here until the gap is filled
+REORDER_BUFFER_SIZE = int(os.environ.get('REORDER_BUFFER_SIZE', 10000))
+reorder_buffer = ReorderBuffer(max_size=REORDER_BUFFER_SIZE)
+
+# Partitioned log: the master replicates partitions after 0 with an X-Partition header, each is applied to a log of its own
+MAX_PARTITIONS = 1024
+partition_logs = {}  # Partition number -> PartitionLog, created by the first batch of the partition
+partition_logs_lock = Lock()
+
+# Deduplication: sequence numbers are checked against last_processed_sequence (the log is contiguous),
+# payloads against a content-hash index, so an append costs the same however long the log is
+DEDUP_PAYLOADS = os.environ.get('DEDUP_PAYLOADS', '1') == '1'  # Skip messages whose payload is already in the log
+DEDUP_MAX_ENTRIES = int(os.environ.get('DEDUP_MAX_ENTRIES', 0))  # 0 = remember every payload
+DEDUP_TTL = float(os.environ.get('DEDUP_TTL', 0))  # Seconds, 0 = no expiry
+payload_index = DedupIndex(max_entries=DEDUP_MAX_ENTRIES, ttl=DEDUP_TTL)
+
+# Every secondary runs this same script, told apart by its name and port
+NODE_NAME = os.environ.get('NODE_NAME', 'secondary1')
+PORT = int(os.environ.get('PORT', 5001))
+
+# Where the master is and how it reaches this secondary (announced to the master at startup)
+MASTER_URL = os.environ.get('MASTER_URL', 'http://master:5000')
+SELF_URL = os.environ.get('SELF_URL', f'http://{NODE_NAME}:{PORT}')
+SYNC_RETRY_INTERVAL = 5  # Seconds between attempts to reach the master
+# An empty secondary loads the master's latest snapshot first, then only the records after it are replicated
+SNAPSHOT_BOOTSTRAP = os.environ.get('SNAPSHOT_BOOTSTRAP', '1') == '1'
+SNAPSHOT_DOWNLOAD_TIMEOUT = float(os.environ.get('SNAPSHOT_DOWNLOAD_TIMEOUT', 300))
+bootstrap_lock = Lock()  # One snapshot download at a time
+
+# Part of the ETag of reads: the log is kept in memory, so a restarted secondary must not match old ETags
+LOG_EPOCH = int(time.time() * 1000)
+
+# Tail readers (long-poll and Server-Sent Events)
+TAIL_MAX_TIMEOUT = float(os.environ.get('TAIL_MAX_TIMEOUT', 30))  # Longest a long-poll is held open, in seconds
+TAIL_MAX_RECORDS = int(os.environ.get('TAIL_MAX_RECORDS', 1000))  # Records per long-poll answer or SSE wake-up
+SSE_KEEPALIVE_INTERVAL = 15  # Seconds between keep-alive comments on an idle event stream
+
+# Exported on /metrics: apply rate (rate() of the applied counter), replication handling time, buffer depth
+REPAIRED_RECORDS = Counter('replog_repair_records_total', 'Records pulled from peers by anti-entropy, by what happened to them.',
+                           ['result'])
+APPLIED_RECORDS = Counter('replog_applied_records_total', 'Records appended to the log (payload duplicates included).')
+RECEIVED_RECORDS = Counter('replog_received_records_total', 'Replicated records received, by what happened to them.',
+                           ['result'])
+REPLICATE_SECONDS = Histogram('replog_replicate_seconds',
+                              'Time to handle a replication request, without the artificial delay.', ['endpoint'])
+Gauge('replog_last_applied_seq', 'Last sequence number applied (the log is contiguous up to it).',
+      lambda: last_processed_sequence)
+Gauge('replog_log_records', 'Messages in the log.', lambda: len(log))
+Gauge('replog_reorder_buffer_records', 'Records waiting in the reorder buffer for a gap to be filled.',
+      lambda: len(reorder_buffer))
+Gauge('replog_reorder_gap_age_seconds', 'How long the oldest gap has been open.', lambda: reorder_buffer.gap_age())
+
+# Spans of the replication requests that carry sampled writes (the master sends their trace IDs)
+TRACE_BUFFER_SPANS = int(os.environ.get('TRACE_BUFFER_SPANS', 10000))
+tracer = Tracer(SELF_URL, sample_rate=0, max_spans=TRACE_BUFFER_SPANS)
+
+# Chain/tree replication: the master tells every secondary its parent and children (POST /topology).
+# Live batches are forwarded to the children, their ACKs are reported to the parent, or the master
+FORWARD_MAX_QUEUE_RECORDS = int(os.environ.get('FORWARD_MAX_QUEUE_RECORDS', 100000))  # Per child, then the master catches it up
+FORWARD_BATCH_RECORDS = int(os.environ.get('FORWARD_BATCH_RECORDS', 1024))
+parent_url = None  # None: this secondary gets its batches from the master
+forwarders = {}  # Child URL -> Forwarder. Replaced, never changed in place, so replicate_batch reads it without a lock
+topology_lock = Lock()
+ack_reporter = AckReporter(SELF_URL, MASTER_URL)
+
+# Anti-entropy: this secondary compares digests of its log with a peer secondary and pulls only the ranges
+# that differ (and the records the peer is ahead by), so missed records are repaired without the master
+ANTI_ENTROPY_INTERVAL = float(os.environ.get('ANTI_ENTROPY_INTERVAL', 60))  # Seconds between rounds, 0 = only on POST /repair
+ANTI_ENTROPY_GAP_AGE = float(os.environ.get('ANTI_ENTROPY_GAP_AGE', 5))  # A gap open this long brings the next round forward
+DIGEST_LEAF_RECORDS = int(os.environ.get('DIGEST_LEAF_RECORDS', 1024))  # Must be the same on every secondary
+DIGEST_FANOUT = 16  # Digests per request, a differing range is split this many ways
+REPAIR_CHUNK_RECORDS = int(os.environ.get('REPAIR_CHUNK_RECORDS', 1000))  # Records per pull from a peer
+repair_lock = Lock()  # One round at a time
+repair_status = {}  # Outcome of the last round
+repair_generation = 0  # Holes filled below the head, part of the read ETag since the high watermark does not move
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+
+@app.route("/")
+def home():
+    return f"Hello, this is {NODE_NAME}!"
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    # http://localhost:5001/health
+    return f"Healthy {NODE_NAME}!", 200
+
+
+def process_message(message, sequence_number):
+    """Append the message to the log and update the last processed sequence number."""
+    global last_processed_sequence
+    if not DEDUP_PAYLOADS or payload_index.lookup(message) is None:
+        log.append(message)
+        log_sequences.append(sequence_number)
+        if DEDUP_PAYLOADS:
+            payload_index.add(sequence_number, message)
+        logging.info(f"Appended message: {message}")
+    else:
+        logging.info(f"Duplicate message received: {message}")
+    # The sequence number is processed either way, otherwise the next messages would look out of order
+    last_processed_sequence = sequence_number
+    APPLIED_RECORDS.inc()
+
+
+def apply_record(sequence_number, message):
+    """
+    Apply one replicated record, keeping total order and deduplication.
+
+    A record that fills the gap is applied together with every buffered record right after it.
+    A record that arrives ahead of a gap is kept in the reorder buffer.
+
+    Returns:
+        str: 'applied', 'duplicate', 'buffered' or 'rejected' (early record and the buffer is full).
+    """
+    if sequence_number <= last_processed_sequence:
+        logging.warning(f"Old or duplicate message received. Sequence: {sequence_number}")
+        return 'duplicate'
+
+    if sequence_number > last_processed_sequence + 1:
+        if reorder_buffer.add(sequence_number, message):
+            logging.info(f"Out-of-order message buffered. Sequence: {sequence_number}")
+            return 'buffered'
+        logging.warning(f"Reorder buffer is full, out-of-order message rejected. Sequence: {sequence_number}")
+        return 'rejected'
+
+    process_message(message, sequence_number)
+    for buffered_sequence, buffered_message in reorder_buffer.pop_ready(last_processed_sequence + 1):
+        process_message(buffered_message, buffered_sequence)
+    log_appended.notify_all()
+    return 'applied'
+
+
+def skip_invalid_record(sequence_number):
+    """
+    Step over an invalid record that is next in order, so one bad record in the master's log can't stall
+    replication: nothing is stored for it (like for a payload duplicate) and the records buffered after it are applied.
+
+    Returns:
+        bool: False if the record is not next in order (it comes again once the gap before it is filled).
+    """
+    global last_processed_sequence
+    if sequence_number != last_processed_sequence + 1:
+        return False
+    logging.warning(f"Invalid message skipped. Sequence: {sequence_number}")
+    last_processed_sequence = sequence_number
+    for buffered_sequence, buffered_message in reorder_buffer.pop_ready(last_processed_sequence + 1):
+        process_message(buffered_message, buffered_sequence)
+    log_appended.notify_all()
+    return True
+
+
+def split_invalid(records):
+    # The valid records before the first invalid one, and that invalid record (None if every record is valid)
+    for index, record in enumerate(records):
+        if not is_valid_message(record['message']):
+            return records[:index], record
+    return records, None
+
+
+def read_records():
+    """
+    The records of a replication request: binary framing (see wire.py) or JSON {"records": [...]}.
+    Returns None if the request is in neither format (answered with 415, the master then sends JSON).
+    """
+    if request.mimetype == MEDIA_TYPE:
+        return decode_batch(request.get_data(), request.headers.get('Content-Encoding'))
+    if request.is_json:
+        return request.json['records']
+    return None
+
+
+def unsupported_media_type():
+    return jsonify({'status': 'error', 'message': f"Send JSON or {MEDIA_TYPE}"}), 415
+
+
+def trace_ids():
+    # Trace IDs of the sampled writes in a replication request (X-Trace-Id: id[,id...])
+    header = request.headers.get(TRACE_HEADER)
+    return [trace_id for trace_id in header.split(',') if trace_id] if header else []
+
+
+def record_spans(traces, name, start, end, **attrs):
+    for trace_id in traces:
+        tracer.record(trace_id, name, start, end, **attrs)
+
+
+@app.route('/replicate', methods=['POST'])
+def replicate():
+    logging.info("Replicate endpoint hit with a POST request.")
+    started = time.perf_counter()
+    try:
+        # Extracting message and sequence number from the request (one record in the binary format, or JSON)
+        if request.mimetype == MEDIA_TYPE:
+            (message_data,) = read_records()
+        elif request.is_json:
+            message_data = request.json
+        else:
+            return unsupported_media_type()
+        message = message_data['message']
+        sequence_number = message_data['sequence_number']
+
+        # Validation message format: an invalid record next in order is skipped and reported, so it isn't sent forever
+        if not is_valid_message(message):
+            with log_lock:
+                skipped = skip_invalid_record(sequence_number)
+                last_applied = last_processed_sequence
+            if skipped:
+                RECEIVED_RECORDS.labels('invalid').inc()
+                return jsonify({'status': 'ACK', 'result': 'invalid', 'invalid': sequence_number, 'last_applied': last_applied}), 200
+            logging.warning("Invalid message format")
+            return jsonify({'status': 'error', 'message': 'Invalid message format'}), 400
+
+        # Handling total ordering and deduplication
+        traces = trace_ids()
+        lock_requested = time.time()
+        with log_lock:
+            applying = time.time()
+            result = apply_record(sequence_number, message)
+            last_applied = last_processed_sequence
+        applied = time.time()
+        RECEIVED_RECORDS.labels(result).inc()
+        REPLICATE_SECONDS.labels('replicate').observe(time.perf_counter() - started)
+        if traces:
+            record_spans(traces, 'lock_wait', lock_requested, applying)
+            record_spans(traces, 'apply', applying, applied, sequence_number=sequence_number, result=result)
+
+        if result == 'rejected':
+            return jsonify({'status': 'error', 'message': 'Reorder buffer is full', 'last_applied': last_applied}), 503
+
+        time.sleep(ARTIFICIAL_DELAY)
+        record_spans(traces, 'artificial_delay', applied, time.time())
+        # The ACK says what happened to this message and how far the log is applied
+        return jsonify({'status': 'ACK', 'result': result, 'last_applied': last_applied}), 200
+
+    except (TypeError, KeyError, ValueError):
+        logging.exception("Failed to replicate message")
+        return jsonify({'status': 'error', 'message': 'Bad request'}), 400
+
+
+@app.route('/replicate_batch', methods=['POST'])
+def replicate_batch():
+    """
+    Apply a contiguous run of records sent by the master in one request.
+    Body: {"records": [{"sequence_number": 5, "message": "..."}, ...]}, or the same records
+    in the binary framing of wire.py (Content-Type application/x-replicated-log-batch).
+
+    The ACK carries the highest contiguous sequence number applied so far,
+    so the master can resolve the write concern of every message up to it at once,
+    and how many records of the batch were buffered (waiting for a gap) or rejected.
+
+    Only the records before the first invalid one (see is_valid_message()) are applied. The invalid
+    record is skipped if it is next in order and its sequence number is reported as `invalid`; the
+    records after it count as rejected, so the master sends them again.
+    """
+    started = time.perf_counter()
+    try:
+        records = read_records()
+        if records is None:
+            return unsupported_media_type()
+
+        valid, invalid_record = split_invalid(records)
+        if invalid_record is not None:
+            logging.warning(f"Invalid message format in batch. Sequence: {invalid_record['sequence_number']}")
+
+        partition = request.headers.get(PARTITION_HEADER, 0, type=int)
+        if partition:
+            return replicate_partition(partition, records, started)
+
+        results = {'applied': 0, 'duplicate': 0, 'buffered': 0, 'rejected': 0}
+        invalid = None
+        traces = trace_ids()
+        lock_requested = time.time()
+        with log_lock:
+            applying = time.time()
+            for record in valid:
+                results[apply_record(record['sequence_number'], record['message'])] += 1
+            if invalid_record is not None and skip_invalid_record(invalid_record['sequence_number']):
+                invalid = invalid_record['sequence_number']
+                valid = valid + [invalid_record]
+            results['rejected'] += len(records) - len(valid)
+            last_applied = last_processed_sequence
+            # Queued under the log lock, so the children get the batches in the order they were applied here
+            if forwarders and request.headers.get(FORWARD_HEADER) and valid:
+                for forwarder in forwarders.values():
+                    forwarder.put(valid)
+        applied = time.time()
+        logging.info(f"Batch of {len(records)} records processed, last applied: {last_applied}")
+        for result, count in results.items():
+            if count:
+                RECEIVED_RECORDS.labels(result).inc(count)
+        if invalid is not None:
+            RECEIVED_RECORDS.labels('invalid').inc()
+        REPLICATE_SECONDS.labels('replicate_batch').observe(time.perf_counter() - started)
+        if traces:
+            record_spans(traces, 'lock_wait', lock_requested, applying)
+            record_spans(traces, 'apply', applying, applied, records=len(records), last_applied=last_applied, **results)
+
+        time.sleep(ARTIFICIAL_DELAY)
+        record_spans(traces, 'artificial_delay', applied, time.time())
+        return jsonify({'status': 'ACK', 'last_applied': last_applied, 'invalid': invalid, **results}), 200
+
+    except (TypeError, KeyError, ValueError):
+        logging.exception("Failed to replicate batch")
+        return jsonify({'status': 'error', 'message': 'Bad request'}), 400
+
+def partition_log(index):
+    # The log of a partition after 0, created on first use
+    with partition_logs_lock:
+        if index not in partition_logs:
+            partition_logs[index] = PartitionLog(index, reorder_buffer_size=REORDER_BUFFER_SIZE)
+            logging.info(f"Receiving partition {index}")
+        return partition_logs[index]
+
+
+def replicate_partition(index, records, started):
+    """Apply a batch of a partition after 0 (see partitions.py); answered like /replicate_batch, with the partition's last_applied."""
+    if not 0 < index < MAX_PARTITIONS:
+        return jsonify({'status': 'error', 'message': f"Partition must be below {MAX_PARTITIONS}"}), 400
+    partition = partition_log(index)
+    valid, invalid_record = split_invalid(records)
+    results = {'applied': 0, 'duplicate': 0, 'buffered': 0, 'rejected': 0}
+    invalid = None
+    with partition.lock:
+        for record in valid:
+            results[partition.apply(record['sequence_number'], record['message'])] += 1
+        if invalid_record is not None and partition.skip(invalid_record['sequence_number']):
+            invalid = invalid_record['sequence_number']
+            valid = valid + [invalid_record]
+        results['rejected'] += len(records) - len(valid)
+        last_applied = partition.last_applied
+    for result, count in results.items():
+        if count:
+            RECEIVED_RECORDS.labels(result).inc(count)
+    if invalid is not None:
+        RECEIVED_RECORDS.labels('invalid').inc()
+    REPLICATE_SECONDS.labels('replicate_batch').observe(time.perf_counter() - started)
+    time.sleep(ARTIFICIAL_DELAY)
+    return jsonify({'status': 'ACK', 'partition': index, 'last_applied': last_applied, 'invalid': invalid, **results}), 200
+
+
+@app.route('/status', methods=['GET'])
+def get_status():
+    # Replication position and reorder buffer state (depth, how long the oldest gap is open)
+    with log_lock:
+        return jsonify({
+            'last_applied': last_processed_sequence,
+            'log_size': len(log),
+            'reorder_buffer': reorder_buffer.stats(),
+            'dedup': {'payloads': DEDUP_PAYLOADS, **payload_index.stats()},
+            'partitions': {index: partition.status() for index, partition in sorted(partition_logs.items())},
+        }), 200
+
+
+def report_child_ack(child, last_applied):
+    ack_reporter.report({child: last_applied})
+
+
+@app.route('/topology', methods=['POST'])
+def set_topology():
+    """
+    The master places this secondary in the replication tree.
+    Body: {"parent": "http://secondary1:5001" or null for the master, "children": ["http://secondary3:5003", ...]}
+    """
+    global forwarders, parent_url
+    payload = request.get_json(silent=True) or {}
+    children = payload.get('children') or []
+    if not isinstance(children, list) or not all(isinstance(child, str) for child in children):
+        return jsonify({'status': 'error', 'message': 'children must be a list of URLs'}), 400
+
+    with topology_lock:
+        parent_url = payload.get('parent')
+        ack_reporter.set_upstream(parent_url or MASTER_URL)
+        current = forwarders
+        forwarders = {
+            child: current.get(child) or Forwarder(child, report_child_ack, max_queue_records=FORWARD_MAX_QUEUE_RECORDS,
+                                                   max_batch_records=FORWARD_BATCH_RECORDS)
+            for child in children
+        }
+        for child, forwarder in current.items():
+            if child not in forwarders:
+                forwarder.stop()
+    logging.info(f"Replication parent: {parent_url or MASTER_URL}, children: {children}")
+    return jsonify({'status': 'ok', 'parent': parent_url, 'children': children}), 200
+
+
+@app.route('/topology', methods=['GET'])
+def get_topology():
+    # Where this secondary is in the replication tree, and how forwarding to its children goes
+    return jsonify({
+        'parent': parent_url,
+        'upstream': ack_reporter.upstream,
+        'acks_reported': ack_reporter.reports,
+        'children': {child: forwarder.status() for child, forwarder in forwarders.items()},
+    })
+
+
+@app.route('/acks', methods=['POST'])
+def receive_acks():
+    """
+    A child reports how far its descendants have applied the log, passed on upstream.
+    Body: {"from": "http://secondary3:5003", "positions": {"http://secondary5:5005": 41, ...}}
+    """
+    payload = request.get_json(silent=True) or {}
+    try:
+        positions = {url: int(last_applied) for url, last_applied in (payload.get('positions') or {}).items()}
+    except (AttributeError, TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'positions must map URLs to sequence numbers'}), 400
+    ack_reporter.report(positions)
+    return jsonify({'status': 'ACK', 'positions': len(positions)}), 200
+
+
+@app.route('/debug/traces', methods=['GET'])
+def get_traces():
+    """
+    Spans of the replication requests that carried sampled writes, by trace.
+    Query: ?trace_id=<one trace>&limit=<number of traces, default 20>&format=chrome (Chrome trace JSON).
+    """
+    trace_id = request.args.get('trace_id')
+    limit = request.args.get('limit', 20, type=int)
+    if request.args.get('format') == 'chrome':
+        return jsonify(tracer.chrome_trace(trace_id, limit))
+    return jsonify(tracer.traces(trace_id, limit))
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus text format
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+@app.route('/messages', methods=['GET'])
+def get_messages():
+    """
+    Read the log, or a range of it, by sequence number.
+    Query: ?since=<first seq>&until=<first seq not returned>&limit=<max messages>&partition=<n>, all optional.
+
+    The response is streamed as chunked JSON and carries `next_since` (the `since` of the next
+    incremental read) and the high watermark (last applied sequence number). A poll that sends
+    back the ETag it got gets 304 Not Modified until something new is applied or anti-entropy
+    fills a hole below the high watermark.
+    """
+    logging.info("Received GET request to /messages")
+    try:
+        since, until, limit = range_args()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+    index = request.args.get('partition', 0, type=int)
+    partition = partition_logs.get(index) if index else None
+    if index and partition is None:
+        return jsonify({'status': 'error', 'message': 'No such partition'}), 404
+    lock, entries, sequences = (partition.lock, partition.log, partition.log_sequences) if partition else (log_lock, log, log_sequences)
+
+    with lock:
+        high_watermark = partition.last_applied if partition else last_processed_sequence
+        etag = f"{LOG_EPOCH}-{high_watermark}" + (f"-p{index}" if partition else f"-r{repair_generation}")
+        if not_modified(etag):
+            return not_modified_response(etag, high_watermark)
+
+        # The sequence numbers are sorted, so the range is found by binary search
+        start = bisect_left(sequences, since) if since is not None else 0
+        stop = bisect_left(sequences, until) if until is not None else len(entries)
+        if limit is not None:
+            stop = min(stop, start + limit)
+        stop = max(start, stop)
+        # Where the next incremental read starts: right after what this one covered
+        next_since = sequences[stop] if stop < len(entries) else high_watermark + 1
+        if until is not None:
+            next_since = min(next_since, until)
+        next_since = max(next_since, since or 0)
+        # The slice is a copy taken under the lock, so it can be streamed without it
+        messages = entries[start:stop]
+
+    return stream_messages(messages, next_since, high_watermark, etag)
+
+
+@app.route('/messages/<int:sequence_number>', methods=['GET'])
+def get_message(sequence_number):
+    # Point lookup of one message by its sequence number
+    with log_lock:
+        position = bisect_left(log_sequences, sequence_number)
+        if position == len(log_sequences) or log_sequences[position] != sequence_number:
+            return jsonify({'status': 'error', 'message': 'No message with this sequence number'}), 404
+        return jsonify({'sequence_number': sequence_number, 'message': log[position]}), 200
+
+
+def records_after(after, limit):
+    """Return up to `limit` records [{'sequence_number': ..., 'message': ...}] applied after `after`. Call with log_lock held."""
+    start = bisect_right(log_sequences, after)
+    stop = start + limit
+    return [{'sequence_number': sequence_number, 'message': message}
+            for sequence_number, message in zip(log_sequences[start:stop], log[start:stop])]
+
+
+@app.route('/messages/tail', methods=['GET'])
+def tail_messages():
+    """
+    Long-poll for the messages applied after a sequence number.
+    Query: ?after=<seq>&timeout=<seconds>&limit=<max records>
+
+    Answers at once if there is something newer than `after`, otherwise holds the request
+    until a message is applied or the timeout runs out (then with no records).
+    The next poll should use `after=<high_watermark>` from the answer: messages skipped as
+    payload duplicates are not returned, but they still move the high watermark.
+    """
+    try:
+        after = int(request.args.get('after', -1))
+        timeout = min(float(request.args.get('timeout', TAIL_MAX_TIMEOUT)), TAIL_MAX_TIMEOUT)
+        limit = min(int(request.args.get('limit', TAIL_MAX_RECORDS)), TAIL_MAX_RECORDS)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'after, timeout and limit must be numbers'}), 400
+
+    with log_appended:
+        log_appended.wait_for(lambda: last_processed_sequence > after, timeout=max(timeout, 0))
+        records = records_after(after, limit)
+        high_watermark = last_processed_sequence
+    if records and len(records) == limit:
+        # Cut short by the limit, the rest comes with the next poll
+        high_watermark = records[-1]['sequence_number']
+    return jsonify({'records': records, 'high_watermark': high_watermark}), 200
+
+
+@app.route('/messages/stream', methods=['GET'])
+def stream_messages_sse():
+    """
+    Server-Sent Events feed of the messages applied after a sequence number.
+    Query: ?after=<seq>. A reconnecting EventSource resumes from its Last-Event-ID header.
+
+    Every record is one event whose id is its sequence number. An idle stream gets
+    a keep-alive comment every SSE_KEEPALIVE_INTERVAL seconds.
+    """
+    try:
+        after = int(request.headers.get('Last-Event-ID', request.args.get('after', -1)))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'after must be a sequence number'}), 400
+
+    def generate(after):
+        while True:
+            with log_appended:
+                log_appended.wait_for(lambda: last_processed_sequence > after, timeout=SSE_KEEPALIVE_INTERVAL)
+                records = records_after(after, TAIL_MAX_RECORDS)
+                high_watermark = last_processed_sequence
+            # Events are written without the lock, a slow reader doesn't hold up replication
+            if records:
+                yield ''.join(f"id: {record['sequence_number']}\ndata: {json.dumps(record)}\n\n" for record in records)
+            else:
+                yield ': keep-alive\n\n'
+            after = records[-1]['sequence_number'] if len(records) == TAIL_MAX_RECORDS else max(after, high_watermark)
+
+    return Response(generate(after), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+def bootstrap_from_snapshot():
+    """
+    Download the master's latest snapshot, check its checksum and apply the records this log doesn't have yet.
+
+    The snapshot is downloaded to a temporary file without holding the log lock, and not at all
+    if the log already reaches the end of the snapshot. Records up to last_applied are skipped,
+    the rest go through the same path as replicated records (payload deduplication included).
+
+    Returns:
+        int: The last applied sequence number afterwards, or None if the master has no snapshot.
+
+    Raises:
+        requests.RequestException: If the master can't be reached.
+        ValueError: If the snapshot is corrupt or not contiguous with the log.
+    """
+    with bootstrap_lock, requests.get(f"{MASTER_URL}/snapshot/latest", stream=True, timeout=(5, SNAPSHOT_DOWNLOAD_TIMEOUT)) as response:
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        snapshot_last_seq = int(response.headers['X-Snapshot-Last-Seq'])
+        if snapshot_last_seq <= last_processed_sequence:
+            return last_processed_sequence
+        return load_snapshot(response, snapshot_last_seq)
+
+
+def load_snapshot(response, snapshot_last_seq):
+    # Download the snapshot of `response`, check it and apply it
+    expected = response.headers.get('X-Snapshot-Checksum', '')
+    with tempfile.TemporaryFile() as snapshot_file:
+        checksum = hashlib.sha256()
+        for chunk in response.iter_content(chunk_size=1024 * 1024):
+            checksum.update(chunk)
+            snapshot_file.write(chunk)
+        if expected != f"sha256:{checksum.hexdigest()}":
+            raise ValueError(f"Snapshot checksum mismatch: expected {expected}, got sha256:{checksum.hexdigest()}")
+        snapshot_file.seek(0)
+
+        applied = 0
+        with log_appended, gzip.open(snapshot_file, 'rt', encoding='utf-8') as lines:
+            for line in lines:
+                sequence_number, message = json.loads(line)
+                if sequence_number <= last_processed_sequence:
+                    continue
+                if sequence_number != last_processed_sequence + 1:
+                    raise ValueError(f"Snapshot skips from {last_processed_sequence} to {sequence_number}")
+                process_message(message, sequence_number)
+                applied += 1
+            for buffered_sequence, buffered_message in reorder_buffer.pop_ready(last_processed_sequence + 1):
+                process_message(buffered_message, buffered_sequence)
+            log_appended.notify_all()
+            last_applied = last_processed_sequence
+
+    logging.info(f"Snapshot up to {snapshot_last_seq} loaded: {applied} records applied, last applied: {last_applied}")
+    return last_applied
+
+
+@app.route('/bootstrap', methods=['POST'])
+def bootstrap():
+    # Called by the master when the records this secondary is missing were compacted out of its log
+    try:
+        last_applied = bootstrap_from_snapshot()
+    except (requests.RequestException, ValueError, KeyError, OSError) as e:
+        logging.error(f"Bootstrap from snapshot failed: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 502
+    if last_applied is None:
+        return jsonify({'status': 'error', 'message': 'The master has no snapshot'}), 404
+    return jsonify({'status': 'ACK', 'last_applied': last_applied}), 200
+
+
+### ANTI-ENTROPY ###
+
+def records_between(start, end):
+    # (sequence_number, message) pairs of the log in [start, end). Call with log_lock held
+    first = bisect_left(log_sequences, start)
+    stop = bisect_left(log_sequences, end)
+    return zip(log_sequences[first:stop], log[first:stop])
+
+
+digests = LogDigests(records_between, leaf_records=DIGEST_LEAF_RECORDS)
+
+
+@app.route('/digests', methods=['GET'])
+def get_digests():
+    """
+    Digests of this log for the anti-entropy repair of a peer (see digests.py).
+    Query: ?first=<leaf>&end=<leaf>&span=<leaves per digest>; without them only the summary is returned.
+    """
+    with log_lock:
+        complete = digests.complete_leaves(last_processed_sequence)
+        response = {'leaf_records': DIGEST_LEAF_RECORDS, 'last_applied': last_processed_sequence, 'complete_leaves': complete}
+        if 'first' in request.args:
+            first = request.args.get('first', type=int)
+            end = request.args.get('end', complete, type=int)
+            span = request.args.get('span', 1, type=int)
+            if first is None or end is None or span is None or not 0 <= first <= end <= complete or span < 1:
+                return jsonify({'status': 'error', 'message': f"Ask for leaves 0 <= first <= end <= {complete}, span >= 1"}), 400
+            response['digests'] = digests.ranges(first, end, span)
+    return jsonify(response)
+
+
+@app.route('/repair/records', methods=['GET'])
+def get_repair_records():
+    """
+    Records of [start, end) for the anti-entropy repair of a peer, in the binary framing of wire.py.
+    Query: ?start=<seq>&end=<seq>&limit=<max records>.
+
+    The X-Through header is the last sequence number the answer covers: the numbers up to it that
+    are not in the answer were skipped here as payload duplicates.
+    """
+    start = request.args.get('start', type=int)
+    end = request.args.get('end', type=int)
+    limit = request.args.get('limit', REPAIR_CHUNK_RECORDS, type=int)
+    if start is None or end is None or limit is None or limit < 1:
+        return jsonify({'status': 'error', 'message': 'start, end and limit >= 1 are required'}), 400
+
+    with log_lock:
+        first = bisect_left(log_sequences, start)
+        stop = bisect_left(log_sequences, end)
+        through = min(end - 1, last_processed_sequence)
+        if stop - first > limit:
+            stop = first + limit
+            through = log_sequences[stop] - 1
+        records = [{'sequence_number': sequence_number, 'message': message}
+                   for sequence_number, message in zip(log_sequences[first:stop], log[first:stop])]
+    body, headers = encode_batch(records)
+    headers['X-Through'] = str(through)
+    return Response(body, headers=headers)
+
+
+def fill_hole(sequence_number, message):
+    """
+    Add a record a peer has below the head of this log. Call with log_lock held.
+
+    Returns:
+        str: 'inserted', 'present', 'duplicate' (a payload this log skipped) or 'conflict' (this log
+             has a different message under the number; it is kept, the master's log decides).
+    """
+    global repair_generation
+    index = bisect_left(log_sequences, sequence_number)
+    if index < len(log_sequences) and log_sequences[index] == sequence_number:
+        if log[index] == message:
+            return 'present'
+        logging.error(f"Anti-entropy conflict at sequence {sequence_number}: the peer has a different message")
+        return 'conflict'
+    if DEDUP_PAYLOADS and payload_index.lookup(message) is not None:
+        return 'duplicate'
+    log.insert(index, message)
+    log_sequences.insert(index, sequence_number)
+    if DEDUP_PAYLOADS:
+        payload_index.add(sequence_number, message)
+    digests.invalidate(sequence_number)
+    repair_generation += 1
+    logging.info(f"Anti-entropy filled a hole at sequence {sequence_number}")
+    return 'inserted'
+
+
+def merge_repair(start, records, through, results):
+    """
+    Apply the records pulled from a peer for [start, through], counting what happened in `results`.
+    Call with log_lock held.
+    """
+    global last_processed_sequence
+    received = dict(records)
+    for sequence_number in range(start, through + 1):
+        message = received.get(sequence_number)
+        if sequence_number <= last_processed_sequence:
+            result = fill_hole(sequence_number, message) if message is not None else None
+        elif message is not None:
+            result = apply_record(sequence_number, message)
+        elif sequence_number == last_processed_sequence + 1:
+            # Skipped by the peer as a payload duplicate, so a duplicate here too (unless it is buffered)
+            ready = reorder_buffer.pop_ready(sequence_number)
+            if not ready:
+                last_processed_sequence = sequence_number
+                ready = reorder_buffer.pop_ready(sequence_number + 1)
+            for buffered_sequence, buffered_message in ready:
+                process_message(buffered_message, buffered_sequence)
+            result = 'skipped'
+        else:
+            result = None
+        if result is not None:
+            results[result] = results.get(result, 0) + 1
+            REPAIRED_RECORDS.labels(result).inc()
+    log_appended.notify_all()
+
+
+def pull_range(peer, start, end, results):
+    # Pull the peer's records in [start, end), chunk by chunk, and merge them into the log
+    while start < end:
+        response = requests.get(f"{peer}/repair/records", params={'start': start, 'end': end, 'limit': REPAIR_CHUNK_RECORDS},
+                                timeout=10)
+        response.raise_for_status()
+        # requests has already undone the Content-Encoding
+        records = [(record['sequence_number'], record['message']) for record in decode_records(response.content)]
+        through = int(response.headers['X-Through'])
+        if through < start:
+            return  # The peer has nothing more
+        with log_lock:
+            merge_repair(start, records, through, results)
+        results['pulled'] = results.get('pulled', 0) + len(records)
+        start = through + 1
+
+
+def choose_peer():
+    # The available secondary furthest ahead in the master's member list, None if there is no other one
+    response = requests.get(f"{MASTER_URL}/members", timeout=5)
+    response.raise_for_status()
+    peers = [member for member in response.json()['members'] if member['url'] != SELF_URL and member.get('available')]
+    if not peers:
+        return None
+    return max(peers, key=lambda member: (member['acked'] if member.get('acked') is not None else -1, random.random()))['url']
+
+
+def repair_with(peer):
+    """
+    One anti-entropy round against `peer`: find the complete leaves on which the logs differ and pull
+    only those, then pull the records the peer is ahead by.
+
+    Returns:
+        dict: What was compared and pulled.
+
+    Raises:
+        requests.RequestException: If the peer can't be reached.
+        ValueError: If the peer cuts its log into leaves of another size.
+    """
+    started = time.time()
+    response = requests.get(f"{peer}/digests", timeout=10)
+    response.raise_for_status()
+    summary = response.json()
+    if summary['leaf_records'] != DIGEST_LEAF_RECORDS:
+        raise ValueError(f"{peer} uses leaves of {summary['leaf_records']} records, this secondary {DIGEST_LEAF_RECORDS}")
+    with log_lock:
+        last_applied = last_processed_sequence
+        leaves = min(digests.complete_leaves(last_applied), summary['complete_leaves'])
+
+    def local(first, end, span):
+        with log_lock:
+            return digests.ranges(first, end, span)
+
+    def remote(first, end, span):
+        response = requests.get(f"{peer}/digests", params={'first': first, 'end': end, 'span': span}, timeout=10)
+        response.raise_for_status()
+        return response.json()['digests']
+
+    divergent, digest_requests = divergent_leaves(local, remote, leaves, DIGEST_FANOUT)
+    results = {}
+    for leaf in divergent:
+        pull_range(peer, leaf * DIGEST_LEAF_RECORDS, (leaf + 1) * DIGEST_LEAF_RECORDS, results)
+    if summary['last_applied'] > last_applied:
+        pull_range(peer, last_applied + 1, summary['last_applied'] + 1, results)
+    return {
+        'peer': peer,
+        'compared_leaves': leaves,
+        'digest_requests': digest_requests,
+        'divergent_leaves': divergent,
+        'peer_last_applied': summary['last_applied'],
+        'last_applied': last_processed_sequence,
+        'results': results,
+        'duration': round(time.time() - started, 3),
+    }
+
+
+def run_repair(peer=None):
+    """Run an anti-entropy round against `peer`, or the peer chosen by choose_peer(), and keep its outcome in repair_status."""
+    global repair_status
+    with repair_lock:
+        status = {'at': time.time(), 'peer': peer}
+        try:
+            peer = status['peer'] = peer or choose_peer()
+            if peer is None:
+                status['error'] = 'No other available secondary'
+            else:
+                status.update(repair_with(peer))
+                if status['divergent_leaves'] or status['results']:
+                    logging.info(f"Anti-entropy with {peer}: {len(status['divergent_leaves'])} divergent leaves, {status['results']}")
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.warning(f"Anti-entropy with {peer} failed: {e}")
+            status['error'] = str(e)
+        repair_status = status
+        return status
+
+
+def anti_entropy():
+    # A round every ANTI_ENTROPY_INTERVAL seconds, and one as soon as a gap has been open for ANTI_ENTROPY_GAP_AGE
+    last_round = time.monotonic()
+    while True:
+        time.sleep(1)
+        since_last = time.monotonic() - last_round
+        if since_last >= ANTI_ENTROPY_INTERVAL or (since_last >= ANTI_ENTROPY_GAP_AGE and reorder_buffer.gap_age() >= ANTI_ENTROPY_GAP_AGE):
+            run_repair()
+            last_round = time.monotonic()
+
+
+@app.route('/repair', methods=['POST'])
+def trigger_repair():
+    """
+    Run an anti-entropy round now.
+    Body (optional): {"peer": "http://secondary2:5002"}, otherwise the peer furthest ahead is chosen.
+    """
+    status = run_repair((request.get_json(silent=True) or {}).get('peer'))
+    return jsonify(status), 502 if 'error' in status else 200
+
+
+@app.route('/repair', methods=['GET'])
+def get_repair_status():
+    # Outcome of the last anti-entropy round, and the digest cache
+    return jsonify({'last_round': repair_status, 'interval': ANTI_ENTROPY_INTERVAL, 'digests': digests.stats()})
+
+
+def announce():
+    """
+    Join the cluster: register with the master with this secondary's URL and last_applied.
+    The master adds it to its members if it is new and streams the messages it has missed in the
+    background. Retried until the master answers.
+    An empty secondary first loads the latest snapshot, so only the records after it are streamed.
+    """
+    if SNAPSHOT_BOOTSTRAP and last_processed_sequence == -1:
+        try:
+            bootstrap_from_snapshot()
+        except (requests.RequestException, ValueError, KeyError, OSError) as e:
+            # Not fatal: the master bootstraps the secondary itself if the records it needs are compacted
+            logging.warning(f"Bootstrap from snapshot failed, syncing from the log: {e}")
+    while True:
+        try:
+            response = requests.post(f"{MASTER_URL}/members", json={'url': SELF_URL, 'last_applied': last_processed_sequence}, timeout=5)
+            if response.status_code in (200, 201):
+                logging.info(f"Registered with the master as {SELF_URL}, last applied: {last_processed_sequence}")
+                return
+            logging.warning(f"Registration failed. Status code: {response.status_code}")
+        except requests.RequestException as e:
+            logging.warning(f"Master is not reachable for registration: {e}")
+        time.sleep(SYNC_RETRY_INTERVAL)
+
+
+if __name__ == "__main__":
+    Thread(target=announce, daemon=True).start()
+    if ANTI_ENTROPY_INTERVAL > 0:
+        Thread(target=anti_entropy, name="anti-entropy", daemon=True).start()
+    app.run(host='0.0.0.0', port=PORT)
@@ -0,0 +1,48 @@
+from digests import LogDigests, divergent_leaves
+
+LEAF = 4
+
+
+def digests_of(log):
+    # log: {sequence_number: message}, read like the secondary reads its log
+    return LogDigests(lambda start, end: sorted((n, m) for n, m in log.items() if start <= n < end), leaf_records=LEAF)
+
+
+def compare(mine, theirs, leaves, fanout=4):
+    return divergent_leaves(mine.ranges, theirs.ranges, leaves, fanout=fanout)
+
+
+def test_identical_logs_take_one_call():
+    log = {n: f"m{n}" for n in range(64)}
+    assert compare(digests_of(log), digests_of(dict(log)), 16) == ([], 1)
+
+
+def test_divergent_leaves_are_found():
+    mine = {n: f"m{n}" for n in range(64)}
+    theirs = dict(mine)
+    del theirs[13]           # A hole in leaf 3
+    theirs[61] = 'changed'   # A conflict in leaf 15
+    leaves, calls = compare(digests_of(mine), digests_of(theirs), 16)
+    assert leaves == [3, 15]
+    assert calls == 3  # The whole range, then 2 differing groups of 4 leaves
+
+
+def test_complete_leaves():
+    digests = digests_of({})
+    assert digests.complete_leaves(-1) == 0
+    assert digests.complete_leaves(2) == 0
+    assert digests.complete_leaves(3) == 1
+    assert compare(digests, digests, 0) == ([], 0)
+
+
+def test_filled_hole_is_hashed_again():
+    mine = {n: f"m{n}" for n in range(8)}
+    theirs = dict(mine)
+    del theirs[5]
+    their_digests = digests_of(theirs)
+    assert compare(digests_of(mine), their_digests, 2) == ([1], 1)
+
+    theirs[5] = 'm5'
+    assert compare(digests_of(mine), their_digests, 2)[0] == [1]  # Still the cached digest
+    their_digests.invalidate(5)
+    assert compare(digests_of(mine), their_digests, 2)[0] == []
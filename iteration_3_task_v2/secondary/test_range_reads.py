@@ -0,0 +1,54 @@
+import pytest
+
+
+def replicate(secondary, messages, start=0):
+    records = [{'sequence_number': start + n, 'message': message} for n, message in enumerate(messages)]
+    response = secondary.app.test_client().post('/replicate_batch', json={'records': records})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_range_read(secondary):
+    replicate(secondary, list('abcdef'))
+    client = secondary.app.test_client()
+    response = client.get('/messages?since=1&until=4')
+    assert response.get_json() == {'messages': ['b', 'c', 'd'], 'next_since': 4, 'high_watermark': 5}
+    assert client.get('/messages?since=4&limit=10').get_json()['next_since'] == 6
+    assert client.get('/messages/2').get_json() == {'sequence_number': 2, 'message': 'c'}
+
+
+def test_range_read_over_skipped_duplicates(secondary):
+    replicate(secondary, ['a', 'b', 'a', 'c'])  # Sequence number 2 is a payload duplicate, not stored
+    client = secondary.app.test_client()
+    assert client.get('/messages?since=2').get_json() == {'messages': ['c'], 'next_since': 4, 'high_watermark': 3}
+    assert client.get('/messages?since=0&limit=2').get_json()['next_since'] == 3
+    assert client.get('/messages/2').status_code == 404
+
+
+def test_unchanged_log_is_not_modified(secondary):
+    replicate(secondary, ['a', 'b'])
+    client = secondary.app.test_client()
+    etag = client.get('/messages').headers['ETag']
+    assert client.get('/messages', headers={'If-None-Match': etag}).status_code == 304
+
+    replicate(secondary, ['c'], start=2)
+    changed = client.get('/messages', headers={'If-None-Match': etag})
+    assert changed.status_code == 200 and changed.get_json()['messages'] == ['a', 'b', 'c']
+
+
+def test_early_records_are_not_read_before_the_gap_is_filled(secondary):
+    replicate(secondary, ['a'])
+    replicate(secondary, ['c'], start=2)  # Waits in the reorder buffer
+    client = secondary.app.test_client()
+    assert client.get('/messages').get_json() == {'messages': ['a'], 'next_since': 1, 'high_watermark': 0}
+    replicate(secondary, ['b'], start=1)
+    assert client.get('/messages').get_json()['messages'] == ['a', 'b', 'c']
+
+
+@pytest.mark.parametrize('query', ['since=-1', 'until=x', 'limit=1.5'])
+def test_bad_range_is_refused_with_400(secondary, query):
+    assert secondary.app.test_client().get(f"/messages?{query}").status_code == 400
+
+
+def test_unknown_partition_is_not_found(secondary):
+    assert secondary.app.test_client().get('/messages?partition=3').status_code == 404
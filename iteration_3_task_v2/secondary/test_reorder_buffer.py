@@ -0,0 +1,45 @@
+import time
+
+from reorder_buffer import ReorderBuffer
+
+
+def test_early_records_wait_for_the_gap():
+    buffer = ReorderBuffer()
+    assert buffer.add(3, 'd')
+    assert buffer.add(2, 'c')
+    assert buffer.add(5, 'f')
+    assert buffer.pop_ready(1) == []
+    assert buffer.pop_ready(2) == [(2, 'c'), (3, 'd')]
+    assert len(buffer) == 1
+    assert buffer.pop_ready(5) == [(5, 'f')]
+    assert len(buffer) == 0
+
+
+def test_duplicate_is_kept_once():
+    buffer = ReorderBuffer()
+    assert buffer.add(1, 'b')
+    assert buffer.add(1, 'b')
+    assert len(buffer) == 1
+
+
+def test_full_buffer_refuses_new_records():
+    buffer = ReorderBuffer(max_size=2)
+    assert buffer.add(1, 'b')
+    assert buffer.add(2, 'c')
+    assert not buffer.add(3, 'd')
+    assert buffer.add(2, 'c')  # Already held, so not refused
+    assert buffer.stats()['lowest_buffered'] == 1
+
+
+def test_gap_age():
+    buffer = ReorderBuffer()
+    assert buffer.gap_age() == 0
+    buffer.add(2, 'c')
+    buffer.add(4, 'e')
+    time.sleep(0.02)
+    assert buffer.gap_age() >= 0.02
+    buffer.pop_ready(2)
+    assert buffer.gap_age() < 0.02  # A new gap, before 4
+    buffer.pop_ready(4)
+    assert buffer.gap_age() == 0
+    assert buffer.stats() == {'depth': 0, 'max_size': 10000, 'gap_age': 0, 'lowest_buffered': None}
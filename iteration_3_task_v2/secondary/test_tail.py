@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+
+
+def replicate(secondary, messages, start=0):
+    records = [{'sequence_number': start + n, 'message': message} for n, message in enumerate(messages)]
+    response = secondary.app.test_client().post('/replicate_batch', json={'records': records})
+    assert response.status_code == 200
+
+
+def records(*pairs):
+    return [{'sequence_number': n, 'message': m} for n, m in pairs]
+
+
+def test_tail_answers_at_once_when_there_is_something_newer(secondary):
+    replicate(secondary, ['a', 'b', 'c'])
+    response = secondary.app.test_client().get('/messages/tail?after=0&timeout=5')
+    assert response.get_json() == {'records': records((1, 'b'), (2, 'c')), 'high_watermark': 2}
+
+
+def test_tail_waits_for_the_next_message(secondary):
+    replicate(secondary, ['a'])
+    timer = threading.Timer(0.1, replicate, args=(secondary, ['b'], 1))
+    timer.start()
+    started = time.monotonic()
+    response = secondary.app.test_client().get('/messages/tail?after=0&timeout=5')
+    timer.join()
+    assert time.monotonic() - started < 4
+    assert response.get_json() == {'records': records((1, 'b')), 'high_watermark': 1}
+
+
+def test_tail_times_out_with_no_records(secondary):
+    replicate(secondary, ['a'])
+    response = secondary.app.test_client().get('/messages/tail?after=0&timeout=0.05')
+    assert response.get_json() == {'records': [], 'high_watermark': 0}
+
+
+def test_tail_cut_short_by_the_limit_resumes_after_the_last_record(secondary):
+    replicate(secondary, ['a', 'b', 'c', 'd'])
+    client = secondary.app.test_client()
+    body = client.get('/messages/tail?after=-1&limit=2').get_json()
+    assert body == {'records': records((0, 'a'), (1, 'b')), 'high_watermark': 1}
+    body = client.get(f"/messages/tail?after={body['high_watermark']}&limit=2").get_json()
+    assert body == {'records': records((2, 'c'), (3, 'd')), 'high_watermark': 3}
+
+
+def test_tail_moves_past_skipped_duplicates(secondary):
+    replicate(secondary, ['a', 'b', 'a'])  # Sequence number 2 is a payload duplicate, not stored
+    body = secondary.app.test_client().get('/messages/tail?after=1&timeout=0').get_json()
+    assert body == {'records': [], 'high_watermark': 2}
+
+
+def first_events(response):
+    # The first chunk of an event stream, then the stream is closed
+    chunk = next(iter(response.response))
+    response.close()
+    return chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+
+
+def test_event_stream_sends_one_event_per_record(secondary):
+    replicate(secondary, ['a', 'b', 'c'])
+    response = secondary.app.test_client().get('/messages/stream?after=0', buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    assert first_events(response) == (
+        'id: 1\ndata: {"sequence_number": 1, "message": "b"}\n\n'
+        'id: 2\ndata: {"sequence_number": 2, "message": "c"}\n\n')
+
+
+def test_event_stream_resumes_from_the_last_event_id(secondary):
+    replicate(secondary, ['a', 'b', 'c'])
+    response = secondary.app.test_client().get('/messages/stream?after=-1', headers={'Last-Event-ID': '1'},
+                                               buffered=False)
+    assert first_events(response).startswith('id: 2\n')
+
+
+@pytest.mark.parametrize('query', ['after=x', 'timeout=soon', 'limit=1.5'])
+def test_bad_tail_is_refused_with_400(secondary, query):
+    assert secondary.app.test_client().get(f"/messages/tail?{query}").status_code == 400